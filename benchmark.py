@@ -0,0 +1,463 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the stages of the map creation that run in python.
+
+The stages run against the polygons of the polygons directory and against
+synthetic land polygons: a grid of polygons with a configurable number of
+vertices over the whole world, written as a shapefile like the downloaded
+land polygons. Osmosis is replaced by resources/stub-osmosis, which only
+writes small output files, so the benchmark runs offline and measures the
+calls mapcreator makes, not osmosis itself. The same calls are also measured
+on a pool of workers with resources/stub-osmosis-worker.
+
+Every run of a stage is a child process of its own, so all runs start with
+the same state and the peak memory of a stage is not hidden by an earlier
+one. For every stage the fastest of the repeated runs is reported with its
+throughput, peak memory is the maximum of all runs. The results are compared
+to a baseline file and lower throughput or higher peak memory than the
+tolerance allows is reported as a regression. The baseline is written with
+--save-baseline, it is only meaningful on the same machine, so none is
+shipped and running without one is an error.
+'''
+
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+from optparse import OptionParser
+from shapely.geometry import Polygon, box
+try:
+    from osgeo import ogr
+except ImportError:
+    import ogr
+import costmodel
+import instrumentation
+import landextraction
+import executors
+import mapcreator
+import osmosisworker
+import shape2osm
+
+RESOURCES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources')
+STUB_OSMOSIS = os.path.join(RESOURCES_PATH, 'stub-osmosis')
+STUB_WORKER = os.path.join(RESOURCES_PATH, 'stub-osmosis-worker')
+BASELINE_FILE = os.path.join(RESOURCES_PATH, 'benchmark-baseline.json')
+
+# the part the measured stages are recorded for
+BENCHMARK_PART = 'benchmark'
+
+# counts returned by the stages and the throughput reported for them
+RATES = [('polygons', 'polygons/s', 1), ('nodes', 'nodes/s', 1), ('bytes', 'MB/s', 1024 * 1024), ('calls', 'calls/s', 1)]
+
+
+class Benchmark:
+
+    def __init__(self, polygons_path, work_dir, land_polygons=2000, vertices=200):
+        self.polygons_path = mapcreator.normalize_path(polygons_path)
+        self.work_dir = work_dir
+        self.land_polygons = land_polygons
+        self.vertices = vertices
+        self.land_nodes = 0
+        self.polygon_files = []
+        for (directory, dirs, files) in os.walk(self.polygons_path):
+            self.polygon_files += [os.path.join(directory, f) for f in files if f.endswith('.poly')]
+        self.polygon_files.sort()
+
+    def settings(self):
+        '''
+        the inputs of the benchmark, results are only comparable for the same settings
+        '''
+        return {'polygons': len(self.polygon_files), 'land-polygons': self.land_polygons, 'vertices': self.vertices}
+
+    def stage_dir(self, name):
+        return os.path.join(self.work_dir, name.replace(' ', '-'))
+
+    def land_extractor(self, name):
+        return landextraction.LandExtractor(mapcreator.normalize_path(self.stage_dir(name)), self.polygons_path)
+
+    def land_shapefile(self):
+        return self.land_extractor('land').land_polygon_shapefile(self.work_dir)
+
+    def top_level_regions(self):
+        return sorted(f[:-len('.poly')] for f in os.listdir(self.polygons_path) if f.endswith('.poly'))
+
+    def part_tree(self):
+        '''
+        the names of the parts per staging directory, like the parts of a configuration with all polygons
+        '''
+        parts = {}
+        for polygon_file in self.polygon_files:
+            (staging_dir, name) = os.path.split(polygon_file[len(self.polygons_path):-len('.poly')])
+            parts.setdefault(mapcreator.normalize_path(staging_dir), []).append(name)
+        return parts
+
+    def write_land_shapefile(self):
+        '''
+        writes the synthetic land polygons, every fourth polygon has a hole
+        '''
+        columns = int(math.ceil(math.sqrt(2 * self.land_polygons)))
+        rows = int(math.ceil(float(self.land_polygons) / columns))
+        (width, height) = (360.0 / columns, 170.0 / rows)
+        radius = 0.45 * min(width, height)
+        directory = os.path.dirname(self.land_shapefile())
+        driver = ogr.GetDriverByName("ESRI Shapefile")
+        if os.path.exists(directory):
+            driver.DeleteDataSource(directory)
+        data_source = driver.CreateDataSource(directory)
+        layer = data_source.CreateLayer('land_polygons', geom_type=ogr.wkbPolygon)
+        for name in ('x', 'y'):
+            layer.CreateField(ogr.FieldDefn(name, ogr.OFTInteger))
+        definition = layer.GetLayerDefn()
+        self.land_nodes = 0
+        for i in range(self.land_polygons):
+            (column, row) = (i % columns, i // columns)
+            center = (-180 + (column + 0.5) * width, -85 + (row + 0.5) * height)
+            holes = []
+            if i % 4 == 0:
+                holes.append(ring(center, radius / 2, max(3, self.vertices // 4)))
+            polygon = Polygon(ring(center, radius, self.vertices), holes)
+            self.land_nodes += self.vertices + sum(len(hole) for hole in holes)
+            feature = ogr.Feature(definition)
+            feature.SetField(0, column)
+            feature.SetField(1, row)
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(polygon.wkb))
+            layer.CreateFeature(feature)
+            feature = None
+        data_source = None
+
+
+def ring(center, radius, vertices):
+    return [(center[0] + radius * math.cos(2 * math.pi * i / vertices),
+             center[1] + radius * math.sin(2 * math.pi * i / vertices)) for i in range(vertices)]
+
+
+def file_size(path):
+    '''
+    size of a file or of all files in a directory
+    '''
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return os.path.getsize(path)
+
+
+# the stages, each gets the benchmark and the stage to measure its work with and returns the counts of its work
+
+def poly_parse_stage(benchmark, measure):
+    extractor = benchmark.land_extractor('poly parse')
+    with measure:
+        polygons = [extractor.read_polygon(f) for f in benchmark.polygon_files]
+    return {'polygons': len(polygons), 'nodes': sum(landextraction.vertex_count(p) for p in polygons),
+            'bytes': sum(os.path.getsize(f) for f in benchmark.polygon_files)}
+
+
+def bbox_stage(benchmark, measure):
+    extractor = benchmark.land_extractor('bbox')
+    for polygon_file in benchmark.polygon_files:
+        extractor.read_polygon(polygon_file)
+    with measure:
+        for polygon_file in benchmark.polygon_files:
+            extractor.polygon_bbox(polygon_file)
+    return {'polygons': len(benchmark.polygon_files)}
+
+
+def land_index_stage(benchmark, measure):
+    extractor = benchmark.land_extractor('land index')
+    with measure:
+        extractor.land_polygon_index(benchmark.work_dir)
+    return {'polygons': benchmark.land_polygons, 'nodes': benchmark.land_nodes,
+            'bytes': file_size(os.path.dirname(benchmark.land_shapefile()))}
+
+
+def land_clip_stage(benchmark, measure):
+    extractor = benchmark.land_extractor('land clip')
+    land_index = extractor.land_polygon_index(benchmark.work_dir)
+    regions = benchmark.top_level_regions()
+    clip_boxes = [box(*extractor.region_bbox(region)) for region in regions]
+    polygons = 0
+    with measure:
+        for (region, clip_box) in zip(regions, clip_boxes):
+            land_polygons = land_index.clip(clip_box)
+            land_index.write_shapefile(land_polygons, os.path.join(extractor.output_dir, region))
+            polygons += len(land_polygons)
+    return {'polygons': polygons, 'bytes': sum(file_size(os.path.join(extractor.output_dir, r)) for r in regions)}
+
+
+def shape2osm_stage(benchmark, measure, output_format='osm'):
+    stage = 'shape2osm pbf' if output_format == 'pbf' else 'shape2osm'
+    output_location = os.path.join(benchmark.stage_dir(stage), 'land')
+    mapcreator.check_create_path(output_location)
+    with measure:
+        shape2osm.run(benchmark.land_shapefile(), output_location=output_location, output_format=output_format)
+    output = output_location + ('.osm.pbf' if output_format == 'pbf' else '.osm')
+    return {'polygons': benchmark.land_polygons, 'nodes': benchmark.land_nodes, 'bytes': os.path.getsize(output)}
+
+
+def shape2osm_pbf_stage(benchmark, measure):
+    return shape2osm_stage(benchmark, measure, 'pbf')
+
+
+def osmosis_calls_stage(benchmark, measure, workers=False):
+    '''
+    creates the pbfs and maps of all parts with the stub osmosis, or with a stub osmosis worker
+    '''
+    stage = 'osmosis workers' if workers else 'osmosis calls'
+    work_dir = benchmark.stage_dir(stage)
+    # created as dry run, which does not download the land polygons
+    creator = mapcreator.MapCreator(STUB_OSMOSIS, os.path.join(work_dir, 'data'), os.path.join(work_dir, 'maps'),
+                                    benchmark.polygons_path, 'planet.osm.pbf', os.path.join(work_dir, 'target'),
+                                    os.path.join(work_dir, 'logs'), 14, 'en', dry_run=True)
+    creator.dry_run = False
+    with open(creator.pbf_staging_path + 'planet.osm.pbf', 'w') as f:
+        f.write('stub')
+    if workers:
+        # the stub worker has no heap limit, every call can run on it
+        worker_heap = costmodel.physical_memory() or 0
+        creator.executor = executors.LocalExecutor(osmosisworker.WorkerPool([sys.executable, STUB_WORKER], 1, worker_heap))
+    created = set()
+    calls = 0
+    with measure:
+        for (staging_dir, names) in sorted(benchmark.part_tree().items()):
+            source_pbf = enclosing_pbf(staging_dir, created)
+            for (name, result) in creator.call_create_pbfs(source_pbf, staging_dir, names).items():
+                if isinstance(result, mapcreator.ProcessingException):
+                    raise result
+                created.add(result)
+            calls += 1
+            for name in names:
+                creator.call_create_map(source_pbf, staging_dir, staging_dir, name, True, 14, 'en', '')
+                # the map writer and the move of the map
+                calls += 2
+        creator.executor.close()
+    return {'polygons': len(benchmark.polygon_files), 'calls': calls}
+
+
+def osmosis_workers_stage(benchmark, measure):
+    return osmosis_calls_stage(benchmark, measure, True)
+
+
+def enclosing_pbf(staging_dir, created):
+    '''
+    the pbf of the closest enclosing part that has one, directories without polygon have none
+    '''
+    region = staging_dir.rstrip('/')
+    while region:
+        if region + '.osm.pbf' in created:
+            return region + '.osm.pbf'
+        region = region.rpartition('/')[0]
+    return 'planet.osm.pbf'
+
+
+STAGES = [('poly parse', poly_parse_stage), ('bbox', bbox_stage), ('land index', land_index_stage),
+          ('land clip', land_clip_stage), ('shape2osm', shape2osm_stage), ('shape2osm pbf', shape2osm_pbf_stage),
+          ('osmosis calls', osmosis_calls_stage), ('osmosis workers', osmosis_workers_stage)]
+
+# stages that need the synthetic land polygons
+LAND_STAGES = set(['land index', 'land clip', 'shape2osm', 'shape2osm pbf'])
+
+
+def run_stage(benchmark, name):
+    '''
+    runs a stage in a child process, returns its wall and cpu time, counts and peak memory
+    '''
+    function = dict(STAGES)[name]
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            # the stages print their progress, e.g. shape2osm
+            os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+            # nothing of an earlier run, e.g. cached bounding boxes or the build manifest, is reused
+            shutil.rmtree(benchmark.stage_dir(name), True)
+            instrumentation.reset()
+            counts = function(benchmark, instrumentation.stage(BENCHMARK_PART, name))
+            record = [r for r in instrumentation.report().records if r['part'] == BENCHMARK_PART][-1]
+            result = {'wall': record['wall'], 'cpu': record['cpu'], 'counts': counts}
+        except Exception, e:
+            traceback.print_exc()
+            result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            status = 1
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(result, f)
+        os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    (pid, status, usage) = os.wait4(pid, 0)
+    try:
+        result = json.loads(output)
+    except ValueError:
+        result = {'error': 'stage process ended with status %d' % status}
+    result['max_rss_kb'] = usage.ru_maxrss
+    return result
+
+
+def run(benchmark, stages, repeat):
+    '''
+    runs the stages repeat times, returns the fastest run of every stage and the errors of failed stages
+    '''
+    results = {}
+    errors = {}
+    for name in stages:
+        for i in range(repeat):
+            result = run_stage(benchmark, name)
+            if 'error' in result:
+                errors[name] = result['error']
+                break
+            best = results.get(name)
+            if best is None or result['wall'] < best['wall']:
+                if best is not None:
+                    result['max_rss_kb'] = max(result['max_rss_kb'], best['max_rss_kb'])
+                results[name] = result
+            else:
+                best['max_rss_kb'] = max(result['max_rss_kb'], best['max_rss_kb'])
+        if name in results:
+            results[name]['rates'] = throughput(results[name])
+    return (results, errors)
+
+
+def throughput(result):
+    wall = max(result['wall'], 1e-9)
+    return dict((rate, result['counts'][count] / float(scale) / wall)
+                for (count, rate, scale) in RATES if count in result['counts'])
+
+
+def compare(results, baseline, tolerance):
+    '''
+    returns the regressions against the baseline: lower throughput or higher peak memory than the tolerance allows
+    '''
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        reference = baseline['stages'].get(name)
+        if reference is None:
+            continue
+        for (rate, value) in sorted(result['rates'].items()):
+            if rate in reference['rates'] and value < reference['rates'][rate] * (1 - tolerance):
+                regressions.append("%s: %.1f %s, baseline %.1f %s" % (name, value, rate, reference['rates'][rate], rate))
+        if result['max_rss_kb'] > reference['max_rss_kb'] * (1 + tolerance):
+            regressions.append("%s: peak memory %.1f MB, baseline %.1f MB" %
+                               (name, result['max_rss_kb'] / 1024.0, reference['max_rss_kb'] / 1024.0))
+    return regressions
+
+
+def print_results(stages, results, errors, baseline):
+    print "%-15s %9s %9s %9s  %s" % ('stage', 'wall s', 'cpu s', 'peak MB', 'throughput')
+    for name in stages:
+        if name in errors:
+            print "%-15s failed: %s" % (name, errors[name])
+            continue
+        result = results[name]
+        reference = baseline['stages'].get(name) if baseline else None
+        rates = []
+        for (count, rate, scale) in RATES:
+            if rate not in result['rates']:
+                continue
+            text = "%.1f %s" % (result['rates'][rate], rate)
+            if reference and reference['rates'].get(rate):
+                text += " (%+.1f%%)" % (100.0 * (result['rates'][rate] / reference['rates'][rate] - 1))
+            rates.append(text)
+        print "%-15s %9.3f %9.3f %9.1f  %s" % (name, result['wall'], result['cpu'], result['max_rss_kb'] / 1024.0,
+                                                ', '.join(rates))
+
+
+def read_baseline(path, settings):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        baseline = json.load(f)
+    if baseline.get('settings') != settings:
+        print "the baseline %s was measured with other settings %s" % (path, baseline.get('settings'))
+        return None
+    return baseline
+
+
+def write_baseline(path, settings, results):
+    stages = dict((name, {'wall': r['wall'], 'cpu': r['cpu'], 'max_rss_kb': r['max_rss_kb'], 'rates': r['rates']})
+                  for (name, r) in results.items())
+    with open(path, 'w') as f:
+        json.dump({'settings': settings, 'stages': stages}, f, indent=1, sort_keys=True)
+
+
+def main():
+    usage = "usage: %prog [-p POLYGONS_PATH] [-n REPEAT] [-s STAGE] [-b BASELINE_FILE] [--save-baseline]"
+    option_parser = OptionParser(usage, version='1.0')
+    option_parser.add_option("-p", "--polygons-path", dest="polygons_path",
+                             action='store', default='polygons',
+                             help="the polygons to run the benchmark with [default=polygons]")
+    option_parser.add_option("-n", "--repeat", dest="repeat",
+                             action='store', type='int', default=3,
+                             help="number of runs of every stage, the fastest is reported [default=3]")
+    option_parser.add_option("-s", "--stage", dest="stages",
+                             action='append', choices=[name for (name, function) in STAGES],
+                             help="only run this stage, can be given several times [default=all stages]")
+    option_parser.add_option("--land-polygons", dest="land_polygons",
+                             action='store', type='int', default=2000,
+                             help="number of synthetic land polygons [default=2000]")
+    option_parser.add_option("--vertices", dest="vertices",
+                             action='store', type='int', default=200,
+                             help="vertices of every synthetic land polygon [default=200]")
+    option_parser.add_option("-b", "--baseline", dest="baseline_file",
+                             action='store', default=BASELINE_FILE,
+                             help="the baseline to compare with [default=resources/benchmark-baseline.json]")
+    option_parser.add_option("--save-baseline", dest="save_baseline",
+                             action='store_true', default=False,
+                             help="store the results as new baseline instead of comparing with it [default=false]")
+    option_parser.add_option("-t", "--tolerance", dest="tolerance",
+                             action='store', type='float', default=0.2,
+                             help="relative change to the baseline reported as regression [default=0.2]")
+    (options, args) = option_parser.parse_args()
+
+    if len(args) != 0:
+        option_parser.print_help()
+        sys.exit("incorrect number of arguments")
+    if not os.path.isdir(options.polygons_path):
+        sys.exit("the polygons path '%s' could not be found" % options.polygons_path)
+    if not options.save_baseline and not os.path.exists(options.baseline_file):
+        sys.exit("the baseline '%s' could not be found, store one with --save-baseline" % options.baseline_file)
+
+    logging.basicConfig(level=logging.WARNING)
+    stages = [name for (name, function) in STAGES if not options.stages or name in options.stages]
+    work_dir = tempfile.mkdtemp(prefix='mapcreator-benchmark-')
+    try:
+        benchmark = Benchmark(options.polygons_path, work_dir, options.land_polygons, options.vertices)
+        if LAND_STAGES & set(stages):
+            benchmark.write_land_shapefile()
+        (results, errors) = run(benchmark, stages, options.repeat)
+    finally:
+        shutil.rmtree(work_dir, True)
+
+    settings = benchmark.settings()
+    if options.save_baseline:
+        if errors:
+            sys.exit("not storing a baseline, %d stages failed" % len(errors))
+        baseline = read_baseline(options.baseline_file, settings)
+        if baseline:
+            # keep the stages that did not run
+            baseline['stages'].update(results)
+            results = baseline['stages']
+        write_baseline(options.baseline_file, settings, results)
+        print_results(stages, results, errors, None)
+        print "stored baseline %s" % options.baseline_file
+        return
+
+    baseline = read_baseline(options.baseline_file, settings)
+    print_results(stages, results, errors, baseline)
+    if not baseline:
+        sys.exit("the baseline '%s' was measured with other settings, store a new one with --save-baseline" %
+                 options.baseline_file)
+    regressions = compare(results, baseline, options.tolerance)
+    for regression in regressions:
+        print "REGRESSION %s" % regression
+    if errors or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Build manifest recording a fingerprint of the inputs of every created file.
+
+An output is only created again if the fingerprint of its inputs differs from
+the recorded one or the file is missing. Fingerprints of created pbfs are part
+of the fingerprints of everything created from them, so a changed input
+causes all outputs downstream of it to be rebuilt.
+
+For outputs recorded with their inputs, the inputs of the fingerprint are
+kept as well, so a later run can tell which of them changed.
+
+The manifest also keeps the content digests of input files, which are only
+computed again if the modification time or size of a file changed.
+
+Recorded values are only written to disk by save, which the caller calls once
+per stage or at the end of the run.
+'''
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import osmpbf
+import polygoncache
+
+DIGEST_BLOCK_SIZE = 1024 * 1024
+
+
+class BuildManifest:
+
+    def __init__(self, manifest_file=None):
+        self.logger = logging.getLogger("mapcreator")
+        self.manifest_file = manifest_file
+        self.lock = threading.Lock()
+        self.outputs = {}
+        self.inputs = {}
+        self.digests = {}
+        # true if there are values that were not saved yet
+        self.dirty = False
+        if manifest_file and os.path.exists(manifest_file):
+            try:
+                with open(manifest_file) as f:
+                    content = json.load(f)
+                self.outputs = content.get('outputs', {})
+                self.inputs = content.get('inputs', {})
+                self.digests = content.get('digests', {})
+            except (IOError, ValueError), e:
+                self.logger.warning("ignoring invalid build manifest %s: %s", manifest_file, e)
+
+    def is_current(self, output, path, fingerprint):
+        '''
+        returns true if the output at path exists and was created from inputs with the same fingerprint
+        '''
+        with self.lock:
+            recorded = self.outputs.get(output)
+        return recorded == fingerprint and os.path.exists(path)
+
+    def differs_only_in(self, output, inputs, index):
+        '''
+        returns true if the output was recorded with inputs that equal the given ones except the one at index
+        '''
+        with self.lock:
+            recorded = self.inputs.get(output)
+        # the recorded inputs went through json, so tuples became lists
+        inputs = json.loads(json.dumps(inputs))
+        if recorded is None or len(recorded) != len(inputs):
+            return False
+        return all(recorded[i] == inputs[i] for i in range(len(inputs)) if i != index)
+
+    def record(self, output, fingerprint, inputs=None):
+        '''
+        records the fingerprint of an output, and the inputs it was computed from if they are given
+        '''
+        if inputs is not None:
+            inputs = json.loads(json.dumps(inputs))
+        with self.lock:
+            if self.outputs.get(output) == fingerprint and self.inputs.get(output) == inputs:
+                return
+            self.outputs[output] = fingerprint
+            if inputs is None:
+                self.inputs.pop(output, None)
+            else:
+                self.inputs[output] = inputs
+            self.dirty = True
+
+    def file_digest(self, path):
+        '''
+        sha1 of the content of a file, computed again only if the file changed
+        '''
+        path = os.path.abspath(path)
+        stamp = polygoncache.file_stamp(path)
+        with self.lock:
+            entry = self.digests.get(path)
+            if entry and entry[0] == stamp:
+                return entry[1]
+
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(DIGEST_BLOCK_SIZE), ''):
+                sha1.update(block)
+        digest = sha1.hexdigest()
+
+        with self.lock:
+            self.digests[path] = [stamp, digest]
+            self.dirty = True
+        return digest
+
+    def pbf_version(self, path):
+        '''
+        the replication sequence number of a pbf, its content digest if the header has none
+        '''
+        try:
+            header = osmpbf.read_header(path)
+        except Exception, e:
+            # missing, empty or not a pbf
+            self.logger.debug("could not read header of %s: %s", path, e)
+            header = {}
+        if 33 in header:
+            return 'sequence:%s:%s' % (header.get(34, ''), header[33])
+        return 'sha1:%s' % self.file_digest(path)
+
+    def save(self):
+        '''
+        writes the manifest to disk if values were recorded since it was last written
+        '''
+        if not self.manifest_file:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_file = self.manifest_file + '.tmp'
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump({'outputs': self.outputs, 'inputs': self.inputs, 'digests': self.digests}, f)
+                os.rename(tmp_file, self.manifest_file)
+                self.dirty = False
+            except (IOError, OSError), e:
+                self.logger.warning("could not write build manifest %s: %s", self.manifest_file, e)
+
+
+def fingerprint(*inputs):
+    '''
+    digest of the given inputs, which have to be json serializable
+    '''
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def osmosis_version(osmosis_path):
+    '''
+    the version osmosis reports and the jars of its installation and plugins,
+    which include the map and poi writers
+    '''
+    version = ''
+    try:
+        process = subprocess.Popen([osmosis_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        match = re.search(r'Osmosis Version (\S+)', process.communicate()[0])
+        if match:
+            version = match.group(1)
+    except OSError:
+        pass
+    osmosis_home = os.path.dirname(os.path.dirname(os.path.realpath(osmosis_path)))
+    jars = glob.glob(os.path.join(osmosis_home, 'lib', '*', '*.jar'))
+    jars += glob.glob(os.path.expanduser(os.path.join('~', '.openstreetmap', 'osmosis', 'plugins', '*.jar')))
+    return [version] + sorted([os.path.basename(jar), os.path.getsize(jar)] for jar in jars)
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Build node running the osmosis calls mapcreator dispatches to it over TCP.
+
+Every call is a connection of its own: mapcreator sends one line with a
+JSON object holding the shared token, the osmosis arguments, the working
+directory, the JAVACMD_OPTIONS (the heap) of the call and its input and
+output files (relative to the working directory), the node runs osmosis and
+answers with one line holding the exit status, the CPU time and peak
+memory of osmosis and its output, which mapcreator appends to the log of
+the call. Calls with another token are refused.
+
+The staging paths are shared: the files must have the same paths on all
+nodes, e.g. on a network file system. A call whose inputs the node cannot
+see fails.
+
+Anyone who can connect to a node and knows the token can run osmosis with
+any arguments as the user of the node, i.e. read and write all files of
+that user. The token is sent in plain text, so only bind nodes to addresses
+of trusted networks.
+
+usage: python buildnode.py [-b ADDRESS] [-p PORT] [-o OSMOSIS_PATH] [-t TOKEN]
+'''
+
+import hmac
+import json
+import logging
+import os
+import socket
+import SocketServer
+import subprocess
+import sys
+import tempfile
+from optparse import OptionParser
+
+DEFAULT_PORT = 7643
+# environment variable holding the token of the nodes, for buildnode.py and mapcreator
+TOKEN_VARIABLE = 'MAPCREATOR_NODE_TOKEN'
+
+
+class NodeUnavailable(Exception):
+    '''
+    the node could not be reached, the call was not started
+    '''
+    pass
+
+
+class CallHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            if not valid_token(self.server.token, request.get('token')):
+                logging.getLogger("mapcreator").warning("refusing call from %s with an invalid token", self.client_address[0])
+                reply = {'error': 'invalid token'}
+            else:
+                reply = run_call(self.server.osmosis_path, request)
+        except (ValueError, KeyError, AttributeError), e:
+            reply = {'status': 1, 'cpu': 0.0, 'max_rss_kb': 0, 'log': 'invalid request: %s\n' % e}
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+class NodeServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, osmosis_path, token):
+        SocketServer.ThreadingTCPServer.__init__(self, address, CallHandler)
+        self.osmosis_path = osmosis_path
+        self.token = token
+
+
+def valid_token(token, request_token):
+    if not token or not isinstance(request_token, basestring):
+        return False
+    # compared in constant time, so the token cannot be guessed from the time of the answer
+    return hmac.compare_digest(token.encode('utf-8'), request_token.encode('utf-8'))
+
+
+def run_call(osmosis_path, request):
+    '''
+    runs the osmosis call of a request, returns the reply
+    '''
+    cwd = request.get('cwd') or os.getcwd()
+    missing = [path for path in request.get('inputs', []) if not os.path.exists(os.path.join(cwd, path))]
+    if missing:
+        return {'status': 1, 'cpu': 0.0, 'max_rss_kb': 0,
+                'log': 'inputs missing on node %s: %s\n' % (socket.gethostname(), ', '.join(missing))}
+    env = dict(os.environ)
+    if request.get('java_options'):
+        env['JAVACMD_OPTIONS'] = request['java_options']
+    for path in request.get('outputs', []):
+        directory = os.path.dirname(os.path.join(cwd, path))
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+    logging.getLogger("mapcreator").info("running: %s", " ".join(request['args']))
+    with tempfile.TemporaryFile() as log:
+        try:
+            process = subprocess.Popen([osmosis_path] + request['args'], stdout=log, stderr=log, env=env, cwd=cwd)
+        except OSError, e:
+            return {'status': 1, 'cpu': 0.0, 'max_rss_kb': 0, 'log': 'could not run osmosis in %s: %s\n' % (cwd, e)}
+        (pid, status, usage) = os.wait4(process.pid, 0)
+        log.seek(0)
+        output = log.read()
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    return {'status': returncode, 'cpu': usage.ru_utime + usage.ru_stime, 'max_rss_kb': usage.ru_maxrss,
+            'log': output.decode('utf-8', 'replace')}
+
+
+def request_call(host, port, request, timeout=None):
+    '''
+    sends a call to the node and waits for the reply. raises NodeUnavailable if the
+    node cannot be reached or refuses the call and IOError if the connection is lost during the call
+    '''
+    try:
+        connection = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout), e:
+        raise NodeUnavailable("node %s:%s is not reachable: %s" % (host, port, e))
+    try:
+        # the call may run for hours
+        connection.settimeout(None)
+        stream = connection.makefile('rw')
+        stream.write(json.dumps(request) + '\n')
+        stream.flush()
+        line = stream.readline()
+        stream.close()
+    finally:
+        connection.close()
+    if not line:
+        raise IOError("node %s:%s closed the connection during the call" % (host, port))
+    reply = json.loads(line)
+    if 'error' in reply:
+        raise NodeUnavailable("node %s:%s refused the call: %s" % (host, port, reply['error']))
+    return reply
+
+
+def main():
+    option_parser = OptionParser("usage: %prog [-b ADDRESS] [-p PORT] [-o OSMOSIS_PATH] [-t TOKEN]")
+    option_parser.add_option("-b", "--bind", dest="address", action='store', default='localhost',
+                             help="address to listen on, everyone who can connect to it and knows the token can "
+                                  "run osmosis as this user, so only use addresses of trusted networks [default=localhost]")
+    option_parser.add_option("-p", "--port", dest="port", action='store', type='int', default=DEFAULT_PORT,
+                             help="port to listen on [default=%d]" % DEFAULT_PORT)
+    option_parser.add_option("-o", "--osmosis-path", dest="osmosis_path", action='store', default='osmosis',
+                             help="the osmosis executable of this node [default=osmosis]")
+    option_parser.add_option("-t", "--token", dest="token", action='store', default=os.environ.get(TOKEN_VARIABLE),
+                             help="the token mapcreator has to send with every call, shown in the process list, "
+                                  "prefer the %s environment variable [default=$%s]" % (TOKEN_VARIABLE, TOKEN_VARIABLE))
+    (options, args) = option_parser.parse_args()
+    if args:
+        option_parser.print_help()
+        sys.exit("incorrect number of arguments")
+    if not options.token:
+        sys.exit("a token is required, set it with -t or the %s environment variable" % TOKEN_VARIABLE)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    server = NodeServer((options.address, options.port), options.osmosis_path, options.token)
+    logging.getLogger("mapcreator").info("build node listening on %s:%d", options.address, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
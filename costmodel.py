@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Rough estimates of the resources needed by the osmosis calls of a part.
+
+All memory values are in MB. The estimates are derived from the size of the
+pbf a task reads, scaled by the share of the source polygon the part covers.
+Durations and staging disk are estimated the same way to plan a run, the
+durations are calibrated with the timings recorded by earlier runs.
+'''
+
+import json
+import logging
+import os
+import os.path as PATH
+
+MB = 1024 * 1024
+
+# map writer heap needed per MB of input pbf for the two storage types
+RAM_HEAP_PER_MB = 10
+HD_HEAP_PER_MB = 1.5
+# heap needed by osmosis regardless of the input size
+BASE_HEAP = 512
+# heap of the streaming tasks (pbf extracts, poi writer)
+STREAMING_HEAP = 1024
+
+WORLD_AREA = 360.0 * 180.0
+
+
+def physical_memory():
+    """total physical memory of this machine in MB, None if unknown"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / MB
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def pbf_size(pbf_path):
+    """size of a pbf file in MB, 0 if it does not exist (yet)"""
+    if not PATH.exists(pbf_path):
+        return 0.0
+    return float(PATH.getsize(pbf_path)) / MB
+
+
+def part_input_size(source_size, source_area, part_area):
+    """
+    estimated size in MB of the data within a part, assuming the data is
+    distributed evenly over the source polygon
+    """
+    if not source_area or part_area is None:
+        return source_size
+    return source_size * min(1.0, part_area / source_area)
+
+
+def map_writer_heap(input_size, storage_type):
+    """heap the map writer needs for an input of the given size"""
+    if storage_type == 'hd':
+        return int(BASE_HEAP + HD_HEAP_PER_MB * input_size)
+    return int(BASE_HEAP + RAM_HEAP_PER_MB * input_size)
+
+
+def choose_map_writer(input_size, max_heap, storage_type=None):
+    """
+    returns the storage type and heap for a map writer call, the storage type
+    is only chosen if it is not given: ram if the estimate fits into max_heap,
+    hd otherwise. The heap never exceeds max_heap.
+    """
+    if storage_type is None:
+        if not max_heap or map_writer_heap(input_size, 'ram') <= max_heap:
+            storage_type = 'ram'
+        else:
+            storage_type = 'hd'
+    heap = map_writer_heap(input_size, storage_type)
+    if max_heap:
+        heap = min(heap, max_heap)
+    return storage_type, heap
+
+
+# durations of the tasks, rough values used for parts without timings of earlier runs.
+# seconds to read 1 MB of source pbf and to filter it with 1000 bounding polygon vertices
+EXTRACT_SECONDS_PER_MB = 0.05
+POLYGON_SECONDS_PER_MB = 0.002
+# seconds the map writer needs per MB of input
+MAP_SECONDS_PER_MB = {'ram': 1.0, 'hd': 3.0}
+# seconds needed by osmosis regardless of the input size
+BASE_SECONDS = 10
+# seconds to write the sea and to clip and convert the land per square degree
+LAND_SECONDS_PER_SQUARE_DEGREE = 0.05
+
+# size in MB of the files in the staging paths: a map file per MB of input pbf and the
+# land per square degree as osm xml and as pbf, streamed land is not written to disk
+MAP_MB_PER_MB = 0.6
+LAND_MB_PER_SQUARE_DEGREE = {'osm': 0.5, 'pbf': 0.05, 'stream': 0.0}
+
+# memory in MB of the land polygons per square degree once they are loaded by the python process
+LAND_MEMORY_MB_PER_SQUARE_DEGREE = 0.05
+# memory in bytes the spatial index over the land polygons takes per polygon and per vertex
+LAND_INDEX_BYTES_PER_POLYGON = 1024
+LAND_INDEX_BYTES_PER_VERTEX = 48
+
+# stages of the run report that make up the tasks, used to look up timings of earlier runs
+EXTRACT_STAGES = ('pbf extract',)
+LAND_STAGES = ('sea file', 'land clip', 'shape2osm')
+MAP_STAGES = ('map write', 'move')
+
+
+class Estimate:
+    '''
+    estimated duration in seconds, memory in MB and staging disk in MB written by a task.
+    Timings of the stages of the part recorded by earlier runs replace the estimated duration.
+    '''
+    def __init__(self, seconds=0.0, memory=0, disk=0.0, part=None, stages=()):
+        self.seconds = seconds
+        self.memory = memory
+        self.disk = disk
+        self.part = part
+        self.stages = stages
+
+
+def extract_heap(parts):
+    """heap of a pbf extract of the given number of parts, each of them has its own filter and writer"""
+    return STREAMING_HEAP * max(1, parts)
+
+
+def extract_estimate(part, source_size, part_sizes, vertices):
+    """estimate of a pbf extract of parts with the given sizes and total polygon vertices from a source"""
+    seconds = BASE_SECONDS + source_size * (EXTRACT_SECONDS_PER_MB + POLYGON_SECONDS_PER_MB * vertices / 1000.0)
+    return Estimate(seconds, extract_heap(len(part_sizes)), disk=sum(part_sizes), part=part, stages=EXTRACT_STAGES)
+
+
+def land_memory(area):
+    """memory the land polygons of the given area take in the python process"""
+    return int(LAND_MEMORY_MB_PER_SQUARE_DEGREE * (area or 0.0))
+
+
+def land_index_memory(polygons, vertices):
+    """memory in MB of the spatial index over land polygons with the given number of polygons and vertices"""
+    return int((LAND_INDEX_BYTES_PER_POLYGON * polygons + LAND_INDEX_BYTES_PER_VERTEX * vertices) / (1024 * 1024))
+
+
+def extract_saving(source_size, part_size, readers, part_vertices, reader_vertices):
+    """
+    estimated seconds saved by extracting a part from its source before the calls reading
+    it: readers calls of the part and its sub parts that read the source pbf and filter it
+    with bounding polygons of reader_vertices vertices in total. Negative if it takes longer.
+    """
+    direct = source_size * (readers * EXTRACT_SECONDS_PER_MB + POLYGON_SECONDS_PER_MB * reader_vertices / 1000.0)
+    extracted = (BASE_SECONDS + source_size * (EXTRACT_SECONDS_PER_MB + POLYGON_SECONDS_PER_MB * part_vertices / 1000.0) +
+                 part_size * (readers * EXTRACT_SECONDS_PER_MB + POLYGON_SECONDS_PER_MB * reader_vertices / 1000.0))
+    return direct - extracted
+
+
+def land_estimate(part, area, land_format):
+    """estimate of writing the sea and land of a part with the given area"""
+    area = area or 0.0
+    return Estimate(LAND_SECONDS_PER_SQUARE_DEGREE * area, disk=LAND_MB_PER_SQUARE_DEGREE[land_format] * area,
+                    part=part, stages=LAND_STAGES)
+
+
+def map_estimate(part, input_size, storage_type, heap, vertices=0):
+    """estimate of a map writer call, the vertices are those of the bounding polygon if the input is filtered"""
+    seconds = (BASE_SECONDS + input_size * MAP_SECONDS_PER_MB[storage_type] +
+               input_size * POLYGON_SECONDS_PER_MB * vertices / 1000.0)
+    return Estimate(seconds, heap, disk=MAP_MB_PER_MB * input_size, part=part, stages=MAP_STAGES)
+
+
+class Timings:
+    '''
+    wall times of the stages of all parts recorded by earlier runs
+    '''
+    def __init__(self, timings_file=None):
+        self.timings = {}
+        if timings_file and PATH.exists(timings_file):
+            try:
+                with open(timings_file) as f:
+                    self.timings = json.load(f)
+            except (IOError, ValueError), e:
+                logging.getLogger("mapcreator").warning("ignoring invalid timings %s: %s", timings_file, e)
+
+    def wall(self, part, stages):
+        """the recorded wall time of the stages of a part, None if none of them was recorded"""
+        recorded = self.timings.get(part, {})
+        walls = [recorded[stage]['wall'] for stage in stages if stage in recorded]
+        if not walls:
+            return None
+        return sum(walls)
+
+    def calibrate(self, estimates):
+        '''
+        replaces the estimated durations by the recorded ones. The estimates of tasks without
+        recorded timings are scaled by the ratio of recorded to estimated durations of the
+        tasks of the same stages that have timings
+        '''
+        recorded = {}
+        ratios = {}
+        for estimate in estimates:
+            wall = self.wall(estimate.part, estimate.stages)
+            if wall is not None and estimate.stages:
+                recorded[estimate] = wall
+                ratio = ratios.setdefault(estimate.stages, [0.0, 0.0])
+                ratio[0] += wall
+                ratio[1] += estimate.seconds
+        for estimate in estimates:
+            if estimate in recorded:
+                estimate.seconds = recorded[estimate]
+            elif estimate.stages in ratios and ratios[estimate.stages][1] > 0:
+                estimate.seconds *= ratios[estimate.stages][0] / ratios[estimate.stages][1]
+
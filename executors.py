@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Executors running the osmosis calls of the tasks of a run.
+
+The LocalExecutor runs them on this machine, on the osmosis workers of a
+pool if there is one. The NodeExecutor distributes them over build nodes:
+this machine ('local'), nodes running buildnode.py ('host:port') and nodes
+reachable by ssh ('ssh:host', osmosis must be installed at the same path).
+Calls to nodes running buildnode.py carry the token of the nodes.
+Every node runs at most its number of slots calls at the same time.
+
+Placement is locality aware: a call goes to the node that created one of
+its inputs, e.g. the pbf of the parent part, if that node has a free slot,
+otherwise to the least busy node. Staging paths are shared, all nodes must
+see the files at the same paths. Nodes that cannot be reached are not used
+anymore, if none is left the calls run on this machine.
+'''
+
+import logging
+import os
+import pipes
+import subprocess
+import threading
+
+import buildnode
+import instrumentation
+import osmosisworker
+
+
+class LocalExecutor:
+
+    def __init__(self, workers=None):
+        self.workers = workers
+
+    def check_call(self, call, logfile, heap=0, env=None, inputs=(), outputs=(), local=False):
+        '''
+        runs an osmosis call writing its output to the log file, raises CalledProcessError if it fails.
+        inputs and outputs are the files the call reads and writes, local calls must run on this machine
+        '''
+        return osmosisworker.check_call(self.workers, call, logfile, heap, env)
+
+    def close(self):
+        if self.workers:
+            self.workers.close()
+
+
+class Node:
+    '''
+    a machine running osmosis calls
+    '''
+    def __init__(self, name, slots=1):
+        self.name = name
+        self.slots = slots
+        self.running = 0
+        self.down = False
+
+    def load(self):
+        return float(self.running) / self.slots
+
+
+class LocalNode(Node):
+
+    def __init__(self, slots=1):
+        Node.__init__(self, 'local', slots)
+        # set by the NodeExecutor
+        self.executor = None
+
+    def check_call(self, call, logfile, heap, env, inputs, outputs):
+        self.executor.check_call(call, logfile, heap, env)
+
+
+class TcpNode(Node):
+    '''
+    a node running buildnode.py
+    '''
+    def __init__(self, host, port, slots=1, token=None):
+        Node.__init__(self, '%s:%d' % (host, port), slots)
+        self.host = host
+        self.port = port
+        self.token = token
+
+    def check_call(self, call, logfile, heap, env, inputs, outputs):
+        request = {'token': self.token, 'args': call[1:], 'cwd': os.getcwd(), 'inputs': list(inputs), 'outputs': list(outputs),
+                   'java_options': (env or {}).get('JAVACMD_OPTIONS')}
+        try:
+            reply = buildnode.request_call(self.host, self.port, request, timeout=30)
+        except (IOError, ValueError), e:
+            logfile.write("%s\n" % e)
+            raise subprocess.CalledProcessError(-1, call)
+        logfile.write(reply['log'].encode('utf-8'))
+        logfile.flush()
+        instrumentation.add_child_usage(reply['cpu'], reply['max_rss_kb'])
+        if reply['status']:
+            raise subprocess.CalledProcessError(reply['status'], call)
+
+
+class SshNode(Node):
+    '''
+    a node osmosis is run on by ssh
+    '''
+    def __init__(self, host, slots=1):
+        Node.__init__(self, 'ssh:' + host, slots)
+        self.host = host
+
+    def check_call(self, call, logfile, heap, env, inputs, outputs):
+        command = ['cd', pipes.quote(os.getcwd()), '&&', 'env']
+        if env and env.get('JAVACMD_OPTIONS'):
+            command.append(pipes.quote('JAVACMD_OPTIONS=' + env['JAVACMD_OPTIONS']))
+        command += [pipes.quote(arg) for arg in call]
+        try:
+            instrumentation.check_call(['ssh', '-o', 'BatchMode=yes', self.host, ' '.join(command)], stderr=logfile)
+        except subprocess.CalledProcessError, e:
+            # ssh exits with 255 if it could not connect
+            if e.returncode == 255:
+                raise buildnode.NodeUnavailable("node %s is not reachable, see %s" % (self.name, logfile.name))
+            raise
+
+
+class NodeExecutor:
+
+    def __init__(self, nodes, workers=None):
+        self.logger = logging.getLogger("mapcreator")
+        self.nodes = nodes
+        # runs the calls that cannot run on a node
+        self.local = LocalExecutor(workers)
+        for node in nodes:
+            if isinstance(node, LocalNode):
+                node.executor = self.local
+        # the node that created a file
+        self.locations = {}
+        self.condition = threading.Condition()
+
+    def check_call(self, call, logfile, heap=0, env=None, inputs=(), outputs=(), local=False):
+        while True:
+            node = self.acquire(inputs, local)
+            if node is None:
+                return self.local.check_call(call, logfile, heap, env)
+            self.logger.debug("running call on node %s", node.name)
+            try:
+                node.check_call(call, logfile, heap, env, inputs, outputs)
+            except buildnode.NodeUnavailable, e:
+                self.logger.warning("%s, not using it anymore", e)
+                with self.condition:
+                    node.down = True
+                continue
+            finally:
+                self.release(node)
+            with self.condition:
+                for output in outputs:
+                    self.locations[output] = node
+            return 0
+
+    def acquire(self, inputs, local):
+        '''
+        waits for a free slot on a node and returns the node, None if the call runs on this machine outside of the nodes
+        '''
+        with self.condition:
+            while True:
+                nodes = [n for n in self.nodes if not n.down]
+                if local:
+                    nodes = [n for n in nodes if isinstance(n, LocalNode)]
+                if not nodes:
+                    return None
+                free = [n for n in nodes if n.running < n.slots]
+                if free:
+                    preferred = [self.locations[i] for i in inputs if self.locations.get(i) in free]
+                    node = (preferred or sorted(free, key=lambda n: n.load()))[0]
+                    node.running += 1
+                    return node
+                self.condition.wait()
+
+    def release(self, node):
+        with self.condition:
+            node.running -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        self.local.close()
+
+
+def parse_nodes(specification, token=None):
+    '''
+    nodes from a space separated list of 'local', 'host:port' and 'ssh:host', each optionally followed by '*slots'.
+    The token is sent to the 'host:port' nodes
+    '''
+    nodes = []
+    for entry in specification.split():
+        (name, _, slots) = entry.partition('*')
+        slots = int(slots or 1)
+        if name == 'local':
+            nodes.append(LocalNode(slots))
+        elif name.startswith('ssh:'):
+            nodes.append(SshNode(name[len('ssh:'):], slots))
+        else:
+            (host, _, port) = name.rpartition(':')
+            if not host:
+                (host, port) = (name, buildnode.DEFAULT_PORT)
+            nodes.append(TcpNode(host, int(port), slots, token))
+    return nodes
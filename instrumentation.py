@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Timing and resource usage of the stages of a run.
+
+Every stage of a part (parsing its polygon, writing the sea, clipping the
+land, converting it with shape2osm, extracting pbfs, writing the map or poi
+file, moving it to the target) is recorded with its wall time, the CPU time
+of the thread running it, the CPU time and peak memory of the osmosis
+processes it started, and the bytes of its input and output files. The peak
+memory of the script itself is only known for the whole process, so it is
+recorded once for the run.
+
+The records of a run are collected in a module level report, like the
+logger, so the stages do not need a reference to it. The report is written
+as JSON with totals per part and per stage and the critical path through the
+part tree, and as CSV with one line per stage.
+'''
+
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# python 2 does not define it, the value is the one of linux
+if hasattr(resource, 'RUSAGE_THREAD'):
+    RUSAGE_THREAD = resource.RUSAGE_THREAD
+elif sys.platform.startswith('linux'):
+    RUSAGE_THREAD = 1
+else:
+    RUSAGE_THREAD = resource.RUSAGE_SELF
+
+# the stage creating the pbfs of the sub parts of a part
+PBF_STAGE = 'pbf extract'
+
+FIELDS = ['part', 'stage', 'status', 'start', 'wall', 'cpu', 'child_cpu', 'child_max_rss_kb', 'bytes_in', 'bytes_out']
+
+
+class RunReport:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.records = []
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def part_totals(self):
+        '''
+        totals per part and stage
+        '''
+        totals = {}
+        for record in self.records:
+            stages = totals.setdefault(record['part'], {})
+            total = stages.setdefault(record['stage'], dict((f, 0) for f in FIELDS[4:]))
+            for f in FIELDS[4:]:
+                if 'max_rss' in f:
+                    total[f] = max(total[f], record[f])
+                else:
+                    total[f] += record[f]
+            total['count'] = total.get('count', 0) + 1
+        return totals
+
+    def stage_totals(self):
+        totals = {}
+        for (part, stages) in self.part_totals().items():
+            for (stage, total) in stages.items():
+                stage_total = totals.setdefault(stage, dict((f, 0) for f in FIELDS[4:] + ['count']))
+                for (f, value) in total.items():
+                    if 'max_rss' in f:
+                        stage_total[f] = max(stage_total[f], value)
+                    else:
+                        stage_total[f] += value
+        return totals
+
+    def critical_path(self):
+        '''
+        the chain of parts with the longest wall time. A part can only start once the pbf
+        extracts of all its enclosing parts are done, so the length of the path to a part is
+        the wall time of the pbf extracts of its ancestors plus the wall time of its own stages
+        '''
+        own = {}
+        extracts = {}
+        for record in self.records:
+            if record['stage'] == PBF_STAGE:
+                extracts[record['part']] = extracts.get(record['part'], 0) + record['wall']
+            else:
+                own[record['part']] = own.get(record['part'], 0) + record['wall']
+        longest = (0, [])
+        for part in set(own.keys()) | set(extracts.keys()):
+            ancestors = ancestor_parts(part)
+            length = sum(extracts.get(a, 0) for a in ancestors) + own.get(part, 0)
+            if length > longest[0]:
+                longest = (length, [a for a in ancestors if a] + [part])
+        return {'wall': longest[0], 'parts': longest[1]}
+
+    def write_json(self, path):
+        with self.lock:
+            report = {'started': self.started, 'finished': time.time(),
+                      'wall': time.time() - self.started,
+                      'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      'stages': self.records,
+                      'parts': self.part_totals(),
+                      'stage_totals': self.stage_totals(),
+                      'critical_path': self.critical_path()}
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    def write_timings(self, path):
+        '''
+        merges the wall times of the stages of all parts that did not fail into the timings
+        of earlier runs, which are used to estimate the durations of the next run
+        '''
+        timings = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    timings = json.load(f)
+            except ValueError:
+                timings = {}
+        with self.lock:
+            records = [record for record in self.records if record['status'] == 'done']
+        for record in records:
+            timings.setdefault(record['part'], {})[record['stage']] = {'wall': 0.0, 'bytes_in': 0}
+        for record in records:
+            timing = timings[record['part']][record['stage']]
+            timing['wall'] += record['wall']
+            timing['bytes_in'] += record['bytes_in']
+        with open(path, 'w') as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+
+    def write_csv(self, path):
+        with self.lock:
+            records = list(self.records)
+        with open(path, 'wb') as f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writerow(dict((f, f) for f in FIELDS))
+            writer.writerows(records)
+
+
+def ancestor_parts(part):
+    '''
+    the enclosing parts of a part, starting with the root ''
+    '''
+    names = part.split('/')
+    return ['/'.join(names[:i]) for i in range(len(names))]
+
+
+# the report of the current run and the stages the threads are in
+REPORT = RunReport()
+current = threading.local()
+
+
+def report():
+    return REPORT
+
+
+def reset():
+    global REPORT
+    REPORT = RunReport()
+    return REPORT
+
+
+@contextmanager
+def stage(part, name, inputs=(), outputs=()):
+    '''
+    records the stage of a part run in the with block, inputs and outputs are file paths
+    '''
+    record = {'part': part, 'stage': name, 'status': 'done', 'start': time.time(),
+              'child_cpu': 0.0, 'child_max_rss_kb': 0}
+    usage = resource.getrusage(RUSAGE_THREAD)
+    stages = current.__dict__.setdefault('stages', [])
+    stages.append(record)
+    try:
+        yield record
+    except:
+        record['status'] = 'failed'
+        raise
+    finally:
+        stages.pop()
+        end_usage = resource.getrusage(RUSAGE_THREAD)
+        record['wall'] = time.time() - record['start']
+        record['cpu'] = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+        record['bytes_in'] = file_bytes(inputs)
+        record['bytes_out'] = file_bytes(outputs)
+        REPORT.add(record)
+
+
+def file_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def check_call(call, **kwargs):
+    '''
+    subprocess.check_call that adds the CPU time and peak memory of the process to the current stage
+    '''
+    process = subprocess.Popen(call, **kwargs)
+    (pid, status, usage) = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    add_child_usage(usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, call)
+    return 0
+
+
+def add_child_usage(cpu, max_rss_kb):
+    '''
+    adds the CPU time and peak memory of a process run for the current stage, e.g. on another machine
+    '''
+    stages = current.__dict__.get('stages')
+    if stages:
+        stages[-1]['child_cpu'] += cpu
+        stages[-1]['child_max_rss_kb'] = max(stages[-1]['child_max_rss_kb'], max_rss_kb)
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Persistent journal of the tasks of a run, used to resume an interrupted run.
+
+The state of every task is written to an SQLite database as soon as it
+changes. For finished tasks the journal also keeps the size and a checksum
+of every output file. When a run is resumed, tasks the journal reports as
+done are not run again if their outputs are still complete and unchanged.
+Tasks that were running when the run stopped, or failed, are run again.
+
+The checksum covers the size and the first and last MB of a file, so large
+pbfs do not have to be read completely. Pbf and map files are additionally
+checked for truncation.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+import osmpbf
+
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+MAP_MAGIC = 'mapsforge binary OSM'
+
+
+class TaskJournal:
+
+    def __init__(self, path, resume=False):
+        self.logger = logging.getLogger("mapcreator")
+        self.path = path
+        self.lock = threading.Lock()
+        # tasks report their states from their worker threads
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS tasks (name TEXT PRIMARY KEY, state TEXT NOT NULL,
+                                   outputs TEXT, started REAL, finished REAL, error TEXT)''')
+        if not resume:
+            self.connection.execute('DELETE FROM tasks')
+        self.connection.commit()
+        self.previous = dict((name, (state, json.loads(outputs or '[]')))
+                             for (name, state, outputs) in self.connection.execute('SELECT name, state, outputs FROM tasks'))
+
+    def was_done(self, name):
+        '''
+        returns true if the task finished successfully in the resumed run and its outputs are still valid
+        '''
+        if name not in self.previous or self.previous[name][0] != 'done':
+            return False
+        for (path, size, checksum) in self.previous[name][1]:
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                return False
+            if output_checksum(path) != checksum or not is_complete(path):
+                self.logger.info("output %s of task '%s' changed or is incomplete, running it again", path, name)
+                return False
+        return True
+
+    def was_finished(self, name):
+        return name in self.previous and self.previous[name][0] == 'done'
+
+    def set_state(self, name, state, outputs=None, error=None):
+        '''
+        records the state of a task, for done tasks the size and checksum of its outputs
+        '''
+        recorded = None
+        if outputs is not None:
+            recorded = json.dumps([[path, os.path.getsize(path), output_checksum(path)]
+                                   for path in outputs if os.path.exists(path)])
+        with self.lock:
+            now = time.time()
+            if state == 'running':
+                self.connection.execute('INSERT OR REPLACE INTO tasks (name, state, started) VALUES (?, ?, ?)',
+                                        (name, state, now))
+            elif state == 'pending':
+                self.connection.execute('INSERT OR REPLACE INTO tasks (name, state) VALUES (?, ?)', (name, state))
+            else:
+                self.connection.execute('UPDATE tasks SET state = ?, outputs = ?, finished = ?, error = ? WHERE name = ?',
+                                        (state, recorded, now, error, name))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def output_checksum(path):
+    sha1 = hashlib.sha1()
+    size = os.path.getsize(path)
+    sha1.update(str(size))
+    with open(path, 'rb') as f:
+        sha1.update(f.read(CHECKSUM_BLOCK_SIZE))
+        if size > CHECKSUM_BLOCK_SIZE:
+            f.seek(max(CHECKSUM_BLOCK_SIZE, size - CHECKSUM_BLOCK_SIZE))
+            sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def is_complete(path):
+    '''
+    returns false for pbf and map files that were not completely written
+    '''
+    if path.endswith('.pbf'):
+        return osmpbf.is_complete(path)
+    if path.endswith('.map'):
+        # the map file header contains the size of the file
+        with open(path, 'rb') as f:
+            header = f.read(36)
+        return (len(header) == 36 and header[:20] == MAP_MAGIC and
+                struct.unpack('!q', header[28:36])[0] == os.path.getsize(path))
+    return True
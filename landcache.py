@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Local copy of the land polygon archive, refreshed with conditional requests.
+
+The archive is only downloaded again if the server reports a change by its
+ETag or Last-Modified header, servers without these headers are detected by
+the checksum of the archive. The archive is only extracted again if its
+content changed. The headers and checksums are kept in a json file next to
+the archive. In offline mode the extracted copy is used without contacting
+the server.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import urllib2
+import zipfile
+
+DEFAULT_URL = "http://data.openstreetmapdata.com/land-polygons-split-4326.zip"
+# seconds to wait for the server before using the local copy
+TIMEOUT = 60
+BLOCK_SIZE = 1024 * 1024
+
+
+class LandPolygonCache:
+
+    def __init__(self, data_dir, name, url=None):
+        self.logger = logging.getLogger("mapcreator")
+        self.url = url or DEFAULT_URL
+        self.name = name
+        self.archive = os.path.join(data_dir, name + ".zip")
+        self.directory = os.path.join(data_dir, name)
+        self.info_file = os.path.join(data_dir, name + ".json")
+        self.info = {}
+        if os.path.exists(self.info_file):
+            try:
+                with open(self.info_file) as f:
+                    self.info = json.load(f)
+            except (IOError, ValueError), e:
+                self.logger.warning("ignoring invalid land polygon info %s: %s", self.info_file, e)
+
+    def update(self, offline=False):
+        '''
+        makes sure the extracted land polygons are current, returns true if they were extracted again.
+        If the server cannot be reached the local copy is used, an error is only raised if there is none.
+        '''
+        if offline:
+            if not os.path.isdir(self.directory):
+                raise IOError("there is no local copy of the land polygons in %s to use offline" % self.directory)
+            self.logger.info("using the local copy of the land polygons in %s", self.directory)
+            return False
+        try:
+            self.download()
+        except (urllib2.URLError, IOError), e:
+            if not os.path.isdir(self.directory):
+                raise
+            self.logger.warning("could not refresh the land polygons from %s, using the local copy: %s", self.url, e)
+            return False
+        if os.path.isdir(self.directory) and self.info.get('extracted') == self.info.get('sha1'):
+            self.logger.info("land polygons in %s are up to date", self.directory)
+            return False
+        self.extract()
+        return True
+
+    def download(self):
+        '''
+        downloads the archive unless the server reports it unchanged since the last download
+        '''
+        request = urllib2.Request(self.url)
+        if os.path.exists(self.archive) and self.info.get('url') == self.url:
+            if self.info.get('etag'):
+                request.add_header('If-None-Match', self.info['etag'])
+            if self.info.get('last_modified'):
+                request.add_header('If-Modified-Since', self.info['last_modified'])
+        try:
+            response = urllib2.urlopen(request, timeout=TIMEOUT)
+        except urllib2.HTTPError, e:
+            if e.code != 304:
+                raise
+            self.logger.info("land polygons at %s are unchanged", self.url)
+            return
+        self.logger.info("downloading land polygons from %s", self.url)
+        part_file = self.archive + ".part"
+        digest = hashlib.sha1()
+        try:
+            with open(part_file, 'wb') as f:
+                block = response.read(BLOCK_SIZE)
+                while block:
+                    digest.update(block)
+                    f.write(block)
+                    block = response.read(BLOCK_SIZE)
+        except:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            raise
+        finally:
+            response.close()
+        os.rename(part_file, self.archive)
+        headers = response.info()
+        self.info.update({'url': self.url, 'etag': headers.getheader('ETag'),
+                          'last_modified': headers.getheader('Last-Modified'), 'sha1': digest.hexdigest()})
+        self.save()
+
+    def extract(self):
+        '''
+        replaces the extracted land polygons by the content of the archive
+        '''
+        self.logger.info("extracting land polygons from %s", self.archive)
+        tmp_dir = self.directory + ".tmp"
+        shutil.rmtree(tmp_dir, True)
+        zipfile.ZipFile(self.archive).extractall(tmp_dir)
+        extracted = os.path.join(tmp_dir, self.name)
+        if not os.path.isdir(extracted):
+            # the archive has no top level directory
+            extracted = tmp_dir
+        shutil.rmtree(self.directory, True)
+        os.rename(extracted, self.directory)
+        shutil.rmtree(tmp_dir, True)
+        self.info['extracted'] = self.info.get('sha1')
+        self.save()
+
+    def save(self):
+        tmp_file = self.info_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.info, f)
+        os.rename(tmp_file, self.info_file)
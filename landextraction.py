@@ -1,18 +1,51 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from shapely.geometry import MultiPolygon, Polygon
+from shapely.geometry import MultiPolygon, Polygon, box
+from shapely.strtree import STRtree
+from shapely.prepared import prep
+from shapely import wkb
+import multiprocessing
 import os
+import re
+import shutil
+import threading
 import logging.config
 from logging.handlers import RotatingFileHandler
 from logging.handlers import SMTPHandler
+import instrumentation
+import landcache
+import osmpbf
+import polygoncache
 import shape2osm
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from osgeo import ogr
+except ImportError:
+    import ogr
+
+# a line terminating a ring or the whole polygon in a polygon file
+POLY_END = re.compile(r'^[ \t]*END[ \t]*\r?$', re.MULTILINE)
+
+# buffer around the region polygon (same as for the bounding box) and the tolerance the buffered
+# polygon is simplified with when clipping to the polygon. As the tolerance is smaller than the buffer,
+# the simplified clip geometry still contains the region polygon.
+CLIP_BUFFER = 0.1
+CLIP_SIMPLIFICATION = 0.01
+
+# the polygons pbfs are extracted with are buffered by the configured extract buffer and simplified
+# with this share of it, so they still contain the region polygon but have far fewer vertices
+EXTRACT_SIMPLIFICATION = 0.5
 
 
 class LandExtractor:
 
-    def __init__(self, output_dir, polygon_dir, dry_run = False):
+    def __init__(self, output_dir, polygon_dir, dry_run = False, clip_to_polygon = False, land_format = 'osm', extract_buffer = 0):
         self.logger = logging.getLogger("mapcreator")
         self.polygon_dir = polygon_dir
         self.output_dir = output_dir
@@ -20,18 +53,79 @@ class LandExtractor:
             os.makedirs(self.output_dir)
         self.polygon_ext = ".poly"
         self.dry_run = dry_run
+        # clip land and sea to the buffered region polygon instead of its bounding box
+        self.clip_to_polygon = clip_to_polygon
+        # land and sea are written as osm xml or as sorted osm pbf, or streamed as osm pbf into the map writer
+        self.land_format = land_format
+        # buffer in degrees of the simplified polygons pbfs are extracted with, 0 to extract with the region polygons
+        self.extract_buffer = extract_buffer
         # self.landfiles = "land-polygons-complete-4326"  # there seems to be a bug in that data
         self.landfiles = "land-polygons-split-4326"
+        # parsed polygons are kept in memory, bounding boxes and areas also on disk
+        self.polygons = {}
+        self.clip_geometries = {}
+        self.polygons_lock = threading.Lock()
+        self.polygon_cache = polygoncache.PolygonCache(os.path.join(self.output_dir, "polygon-cache.json"))
+        # the land polygons are loaded into a spatial index on first use, the listener is called with the index
+        # once it is loaded, so the memory it holds for the rest of the run can be accounted for
+        self.land_index = None
+        self.land_index_lock = threading.Lock()
+        self.land_index_listener = None
+        # clipped land polygons of regions whose sub regions are still to be processed
+        self.clipped_land = {}
+        self.clipped_land_lock = threading.Lock()
+        # simplified land of regions whose map writer has not streamed it yet, it is clipped by the
+        # map task itself, so only the land of the running map writers is held here
+        self.streamed_land = {}
 
     def parse_poly(self, lines):
         """ Parse an Osmosis polygon filter file.
         
-        Accept a sequence of lines from a polygon file, return a shapely.geometry.MultiPolygon object.
+        Accept the content of a polygon file, either as a string or a sequence of lines,
+        return a shapely.geometry.MultiPolygon object.
         
         http://wiki.openstreetmap.org/wiki/Osmosis/Polygon_Filter_File_Format
         Source taken from 
         http://wiki.openstreetmap.org/wiki/Osmosis/Polygon_Filter_File_Python_Parsing
         """
+        return MultiPolygon(self.parse_poly_rings(lines))
+
+    def parse_poly_rings(self, lines):
+        """
+        Parse an Osmosis polygon filter file into its rings.
+
+        Returns a list with an (outer ring, list of holes) tuple per polygon part. With numpy
+        available every ring is a float64 array with one lon/lat row per vertex, otherwise a list
+        of coordinate lists.
+        """
+        if numpy is None:
+            if isinstance(lines, basestring):
+                lines = lines.splitlines()
+            return self.parse_poly_rings_python(lines)
+        if not isinstance(lines, basestring):
+            lines = '\n'.join(line.rstrip('\r\n') for line in lines)
+        return self.parse_poly_rings_numpy(lines)
+
+    def parse_poly_rings_numpy(self, text):
+        # every END line terminates a ring, the END of the whole polygon leaves an empty section
+        sections = POLY_END.split(text)
+        # first line is junk, the second line starts the first polygon ring
+        sections[0] = sections[0].partition('\n')[2]
+        coords = []
+        for (index, section) in enumerate(sections):
+            (name, _, ring) = section.lstrip().partition('\n')
+            if not name:
+                # we are at the end of the whole polygon.
+                break
+            ring = numpy.array(ring.split(), dtype=numpy.float64).reshape(-1, 2)
+            if index > 0 and name.startswith('!'):
+                # a polygon part hole.
+                coords[-1][1].append(ring)
+            else:
+                coords.append((ring, []))
+        return coords
+
+    def parse_poly_rings_python(self, lines):
         in_ring = False
         coords = []
         
@@ -42,7 +136,7 @@ class LandExtractor:
         
             elif index == 1:
                 # second line is the first polygon ring.
-                coords.append([[], []])
+                coords.append(([], []))
                 ring = coords[-1][0]
                 in_ring = True
         
@@ -66,17 +160,42 @@ class LandExtractor:
     
             elif not in_ring:
                 # we are at the start of a polygon part.
-                coords.append([[], []])
+                coords.append(([], []))
                 ring = coords[-1][0]
                 in_ring = True
     
-        return MultiPolygon(coords)
+        return coords
 
+    def read_polygon(self, polygon_file):
+        """
+        returns the parsed polygon, every polygon file is only parsed once as long as it is unchanged
+        """
+        stamp = polygoncache.file_stamp(polygon_file)
+        with self.polygons_lock:
+            cached = self.polygons.get(polygon_file)
+            if cached and cached[0] == stamp:
+                return cached[1]
+        with instrumentation.stage(self.polygon_region(polygon_file), 'poly parse', inputs=[polygon_file]):
+            with open(polygon_file) as f:
+                polygon = self.parse_poly(f.read())
+        with self.polygons_lock:
+            self.polygons[polygon_file] = (stamp, polygon)
+        return polygon
 
     def polygon_bbox(self, polygon_file, buffer=0.1):
-        with open(polygon_file) as f:
-            polygon = self.parse_poly(f.readlines())
-            return polygon.buffer(buffer).intersection(self.world_polygon()).bounds
+        def compute(polygon_file):
+            polygon = self.read_polygon(polygon_file)
+            with instrumentation.stage(self.polygon_region(polygon_file), 'bbox'):
+                return polygon.buffer(buffer).intersection(self.world_polygon()).bounds
+        return self.polygon_cache.get(polygon_file, "bbox:%s" % buffer, compute)
+
+    def polygon_region(self, polygon_file):
+        """
+        the region of a polygon file in the polygon directory
+        """
+        if polygon_file.startswith(self.polygon_dir) and polygon_file.endswith(self.polygon_ext):
+            return polygon_file[len(self.polygon_dir):-len(self.polygon_ext)]
+        return polygon_file
 
     def sea_polygon_file(self, bbox, output):
         template = """<osm version='0.6'>
@@ -103,39 +222,342 @@ class LandExtractor:
         with open(self.sea_path(output), "w+") as f:
             f.write(template.format(lonmin=bbox[0], latmin=bbox[1], lonmax=bbox[2], latmax=bbox[3]))
 
+    def sea_polygon_osm_file(self, geometry, output):
+        """
+        writes the sea covering the polygons of the geometry, polygons with holes become multipolygon relations
+        """
+        node = "<node timestamp='1969-12-31T23:59:59Z' changeset='-1' id='%s' version='1' lon='%s' lat='%s' />"
+        tags = ["<tag k='area' v='yes' />", "<tag k='layer' v='-5' />", "<tag k='natural' v='sea' />"]
+        node_id = 32951459320
+        way_id = 32951623372
+        nodes = []
+        ways = []
+        relations = []
+        for polygon in polygon_parts(geometry):
+            rings = [polygon.exterior] + list(polygon.interiors)
+            way_ids = []
+            for ring in rings:
+                refs = []
+                for (lon, lat) in list(ring.coords)[:-1]:
+                    nodes.append(node % (node_id, lon, lat))
+                    refs.append("<nd ref='%s' />" % node_id)
+                    node_id += 1
+                refs.append(refs[0])
+                way = ["<way timestamp='1969-12-31T23:59:59Z' changeset='-1' id='%s' version='1'>" % way_id] + refs
+                if len(rings) == 1:
+                    way += tags
+                ways.append("\n".join(way + ["</way>"]))
+                way_ids.append(way_id)
+                way_id += 1
+            if len(rings) > 1:
+                members = ['<member type="way" ref="%s" role="outer" />' % way_ids[0]]
+                members += ['<member type="way" ref="%s" role="inner" />' % i for i in way_ids[1:]]
+                relations.append("\n".join(["<relation timestamp='1969-12-31T23:59:59Z' changeset='-1' id='%s' version='1'>" % way_id,
+                                             "<tag k='type' v='multipolygon' />"] + tags + members + ["</relation>"]))
+                way_id += 1
+        with open(self.sea_path(output), "w+") as f:
+            f.write("\n".join(["<osm version='0.6'>"] + nodes + ways + relations + ["</osm>", ""]))
+
+    def sea_polygon_pbf_file(self, geometry, output):
+        """
+        writes the sea covering the polygons of the geometry as pbf, with the same ids and tags as the osm files
+        """
+        tags = [('area', 'yes'), ('layer', '-5'), ('natural', 'sea')]
+        node_id = 32951459320
+        way_id = 32951623372
+        writer = osmpbf.PbfWriter(self.sea_path(output))
+        for polygon in polygon_parts(geometry):
+            rings = [polygon.exterior] + list(polygon.interiors)
+            way_ids = []
+            for ring in rings:
+                refs = []
+                for (lon, lat) in list(ring.coords)[:-1]:
+                    writer.add_node(node_id, lon, lat)
+                    refs.append(node_id)
+                    node_id += 1
+                refs.append(refs[0])
+                if len(rings) == 1:
+                    writer.add_way(way_id, refs, tags)
+                else:
+                    writer.add_way(way_id, refs)
+                way_ids.append(way_id)
+                way_id += 1
+            if len(rings) > 1:
+                members = [('way', way_ids[0], 'outer')] + [('way', i, 'inner') for i in way_ids[1:]]
+                writer.add_relation(way_id, members, [('type', 'multipolygon')] + tags)
+                way_id += 1
+        writer.close()
+
     def world_polygon(self):
         return Polygon([(-180, 90), (180, 90), (180, -90), (-180, -90), (-180, 90)])
 
     def region_bbox(self, region):
         return self.polygon_bbox(self.polygon_dir + region + self.polygon_ext)
 
+    def region_clip_geometry(self, region):
+        """
+        the buffered and simplified region polygon land and sea are clipped to, computed once per region
+        """
+        polygon_file = self.polygon_dir + region + self.polygon_ext
+        stamp = polygoncache.file_stamp(polygon_file)
+        with self.polygons_lock:
+            cached = self.clip_geometries.get(polygon_file)
+            if cached and cached[0] == stamp:
+                return cached[1]
+        def compute(polygon_file):
+            polygon = self.read_polygon(polygon_file).buffer(CLIP_BUFFER).intersection(self.world_polygon())
+            return polygon.simplify(CLIP_SIMPLIFICATION, preserve_topology=True).wkb_hex
+        geometry = wkb.loads(self.polygon_cache.get(polygon_file, "clip:%s:%s" % (CLIP_BUFFER, CLIP_SIMPLIFICATION), compute), hex=True)
+        with self.polygons_lock:
+            self.clip_geometries[polygon_file] = (stamp, geometry)
+        return geometry
+
+    def region_area(self, region):
+        """
+        area of the region polygon in square degrees, None if there is no polygon for the region
+        """
+        polygon_file = self.polygon_dir + region + self.polygon_ext
+        if not os.path.exists(polygon_file):
+            return None
+        return self.polygon_cache.get(polygon_file, "area", lambda f: self.read_polygon(f).area)
+
+    def region_vertices(self, region):
+        """
+        number of vertices of the region polygon, None if there is no polygon for the region
+        """
+        polygon_file = self.polygon_dir + region + self.polygon_ext
+        if not os.path.exists(polygon_file):
+            return None
+        return self.polygon_cache.get(polygon_file, "vertices", lambda f: vertex_count(self.read_polygon(f)))
+
+    def region_extract_polygon(self, region):
+        """
+        the polygon file pbfs of the region are extracted with
+        """
+        return self.extract_polygon(region)[0]
+
+    def region_extract_vertices(self, region):
+        """
+        number of vertices of the polygon pbfs of the region are extracted with, None if there is no polygon
+        """
+        return self.extract_polygon(region)[1]
+
+    def extract_polygon(self, region):
+        """
+        returns the polygon file pbfs of the region are extracted with and its number of vertices: the region
+        polygon buffered by the extract buffer and simplified, written once to the output directory. the region
+        polygon itself if there is no extract buffer or if simplifying it does not reduce its vertices
+        """
+        polygon_file = self.polygon_dir + region + self.polygon_ext
+        if not self.extract_buffer or not os.path.exists(polygon_file):
+            return (polygon_file, self.region_vertices(region))
+        extract_file = os.path.join(self.output_dir, 'extract-polygons', str(self.extract_buffer), region + self.polygon_ext)
+        def compute(polygon_file):
+            polygon = self.read_polygon(polygon_file)
+            with instrumentation.stage(region, 'extract polygon', inputs=[polygon_file]):
+                simplified = polygon.buffer(self.extract_buffer, 4).simplify(self.extract_buffer * EXTRACT_SIMPLIFICATION,
+                                                                             preserve_topology=True)
+                if not simplified.contains(polygon) or vertex_count(simplified) >= vertex_count(polygon):
+                    return 0
+                write_poly(simplified, region, extract_file)
+            return vertex_count(simplified)
+        name = "extract:%s:%s" % (self.extract_buffer, EXTRACT_SIMPLIFICATION)
+        vertices = self.polygon_cache.get(polygon_file, name, compute)
+        if not vertices:
+            return (polygon_file, self.region_vertices(region))
+        if not os.path.exists(extract_file):
+            # the cached vertices are those of the polygon written before, not necessarily of the new one
+            vertices = compute(polygon_file)
+            self.polygon_cache.put(polygon_file, name, vertices)
+            if not vertices:
+                return (polygon_file, self.region_vertices(region))
+        return (extract_file, vertices)
+
+    def prepare_regions(self, regions, processes=None):
+        """
+        validates the polygons of the regions and caches their bounding boxes, areas, vertices and clip
+        geometries, so no polygon is parsed while the land is extracted. the regions are prepared in
+        parallel processes (one per core by default). returns an error message for every invalid region
+        """
+        errors = []
+        pending = []
+        for region in regions:
+            polygon_file = self.polygon_dir + region + self.polygon_ext
+            if os.path.exists(polygon_file):
+                pending.append(region)
+            else:
+                errors.append("%s: polygon %s is missing" % (region, polygon_file))
+        if not pending:
+            return errors
+        entries = {}
+        with instrumentation.stage('', 'prepare'):
+            pool = multiprocessing.Pool(processes, init_prepare_worker,
+                                        (self.output_dir, self.polygon_dir, self.clip_to_polygon, self.extract_buffer))
+            try:
+                for (region, entry, error) in pool.imap(prepare_region, pending):
+                    if error:
+                        errors.append("%s: %s" % (region, error))
+                    else:
+                        entries[os.path.abspath(self.polygon_dir + region + self.polygon_ext)] = entry
+            finally:
+                pool.close()
+                pool.join()
+        self.polygon_cache.add_entries(entries)
+        self.polygon_cache.save()
+        return errors
+
+    def prepare_region(self, region):
+        """
+        computes the cached values of a region, raises an exception if its polygon is invalid
+        """
+        if not self.region_area(region):
+            raise ValueError("polygon is empty")
+        self.region_bbox(region)
+        self.region_vertices(region)
+        if self.clip_to_polygon:
+            self.region_clip_geometry(region)
+        if self.extract_buffer:
+            self.region_extract_polygon(region)
+
     def make_sea_polygon_file(self, region):
+        if self.streams_land():
+            # the sea is written while the map writer reads it
+            return
         self.logger.info("Making sea polygon for " + region)
-        bbox = self.region_bbox(region)
-        self.sea_polygon_file(bbox, region)
+        if self.clip_to_polygon:
+            geometry = self.region_clip_geometry(region)
+        else:
+            geometry = None
+            bbox = self.region_bbox(region)
+        with instrumentation.stage(region, 'sea file', outputs=[self.sea_path(region)]):
+            if self.land_format == 'pbf':
+                if geometry is None:
+                    geometry = box(*bbox)
+                self.sea_polygon_pbf_file(geometry, region)
+            elif geometry is not None:
+                self.sea_polygon_osm_file(geometry, region)
+            else:
+                self.sea_polygon_file(bbox, region)
 
-    def download_land_polygons(self, data_dir):
-        import urllib
-        import zipfile
+    def download_land_polygons(self, data_dir, url=None, offline=False):
+        """
+        updates the local copy of the land polygons in the data dir if they changed at the url,
+        offline the local copy is used as it is
+        """
         self.logger.info("Retrieving new land files")
         if not self.dry_run:
-            path = os.path.join(data_dir, self.landfiles + ".zip")
-            urllib.urlretrieve ("http://data.openstreetmapdata.com/" + self.landfiles + ".zip", path)
-            zfile = zipfile.ZipFile(path)
-            print data_dir
-            zfile.extractall(data_dir)
-        self.logger.info("Retrieved new land files")
+            if landcache.LandPolygonCache(data_dir, self.landfiles, url).update(offline):
+                self.logger.info("Retrieved new land files")
 
     def extract_land_polygons(self, region, data_dir, simplify=0):
-        import subprocess
-        bbox = self.region_bbox(region)
-        if simplify == 0:
-            ogr_call = ["ogr2ogr", "-overwrite", "-skipfailures", "-clipsrc", str(bbox[0]), str(bbox[1]), str(bbox[2]), str(bbox[3]), os.path.join(self.output_dir, region.replace("/", "-")), os.path.join(data_dir, os.path.join(self.landfiles, "land_polygons.shp"))]
+        """
+        clips the land polygons to the region's bounding box (or buffered polygon) and converts them to osm.
+        the land is clipped from the land of the closest enclosing region that is still kept, only the
+        top level regions are clipped from the whole land polygon data.
+        """
+        if self.clip_to_polygon:
+            clip_geometry = self.region_clip_geometry(region)
         else:
-            ogr_call = ["ogr2ogr", "-overwrite", "-skipfailures", "-simplify", str(simplify), "-clipsrc", str(bbox[0]), str(bbox[1]), str(bbox[2]), str(bbox[3]), os.path.join(self.output_dir, region.replace("/", "-")), os.path.join(data_dir, "land-polygons-split-4326/land_polygons.shp")]
-        self.logger.debug("calling: %s"," ".join(ogr_call))
-        success = subprocess.call(ogr_call)
-        shape2osm.run(self.land_polygon_path(region), output_location=self.land_path_base(region))
+            clip_geometry = box(*self.region_bbox(region))
+        land_index = self.land_polygon_index(data_dir)
+        (ancestor, ancestor_land) = self.enclosing_clipped_land(region, clip_geometry)
+        with instrumentation.stage(region, 'land clip', outputs=[self.land_polygon_path(region)]):
+            if ancestor_land is not None:
+                self.logger.debug("clipping land polygons for %s from %s", region, ancestor)
+                land_polygons = clip_polygons(ancestor_land, clip_geometry)
+            else:
+                land_polygons = land_index.clip(clip_geometry)
+            with self.clipped_land_lock:
+                self.clipped_land[region] = (clip_geometry, land_polygons)
+            if float(simplify):
+                land_polygons = simplify_polygons(land_polygons, float(simplify))
+            if self.streams_land():
+                with self.clipped_land_lock:
+                    self.streamed_land[region] = land_polygons
+                return
+            self.logger.debug("writing %d land polygons for %s", len(land_polygons), region)
+            land_index.write_shapefile(land_polygons, os.path.join(self.output_dir, region.replace("/", "-")))
+        with instrumentation.stage(region, 'shape2osm', inputs=[self.land_polygon_path(region)], outputs=[self.land_path(region)]):
+            shape2osm.run(self.land_polygon_path(region), output_location=self.land_path_base(region),
+                          output_format=self.land_format)
+        # the clipped shapefile is only needed for the conversion
+        shutil.rmtree(os.path.dirname(self.land_polygon_path(region)), True)
+
+    def enclosing_clipped_land(self, region, clip_geometry):
+        """
+        returns the closest ancestor of the region whose clipped land covers the clip geometry and its land
+        """
+        with self.clipped_land_lock:
+            ancestor = region
+            while '/' in ancestor:
+                ancestor = ancestor.rsplit('/', 1)[0]
+                if ancestor in self.clipped_land:
+                    (ancestor_clip, ancestor_land) = self.clipped_land[ancestor]
+                    if ancestor_clip.contains(clip_geometry):
+                        return (ancestor, ancestor_land)
+        return (None, None)
+
+    def release_clipped_land(self, region):
+        """
+        drops the clipped land of a region once all of its sub regions have been processed
+        """
+        with self.clipped_land_lock:
+            self.clipped_land.pop(region, None)
+            self.streamed_land.pop(region, None)
+
+    def streams_land(self):
+        return self.land_format == 'stream'
+
+    def sea_geometry(self, region):
+        if self.clip_to_polygon:
+            return self.region_clip_geometry(region)
+        return box(*self.region_bbox(region))
+
+    def stream_sea(self, region):
+        """
+        writes the sea of the region as pbf to its sea path, which is a named pipe read by the map writer
+        """
+        self.logger.info("Streaming sea polygon for " + region)
+        with instrumentation.stage(region, 'sea file'):
+            self.sea_polygon_pbf_file(self.sea_geometry(region), region)
+
+    def stream_land(self, region, data_dir):
+        """
+        converts the land extract_land_polygons kept for the region to pbf without writing a shapefile,
+        the output is the land path of the region, which is a named pipe read by the map writer
+        """
+        with self.clipped_land_lock:
+            land_polygons = self.streamed_land.pop(region)
+        self.logger.debug("streaming %d land polygons for %s", len(land_polygons), region)
+        with instrumentation.stage(region, 'shape2osm'):
+            data_source = self.land_polygon_index(data_dir).memory_data_source(land_polygons)
+            shape2osm.run(data_source, output_location=self.land_path_base(region), output_format='pbf')
+
+    def land_polygon_index(self, data_dir):
+        """
+        the spatial index over all land polygons, it is only loaded once
+        """
+        with self.land_index_lock:
+            if self.land_index is None:
+                shapefile = self.land_polygon_shapefile(data_dir)
+                self.logger.info("loading land polygons from %s", shapefile)
+                with instrumentation.stage('', 'land index', inputs=[shapefile]):
+                    data_source = ogr.Open(shapefile)
+                    if not data_source:
+                        raise IOError("could not open land polygons %s" % shapefile)
+                    self.land_index = LandPolygonIndex(data_source)
+                    data_source = None
+                self.logger.info("loaded %d land polygons with %d vertices", len(self.land_index.polygons),
+                                 self.land_index.vertices)
+                if self.land_index_listener:
+                    self.land_index_listener(self.land_index)
+            return self.land_index
+
+    def land_polygon_shapefile(self, data_dir):
+        """
+        path to the shapefile with all land polygons
+        """
+        return os.path.join(data_dir, os.path.join(self.landfiles, "land_polygons.shp"))
 
     def land_polygon_path(self, region):
         """
@@ -144,7 +566,7 @@ class LandExtractor:
         return os.path.join(os.path.join(self.output_dir, region.replace("/", "-")), "land_polygons.shp")
         
     def sea_path(self, region):
-        return os.path.join(self.output_dir, region.replace("/", "-") + "-sea.osm")
+        return os.path.join(self.output_dir, region.replace("/", "-") + "-sea" + self.land_extension())
     def land_path_base(self, region):
         """
         returns path to land file but without the numbers and extension
@@ -155,7 +577,257 @@ class LandExtractor:
         """
         returns path to land file with first extension, which should be sufficient
         """        
-        return self.land_path_base(region) + ".osm"
+        return self.land_path_base(region) + self.land_extension()
+
+    def land_extension(self):
+        if self.land_format in ('pbf', 'stream'):
+            return ".osm.pbf"
+        return ".osm"
+
+
+class LandStream:
+    """
+    Writes the sea and land of a region as sorted osm pbf into named pipes at their usual paths,
+    so the map writer reads them while they are generated instead of waiting for the files.
+    """
+
+    def __init__(self, extractor, region, data_dir):
+        self.logger = logging.getLogger("mapcreator")
+        self.pipes = [(extractor.sea_path(region), lambda: extractor.stream_sea(region)),
+                      (extractor.land_path(region), lambda: extractor.stream_land(region, data_dir))]
+        self.threads = []
+        self.errors = []
+
+    def start(self):
+        for (path, write) in self.pipes:
+            if os.path.exists(path):
+                os.remove(path)
+            os.mkfifo(path)
+            thread = threading.Thread(target=self.write, args=(path, write), name=path)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def write(self, path, write):
+        try:
+            write()
+        except Exception, e:
+            self.logger.debug("could not stream %s: %s", path, e)
+            self.errors.append("%s: %s" % (path, e))
+            # the map writer, if it is still waiting for the pipe, reads an empty stream and fails
+            try:
+                os.close(os.open(path, os.O_WRONLY))
+            except OSError:
+                pass
+
+    def finish(self):
+        """
+        waits for the writers and removes the pipes, returns the errors of the writers. Writers still
+        waiting for a reader, as the map writer failed before opening their pipe, are released by
+        opening the pipe for reading, their writes then fail.
+        """
+        for (thread, (path, write)) in zip(self.threads, self.pipes):
+            while thread.is_alive():
+                try:
+                    os.close(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+                thread.join(0.1)
+            if os.path.exists(path):
+                os.remove(path)
+        return self.errors
+
+
+class LandPolygonIndex:
+    """
+    All land polygons of a shapefile in an STRtree, so clipping a region only touches
+    the polygons intersecting its bounding box instead of scanning the whole shapefile.
+    """
+
+    def __init__(self, data_source):
+        layer = data_source.GetLayer(0)
+        self.layer_name = layer.GetName()
+        definition = layer.GetLayerDefn()
+        # the field definitions belong to the data source, which is closed at the end,
+        # so only their (name, type, width, precision) are kept
+        self.fields = []
+        for i in range(definition.GetFieldCount()):
+            field = definition.GetFieldDefn(i)
+            self.fields.append((field.GetName(), field.GetType(), field.GetWidth(), field.GetPrecision()))
+        self.polygons = []
+        self.attributes = []
+        self.vertices = 0
+        feature = layer.GetNextFeature()
+        while feature:
+            geometry = feature.GetGeometryRef()
+            if geometry is not None:
+                self.polygons.append(wkb.loads(geometry.ExportToWkb()))
+                self.attributes.append([feature.GetField(i) for i in range(len(self.fields))])
+                self.vertices += vertex_count(self.polygons[-1])
+            feature = layer.GetNextFeature()
+        self.tree = STRtree(self.polygons)
+        # shapely < 2 returns the geometries of a query instead of their indices
+        self.index_of = dict((id(polygon), i) for (i, polygon) in enumerate(self.polygons))
+
+    def query(self, geometry):
+        """
+        indices of the land polygons whose bounding box intersects the geometry
+        """
+        result = self.tree.query(geometry)
+        if len(result) and hasattr(result[0], 'geom_type'):
+            return sorted(self.index_of[id(polygon)] for polygon in result)
+        return sorted(result)
+
+    def clip(self, clip_geometry):
+        """
+        returns the land polygons clipped to the geometry as list of (polygon, attributes)
+        """
+        return clip_polygons([(self.polygons[i], self.attributes[i]) for i in self.query(clip_geometry)], clip_geometry)
+
+    def write_shapefile(self, polygons, directory):
+        """
+        writes (polygon, attributes) tuples to the shapefile land_polygons.shp in the directory
+        """
+        driver = ogr.GetDriverByName("ESRI Shapefile")
+        if os.path.exists(directory):
+            driver.DeleteDataSource(directory)
+        data_source = driver.CreateDataSource(directory)
+        self.write_layer(data_source, polygons)
+        data_source = None
+
+    def memory_data_source(self, polygons):
+        """
+        returns an in memory data source with a layer of the (polygon, attributes) tuples
+        """
+        data_source = ogr.GetDriverByName("Memory").CreateDataSource(self.layer_name)
+        self.write_layer(data_source, polygons)
+        return data_source
+
+    def write_layer(self, data_source, polygons):
+        layer = data_source.CreateLayer(self.layer_name, geom_type=ogr.wkbPolygon)
+        for (name, field_type, width, precision) in self.fields:
+            field = ogr.FieldDefn(name, field_type)
+            field.SetWidth(width)
+            field.SetPrecision(precision)
+            layer.CreateField(field)
+        definition = layer.GetLayerDefn()
+        for (polygon, attributes) in polygons:
+            feature = ogr.Feature(definition)
+            for (i, value) in enumerate(attributes):
+                if value is not None:
+                    feature.SetField(i, value)
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(polygon.wkb))
+            layer.CreateFeature(feature)
+            feature = None
+
+
+def clip_polygons(polygons, clip_geometry):
+    """
+    clips (polygon, attributes) tuples to the geometry, polygons outside of it are dropped
+    """
+    (minx, miny, maxx, maxy) = clip_geometry.bounds
+    prepared = prep(clip_geometry)
+    clipped = []
+    for (polygon, attributes) in polygons:
+        bounds = polygon.bounds
+        if bounds[0] > maxx or bounds[2] < minx or bounds[1] > maxy or bounds[3] < miny:
+            continue
+        try:
+            if not prepared.intersects(polygon):
+                continue
+            if not prepared.contains(polygon):
+                polygon = polygon.intersection(clip_geometry)
+        except Exception, e:
+            # like ogr2ogr -skipfailures
+            logging.getLogger("mapcreator").debug("skipping land polygon: %s", e)
+            continue
+        for part in polygon_parts(polygon):
+            clipped.append((part, attributes))
+    return clipped
+
+
+def simplify_polygons(polygons, tolerance):
+    """
+    simplifies (polygon, attributes) tuples, polygons that collapse are dropped
+    """
+    simplified = []
+    for (polygon, attributes) in polygons:
+        for part in polygon_parts(polygon.simplify(tolerance, preserve_topology=True)):
+            simplified.append((part, attributes))
+    return simplified
+
+
+def polygon_parts(geometry):
+    """
+    the non-empty polygons of a (multi) polygon or geometry collection
+    """
+    if geometry.is_empty:
+        return []
+    if geometry.geom_type == 'Polygon':
+        return [geometry]
+    if hasattr(geometry, 'geoms'):
+        parts = []
+        for part in geometry.geoms:
+            parts += polygon_parts(part)
+        return parts
+    return []
+
+
+def vertex_count(geometry):
+    """
+    number of vertices of all rings of a polygon or multipolygon
+    """
+    return sum(len(polygon.exterior.coords) + sum(len(interior.coords) for interior in polygon.interiors)
+               for polygon in polygon_parts(geometry))
+
+
+def write_poly(geometry, name, path):
+    """
+    writes a (multi) polygon as an osmosis polygon filter file
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+    lines = [name]
+    ring_number = 0
+    for polygon in polygon_parts(geometry):
+        for (index, ring) in enumerate([polygon.exterior] + list(polygon.interiors)):
+            ring_number += 1
+            lines.append(('!%d' if index else '%d') % ring_number)
+            lines += ['   %.7E   %.7E' % (x, y) for (x, y) in ring.coords]
+            lines.append('END')
+    lines.append('END')
+    # written to a temporary file first, a file that exists is complete
+    temporary_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(temporary_path, path)
+
+
+# the extractor of a process preparing regions
+worker_extractor = None
+
+
+def init_prepare_worker(output_dir, polygon_dir, clip_to_polygon, extract_buffer=0):
+    global worker_extractor
+    worker_extractor = LandExtractor(output_dir, polygon_dir, clip_to_polygon=clip_to_polygon, extract_buffer=extract_buffer)
+    # the values are returned to the parent process, which writes the cache
+    worker_extractor.polygon_cache.cache_file = None
+
+
+def prepare_region(region):
+    """
+    prepares a region in a worker process, returns the region, its polygon cache entry and an error message
+    """
+    try:
+        worker_extractor.prepare_region(region)
+    except Exception, e:
+        return (region, None, "invalid polygon: %s" % (str(e) or e.__class__.__name__))
+    polygon_file = worker_extractor.polygon_dir + region + worker_extractor.polygon_ext
+    return (region, worker_extractor.polygon_cache.entry(polygon_file), None)
 
 
 if __name__ == '__main__':
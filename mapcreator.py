@@ -22,16 +22,32 @@ logging.RotatingFileHandler = RotatingFileHandler
 logging.SMTPHandler = SMTPHandler
 import os
 import os.path as PATH
+import shlex
 import subprocess
 import sys
+import buildmanifest
+import buildnode
+import costmodel
+import instrumentation
+import journal
 import landextraction
+import executors
+import osmchange
+import osmosisworker
+import scheduler
+
+# index of the source pbf in the inputs of a map fingerprint
+MAP_SOURCE_INPUT = 1
 
 class MapCreator:
     '''
     classdocs
     '''
     def __init__(self, osmosis_path, pbf_staging_path, map_staging_path, polygons_path,
-                  initial_source_pbf, target_path, logging_path, default_start_zoom, default_preferred_languages, dry_run=False):
+                  initial_source_pbf, target_path, logging_path, default_start_zoom, default_preferred_languages, dry_run=False,
+                  memory_budget=0, jvm_heap=0, land_clip='bbox', land_format='osm', changed_area=None, resume=False,
+                  disk_budget=0, land_polygons_url=None, offline=False, osmosis_worker=None, osmosis_worker_heap=0,
+                  build_nodes=None, extract_polygon_buffer=0, build_node_token=None):
         '''
         Constructor
         '''
@@ -45,143 +61,758 @@ class MapCreator:
         self.default_start_zoom = default_start_zoom
         self.default_preferred_languages = default_preferred_languages
         self.dry_run = dry_run
+        # memory in MB available to all concurrent osmosis calls and to a single call, 0 if not limited
+        self.memory_budget = memory_budget
+        self.jvm_heap = jvm_heap
+        # disk in MB available to the intermediate files in the staging paths, 0 if not limited
+        self.disk_budget = disk_budget
+        # command starting a long running osmosis worker and its maximum heap in MB, the
+        # workers are started by evalPartParallel
+        self.osmosis_worker = osmosis_worker
+        self.osmosis_worker_heap = osmosis_worker_heap
+        # the nodes the osmosis calls are distributed to (see executors.parse_nodes), None to run them here
+        self.build_nodes = build_nodes
+        self.build_node_token = build_node_token
+        # runs the osmosis calls, replaced by evalPartParallel for the duration of a run
+        self.executor = executors.LocalExecutor()
 
         self.logger = logging.getLogger("mapcreator")
-        self.landExtractor = landextraction.LandExtractor(self.pbf_staging_path, self.polygons_path, self.dry_run)
+        self.landExtractor = landextraction.LandExtractor(self.pbf_staging_path, self.polygons_path, self.dry_run,
+                                                          land_clip == 'polygon', land_format, extract_polygon_buffer)
 
         self.logger.info("start downloading new land polygons")
-        self.landExtractor.download_land_polygons(self.pbf_staging_path)
-        
+        self.landExtractor.download_land_polygons(self.pbf_staging_path, land_polygons_url, offline)
+        # the heaps the map tasks were admitted with by part, passed on to their map writers
+        self.map_heaps = {}
 
-    def evalPart(self, subtree, source_pbf, staging_path, target_dir, zoom_interval_conf, land_simplification):
-        
-        error_occurred = False
+        # fingerprints of the inputs of all created files, files with unchanged inputs are not created again
+        self.manifest = buildmanifest.BuildManifest(self.pbf_staging_path + 'build-manifest.json')
+        self.pbf_fingerprints = {}
+        # the inputs of the map fingerprints by fingerprint
+        self.map_inputs = {}
+        self.osmosis_version_info = None
+        self.land_version_info = None
+        # the area changed since the last run, only parts intersecting it are created again. None if unknown
+        self.changed_area = changed_area
+        self.changed_parts = {}
+        # continue the run recorded in the task journal instead of starting a new one
+        self.resume = resume
+        # the source pbfs of the pbfs created by the scheduled tasks, used to estimate their sizes
+        self.pbf_sources = {}
+        # the parts insert_pbf_extracts decided to create a pbf for, the configuration is left as it is
+        self.inserted_pbfs = set()
         
-        for child in subtree:            
+
+    def needs_area_filter(self, source_pbf, staging_path, current_part_name, create_pbf):
+        '''
+        returns true if the map of a part has to be filtered by the part's polygon: unless the source pbf
+        is the part or the map reads the part's pbf and the pbf was extracted with the part's polygon itself
+        '''
+        if PATH.basename(source_pbf).startswith(current_part_name):
+            return False
+        if not create_pbf:
+            return True
+        region = staging_path + current_part_name
+        return self.landExtractor.region_extract_polygon(region) != self.polygons_path + region + '.poly'
+
+    def pbf_part_names(self, subtree):
+        return [child.get('name') for child in subtree if self.read_part_attributes(child)[1]]
+
+    def current_part_names(self, subtree, source_pbf, staging_path, target_dir, zoom_interval_conf, land_simplification):
+        return set(child.get('name') for child in subtree
+                   if self.part_is_current(child, source_pbf, staging_path, target_dir, zoom_interval_conf, land_simplification))
+
+    def part_is_current(self, child, source_pbf, staging_path, target_dir, zoom_interval_conf, land_simplification):
+        '''
+        returns true if the map of the part and the maps of all its sub parts were created from unchanged inputs
+        '''
+        current_part_name = child.get('name')
+        (create_map, create_pbf, defines_hierarchy, storage_type, map_start_zoom,
+         map_start_lat, map_start_lon, preferred_languages) = self.read_part_attributes(child)
+        area_filter = self.needs_area_filter(source_pbf, staging_path, current_part_name, create_pbf)
+
+        if create_pbf:
+            self.pbf_fingerprint(source_pbf, staging_path, current_part_name)
+            new_source_pbf = staging_path + current_part_name + '.osm.pbf'
+        else:
+            new_source_pbf = source_pbf
+
+        if create_map:
+            map_fingerprint = self.map_fingerprint(new_source_pbf, staging_path, current_part_name, area_filter, map_start_zoom, preferred_languages,
+                                                   zoom_interval_conf, storage_type, map_start_lat, map_start_lon, land_simplification)
+            if not self.map_is_current(staging_path, target_dir, current_part_name, map_fingerprint):
+                return False
+
+        if defines_hierarchy:
+            new_target_dir = target_dir + current_part_name + '/'
+        else:
+            new_target_dir = target_dir
+        new_staging_path = staging_path + current_part_name + '/'
+        return all(self.part_is_current(sub_part, new_source_pbf, new_staging_path, new_target_dir, zoom_interval_conf, land_simplification)
+                   for sub_part in child)
+
+    def map_is_current(self, staging_dir, target_dir, current_part_name, fingerprint):
+        map_file = target_dir + current_part_name + '.map'
+        inputs = self.map_inputs.get(fingerprint)
+        if (self.changed_area is not None and inputs is not None and PATH.exists(self.target_path + map_file) and
+                self.manifest.differs_only_in('map:' + map_file, inputs, MAP_SOURCE_INPUT) and
+                not self.part_has_changes(staging_dir + current_part_name)):
+            # only the source changed and its changes do not touch the part, so the map is current for the new source
+            if not self.dry_run:
+                self.manifest.record('map:' + map_file, fingerprint, inputs)
+            return True
+        return self.manifest.is_current('map:' + map_file, self.target_path + map_file, fingerprint)
+
+    def part_has_changes(self, region):
+        '''
+        returns true if the changed area intersects the buffered polygon of the region
+        '''
+        if region not in self.changed_parts:
+            if not PATH.exists(self.polygons_path + region + '.poly'):
+                self.changed_parts[region] = True
+            else:
+                self.changed_parts[region] = self.changed_area.intersects(self.landExtractor.region_clip_geometry(region))
+        return self.changed_parts[region]
+
+    def plan(self, subtree, source_pbf, staging_path, target_dir, zoom_interval_conf, land_simplification):
+        '''
+        returns (part, steps) for all parts of the subtree, the steps are the files that will be created
+        '''
+        plan = []
+        current_parts = self.current_part_names(subtree, source_pbf, staging_path, target_dir, zoom_interval_conf, land_simplification)
+        for child in subtree:
             current_part_name = child.get('name')
-            self.logger.info("evaluating part '%s'", staging_path + current_part_name)
-            
-            # get attributes from xml element
-            create_map = child.get('create-map', default='true') == 'true'
-            create_pbf = child.get('create-pbf', default='false') == 'true'
-            defines_hierarchy = child.get('defines-hierarchy', default='true') == 'true'
-            storage_type = child.get('type',default='ram')
-            map_start_zoom = child.get('map-start-zoom', default=self.default_start_zoom)
-            # lat/lon maybe None
-            map_start_lat = child.get('map-start-lat')
-            map_start_lon = child.get('map-start-lon')
-            preferred_languages = child.get('preferred-languages', self.default_preferred_languages)
-            # if not None, convert lat/lon to float
-            if map_start_lat:
-                map_start_lat = float(map_start_lat)
-            if map_start_lon:
-                map_start_lon = float(map_start_lon)
-                
-            
-            # we do not need to filter the area during map creation if either a pbf was created (with a filter)
-            # or the source pbf equals the current part
-            area_filter = not(create_pbf or PATH.basename(source_pbf).startswith(current_part_name))
-                
-            if create_pbf: 
-                # create pbf
-                try:        
-                    # the new source pbf for the subtree and this child is the newly created one
-                    new_source_pbf = self.call_create_pbf(source_pbf, staging_path, current_part_name)                                        
-                except ProcessingException, e:
-                    error_occurred = True
-                    self.logger.warning("%s, skipping all sub parts", str(e))
-                    #print "an error occurred while creating pbf for '%s', no further processing of sub-parts will take part, error message: %s" % (current_part_name, e)
-                    # we need to skip processing of sub parts
-                    continue                
+            if current_part_name in current_parts:
+                plan.append((staging_path + current_part_name, []))
+                continue
+            (create_map, create_pbf, defines_hierarchy, storage_type, map_start_zoom,
+             map_start_lat, map_start_lon, preferred_languages) = self.read_part_attributes(child)
+            area_filter = self.needs_area_filter(source_pbf, staging_path, current_part_name, create_pbf)
+            steps = []
+            if create_pbf:
+                new_source_pbf = staging_path + current_part_name + '.osm.pbf'
+                if not self.manifest.is_current('pbf:' + new_source_pbf, self.pbf_staging_path + new_source_pbf,
+                                                self.pbf_fingerprint(source_pbf, staging_path, current_part_name)):
+                    steps.append('pbf')
             else:
-                # we didn't create a new pbf, so the new source pbf is the old one
                 new_source_pbf = source_pbf
-                
             if create_map:
-                self.landExtractor.make_sea_polygon_file(staging_path + current_part_name)
-                self.landExtractor.extract_land_polygons(staging_path + current_part_name, self.pbf_staging_path, land_simplification)
-                try:
-                    self.call_create_map(new_source_pbf, staging_path, target_dir, current_part_name, area_filter, map_start_zoom, preferred_languages, zoom_interval_conf, storage_type, map_start_lat, map_start_lon)
-                except ProcessingException, e:
-                    error_occurred = True
-                    self.logger.warning("%s", str(e))
-                    #print "an error occurred while creating map for '%s', error message: %s" % (current_part_name, e)
-                    # errors while creating the map file do not harm any sub parts
-                    # continue with processing sub parts
-            
+                map_fingerprint = self.map_fingerprint(new_source_pbf, staging_path, current_part_name, area_filter, map_start_zoom, preferred_languages,
+                                                       zoom_interval_conf, storage_type, map_start_lat, map_start_lon, land_simplification)
+                if not self.map_is_current(staging_path, target_dir, current_part_name, map_fingerprint):
+                    steps.append('map')
+            plan.append((staging_path + current_part_name, steps))
+
+            if defines_hierarchy:
+                new_target_dir = target_dir + current_part_name + '/'
+            else:
+                new_target_dir = target_dir
+            plan += self.plan(child, new_source_pbf, staging_path + current_part_name + '/', new_target_dir, zoom_interval_conf, land_simplification)
+        return plan
+
+    def print_plan(self, subtree, source_pbf, zoom_interval_conf, land_simplification):
+        plan = self.plan(subtree, source_pbf, '', '', zoom_interval_conf, land_simplification)
+        for (part, steps) in plan:
+            if steps:
+                print "%-40s %s" % (part, " ".join(steps))
+        print "%d of %d parts to process, %d up to date" % (len([p for p in plan if p[1]]), len(plan), len([p for p in plan if not p[1]]))
+
+    def source_fingerprint(self, source_pbf):
+        '''
+        fingerprint of a source pbf, for pbfs created from the configuration the fingerprint of their inputs
+        '''
+        if source_pbf not in self.pbf_fingerprints:
+            source_pbf_path = self.pbf_staging_path + source_pbf
+            if not PATH.exists(source_pbf_path):
+                return None
+            self.pbf_fingerprints[source_pbf] = self.manifest.pbf_version(source_pbf_path)
+        return self.pbf_fingerprints[source_pbf]
+
+    def pbf_fingerprint(self, source_pbf, staging_dir, current_part_name):
+        inputs = ['pbf', self.source_fingerprint(source_pbf), self.polygon_digest(staging_dir + current_part_name), self.osmosis_version()]
+        if self.landExtractor.extract_buffer:
+            inputs.append(self.landExtractor.extract_buffer)
+        fingerprint = buildmanifest.fingerprint(*inputs)
+        self.pbf_fingerprints[staging_dir + current_part_name + '.osm.pbf'] = fingerprint
+        return fingerprint
+
+    def map_fingerprint(self, source_pbf, staging_dir, current_part_name, area_filter, start_zoom, preferred_languages,
+                        zoom_interval_conf, storage_type, lat, lon, land_simplification):
+        inputs = ['map', self.source_fingerprint(source_pbf), self.polygon_digest(staging_dir + current_part_name),
+                  area_filter, self.land_version(), land_simplification, self.landExtractor.clip_to_polygon,
+                  zoom_interval_conf, preferred_languages, storage_type, start_zoom, lat, lon, self.osmosis_version()]
+        fingerprint = buildmanifest.fingerprint(*inputs)
+        self.map_inputs[fingerprint] = inputs
+        return fingerprint
+
+    def polygon_digest(self, region):
+        polygon_file_path = self.polygons_path + region + '.poly'
+        if not PATH.exists(polygon_file_path):
+            return None
+        return self.manifest.file_digest(polygon_file_path)
+
+    def land_version(self):
+        if self.land_version_info is None:
+            shapefile = self.landExtractor.land_polygon_shapefile(self.pbf_staging_path)
+            if PATH.exists(shapefile):
+                self.land_version_info = self.manifest.file_digest(shapefile)
+        return self.land_version_info
+
+    def osmosis_version(self):
+        if self.osmosis_version_info is None:
+            self.osmosis_version_info = buildmanifest.osmosis_version(self.osmosis_path)
+        return self.osmosis_version_info
+
+    def read_part_attributes(self, child):
+        create_map = child.get('create-map', default='true') == 'true'
+        create_pbf = child.get('create-pbf', default='false') == 'true' or child in self.inserted_pbfs
+        defines_hierarchy = child.get('defines-hierarchy', default='true') == 'true'
+        # None if the storage type should be chosen automatically
+        storage_type = child.get('type')
+        map_start_zoom = child.get('map-start-zoom', default=self.default_start_zoom)
+        # lat/lon maybe None
+        map_start_lat = child.get('map-start-lat')
+        map_start_lon = child.get('map-start-lon')
+        preferred_languages = child.get('preferred-languages', self.default_preferred_languages)
+        # if not None, convert lat/lon to float
+        if map_start_lat:
+            map_start_lat = float(map_start_lat)
+        if map_start_lon:
+            map_start_lon = float(map_start_lon)
+        return (create_map, create_pbf, defines_hierarchy, storage_type, map_start_zoom,
+                map_start_lat, map_start_lon, preferred_languages)
+
+    def prepare_parts(self, subtree, processes=None):
+        '''
+        checks the polygons of all parts creating a map or pbf and computes everything derived from them
+        before any osmosis call, in parallel processes. returns an error message for every invalid polygon
+        '''
+        regions = self.polygon_regions(subtree, '')
+        self.logger.info("preparing the polygons of %d parts", len(regions))
+        return self.landExtractor.prepare_regions(regions, processes)
+
+    def polygon_regions(self, subtree, staging_path):
+        regions = []
+        for child in subtree:
+            (create_map, create_pbf) = self.read_part_attributes(child)[:2]
+            if create_map or create_pbf:
+                regions.append(staging_path + child.get('name'))
+            regions += self.polygon_regions(child, staging_path + child.get('name') + '/')
+        return regions
+
+    def insert_pbf_extracts(self, subtree, source_pbf, staging_path='', source_size=None):
+        '''
+        lets parts without a pbf create one if extracting it is estimated to be faster than reading
+        the source pbf in every call of the part and its sub parts. like all created pbfs, the
+        extracts are removed once the sub parts are done. returns the regions of these parts
+        '''
+        if source_size is None:
+            source_size = costmodel.pbf_size(self.pbf_staging_path + source_pbf)
+        source_area = self.source_area(source_pbf)
+        regions = []
+        for child in subtree:
+            region = staging_path + child.get('name')
+            create_pbf = self.read_part_attributes(child)[1]
+            area = self.landExtractor.region_area(region)
+            new_source_pbf = source_pbf
+            new_source_size = source_size
+            if area is not None and not PATH.basename(source_pbf).startswith(child.get('name')):
+                part_size = costmodel.part_input_size(source_size, source_area, area)
+                if not create_pbf:
+                    (readers, reader_vertices) = self.source_readers(child, staging_path)
+                    saving = costmodel.extract_saving(source_size, part_size, readers,
+                                                      self.landExtractor.region_extract_vertices(region) or 0, reader_vertices)
+                    if saving > 0:
+                        self.logger.info("creating an intermediate pbf for part '%s' read by %d calls, saves about %s",
+                                         region, readers, format_seconds(saving))
+                        self.inserted_pbfs.add(child)
+                        regions.append(region)
+                        create_pbf = True
+                if create_pbf:
+                    new_source_pbf = region + '.osm.pbf'
+                    new_source_size = part_size
+            regions += self.insert_pbf_extracts(child, new_source_pbf, region + '/', new_source_size)
+        return regions
+
+    def source_readers(self, child, staging_path):
+        '''
+        returns the number of osmosis calls of a part without a pbf and its sub parts that read
+        the source pbf of the part and the total vertices of the polygons they filter it with
+        '''
+        region = staging_path + child.get('name')
+        readers = 0
+        vertices = 0
+        if self.read_part_attributes(child)[0]:
+            readers += 1
+            vertices += self.landExtractor.region_vertices(region) or 0
+        pbf_part_names = self.pbf_part_names(child)
+        if pbf_part_names:
+            # the pbfs of sibling parts are extracted by a single call
+            readers += 1
+            vertices += sum(self.landExtractor.region_extract_vertices(region + '/' + name) or 0 for name in pbf_part_names)
+        for sub_part in child:
+            if sub_part.get('name') not in pbf_part_names:
+                (sub_readers, sub_vertices) = self.source_readers(sub_part, region + '/')
+                readers += sub_readers
+                vertices += sub_vertices
+        return (readers, vertices)
+
+    def evalPartParallel(self, subtree, source_pbf, zoom_interval_conf, land_simplification, jobs):
+        '''
+        processes all parts of the configuration: the osmosis calls of the parts are scheduled as tasks
+        and independent calls run concurrently with the given number of jobs. the task states are recorded
+        in a journal in the logging path, so an interrupted run can be resumed
+        '''
+        task_journal = None
+        if not self.dry_run:
+            task_journal = journal.TaskJournal(check_create_path(self.logging_path + 'journal.sqlite'), self.resume)
+        part_scheduler = scheduler.PartScheduler(jobs, self.memory_budget, task_journal, self.disk_budget)
+        self.schedulePart(part_scheduler, subtree, None, None, source_pbf, '', '', zoom_interval_conf, land_simplification)
+        self.reserve_land_index(part_scheduler)
+        if not self.dry_run:
+            self.executor = self.create_executor(jobs)
+        try:
+            return part_scheduler.run()
+        except KeyboardInterrupt:
+            if task_journal:
+                self.logger.error("the run was interrupted, run it again with --resume to continue it")
+            raise
+        finally:
+            self.executor.close()
+            self.executor = executors.LocalExecutor()
+            self.landExtractor.land_index_listener = None
+            if task_journal:
+                task_journal.close()
+            self.write_report()
+            # values computed while scheduling and running the tasks are written once at the end of the run
+            self.manifest.save()
+            self.landExtractor.polygon_cache.save()
+
+    def reserve_land_index(self, part_scheduler):
+        '''
+        the land polygon index is held by this process for the rest of the run once it is loaded,
+        so its memory is taken off the budget of the osmosis calls then
+        '''
+        def reserve(land_index):
+            memory = costmodel.land_index_memory(len(land_index.polygons), land_index.vertices)
+            self.logger.info("the land polygon index takes about %d MB of the memory budget", memory)
+            part_scheduler.reserve(memory)
+        self.landExtractor.land_index_listener = reserve
+        if self.landExtractor.land_index is not None:
+            reserve(self.landExtractor.land_index)
+
+    def create_executor(self, jobs):
+        workers = None
+        if self.osmosis_worker:
+            workers = osmosisworker.WorkerPool(self.osmosis_worker, jobs, self.osmosis_worker_heap,
+                                               log_dir=check_create_path(self.logging_path + 'workers/'))
+        if self.build_nodes:
+            return executors.NodeExecutor(executors.parse_nodes(self.build_nodes, self.build_node_token), workers)
+        return executors.LocalExecutor(workers)
+
+    def write_report(self):
+        '''
+        writes the timings and resource usage of all stages of the run to the logging path
+        '''
+        report = instrumentation.report()
+        try:
+            report.write_json(check_create_path(self.logging_path + 'run-report.json'))
+            report.write_csv(self.logging_path + 'run-report.csv')
+            report.write_timings(self.logging_path + 'timings.json')
+        except (IOError, OSError), e:
+            self.logger.warning("could not write run report: %s", e)
+
+    def print_schedule(self, subtree, source_pbf, zoom_interval_conf, land_simplification, jobs):
+        '''
+        prints the estimated duration, memory and staging disk of the tasks of all parts to process
+        and when they run with the given number of jobs
+        '''
+        part_scheduler = scheduler.PartScheduler(jobs, self.memory_budget, disk_budget=self.disk_budget)
+        self.schedulePart(part_scheduler, subtree, None, None, source_pbf, '', '', zoom_interval_conf, land_simplification)
+        estimates = dict((task, task.cost() if task.cost else costmodel.Estimate()) for task in part_scheduler.tasks)
+        costmodel.Timings(self.logging_path + 'timings.json').calibrate(estimates.values())
+        for (task, estimate) in estimates.items():
+            task.memory = estimate.memory
+            task.disk = estimate.disk
+        (schedule, peak_memory, peak_disk) = part_scheduler.simulate(lambda task: estimates[task].seconds)
+
+        print "%9s %9s %9s %9s %9s  %s" % ('start', 'end', 'duration', 'memory', 'disk', 'task')
+        for (task, start, end) in schedule:
+            if task.cost:
+                estimate = estimates[task]
+                print "%9s %9s %9s %6d MB %6d MB  %s" % (format_seconds(start), format_seconds(end), format_seconds(end - start),
+                                                        estimate.memory, estimate.disk, task.name)
+        makespan = max([end for (task, start, end) in schedule] + [0])
+        print "%d tasks taking %s, with %d jobs the run takes %s, peak memory %d MB, peak staging disk %d MB" % (
+            len([t for t in part_scheduler.tasks if t.cost]), format_seconds(sum(e.seconds for e in estimates.values())),
+            part_scheduler.jobs, format_seconds(makespan), peak_memory, peak_disk)
+
+    def schedulePart(self, part_scheduler, subtree, source_task, land_task, source_pbf, staging_path, target_dir, zoom_interval_conf, land_simplification):
+        '''
+        adds the tasks for all parts in the subtree to the scheduler, returns the added tasks.
+        a part waits for the task creating its source pbf, a created pbf is removed after all
+        tasks of the subtree have finished and none of them failed. the land of a part is
+        clipped after the land of the closest enclosing part with a map, so it can be clipped
+        from the land of that part.
+        '''
+        tasks = []
+
+        current_parts = self.current_part_names(subtree, source_pbf, staging_path, target_dir, zoom_interval_conf, land_simplification)
+
+        # one task creates the pbfs of all sibling parts, the per part tasks report its results
+        pbf_results = {}
+        pbf_part_names = [name for name in self.pbf_part_names(subtree) if name not in current_parts]
+        if pbf_part_names:
+            split_cost = self.split_cost(source_pbf, staging_path, pbf_part_names)
+            split_task = part_scheduler.add(staging_path + ':split',
+                                            self.split_action(source_pbf, staging_path, pbf_part_names, pbf_results),
+                                            [source_task], memory=costmodel.extract_heap(len(pbf_part_names)),
+                                            outputs=[self.pbf_staging_path + staging_path + name + '.osm.pbf' for name in pbf_part_names],
+                                            cost=split_cost, intermediate=True, inputs=[self.pbf_staging_path + source_pbf],
+                                            disk=self.disk_estimate(split_cost))
+            tasks.append(split_task)
+
+        for child in subtree:
+            current_part_name = child.get('name')
+            if current_part_name in current_parts:
+                self.logger.info("part '%s' is up to date, skipping it and all sub parts", staging_path + current_part_name)
+                continue
+            self.logger.info("scheduling part '%s'", staging_path + current_part_name)
+
+            (create_map, create_pbf, defines_hierarchy, storage_type, map_start_zoom,
+             map_start_lat, map_start_lon, preferred_languages) = self.read_part_attributes(child)
+
+            area_filter = self.needs_area_filter(source_pbf, staging_path, current_part_name, create_pbf)
+
+            subtree_tasks = []
+            if create_pbf:
+                new_source_pbf = staging_path + current_part_name + '.osm.pbf'
+                self.pbf_sources[new_source_pbf] = source_pbf
+                pbf_task = part_scheduler.add(staging_path + current_part_name + '.osm.pbf',
+                                              self.pbf_action(pbf_results, current_part_name, self.pbf_staging_path + new_source_pbf),
+                                              [split_task], outputs=[self.pbf_staging_path + new_source_pbf])
+                new_source_task = pbf_task
+                subtree_tasks.append(pbf_task)
+            else:
+                new_source_pbf = source_pbf
+                new_source_task = source_task
+
+            if create_map:
+                map_fingerprint = self.map_fingerprint(new_source_pbf, staging_path, current_part_name, area_filter, map_start_zoom, preferred_languages,
+                                                       zoom_interval_conf, storage_type, map_start_lat, map_start_lon, land_simplification)
+                if self.map_is_current(staging_path, target_dir, current_part_name, map_fingerprint):
+                    self.logger.info("map '%s' is up to date", target_dir + current_part_name)
+                    create_map = False
+
+            new_land_task = land_task
+            if create_map:
+                region = staging_path + current_part_name
+                map_cost = self.map_cost(new_source_pbf, staging_path, current_part_name, area_filter, storage_type)
+                map_memory = self.map_memory_estimate(new_source_pbf, staging_path, current_part_name, area_filter, storage_type)
+                if self.landExtractor.streams_land():
+                    # the map task clips the land itself, so the clipped land is only held while it is streamed
+                    # into the map writer. sub parts clip from it if it is still held when they start
+                    land_files = []
+                    map_cost = self.stream_map_cost(map_cost, region)
+                    map_memory = self.stream_map_memory(map_memory, region)
+                    map_dependencies = [new_source_task]
+                    clip_simplification = land_simplification
+                else:
+                    land_files = [self.landExtractor.sea_path(region), self.landExtractor.land_path(region)]
+                    land_cost = self.land_cost(region)
+                    new_land_task = part_scheduler.add(region + '.land',
+                                                       self.land_action(region, land_simplification),
+                                                       [land_task], always_run=True, outputs=land_files, cost=land_cost,
+                                                       intermediate=True, disk=self.disk_estimate(land_cost))
+                    subtree_tasks.append(new_land_task)
+                    map_dependencies = [new_source_task, new_land_task]
+                    clip_simplification = None
+                map_task = part_scheduler.add(region + '.map',
+                                              self.map_action(new_source_pbf, staging_path, target_dir, current_part_name, area_filter,
+                                                              map_start_zoom, preferred_languages, zoom_interval_conf, storage_type,
+                                                              map_start_lat, map_start_lon, map_fingerprint, clip_simplification),
+                                              map_dependencies, memory=map_memory,
+                                              outputs=[self.target_path + target_dir + current_part_name + '.map'],
+                                              cost=map_cost, inputs=[self.pbf_staging_path + new_source_pbf] + land_files,
+                                              disk=self.disk_estimate(map_cost))
+                subtree_tasks.append(map_task)
+
             if defines_hierarchy:
-                # this part defines a new level in the output hierarchy
                 new_target_dir = target_dir + child.get('name') + '/'
             else:
-                new_target_dir = target_dir;
-        
+                new_target_dir = target_dir
+
             new_staging_path = staging_path + child.get('name') + '/'
-            
-            #### RECURSION         
-            subpart_error = self.evalPart(child, new_source_pbf, new_staging_path, new_target_dir, zoom_interval_conf, land_simplification)
-            error_occurred = subpart_error or error_occurred
-            
-            # clean up files
-            pbf_file_path = self.pbf_staging_path+new_source_pbf
-            if create_pbf and PATH.exists(pbf_file_path):
-                if not error_occurred:
-                    self.logger.debug("removing pbf file %s",pbf_file_path)
-                    os.remove(pbf_file_path)
-                else:
-                    self.logger.debug("error occurred in sub part, keeping pbf file %s",pbf_file_path)
-                
-        return error_occurred
-                
-    
-    def call_create_pbf(self, source_pbf, staging_dir, current_part_name):
-        
-        # set the path to the pbf file
-        target_pbf = staging_dir + current_part_name + '.osm.pbf'
-        target_pbf_path = check_create_path(self.pbf_staging_path+target_pbf)
-        if PATH.exists(target_pbf_path):
-            self.logger.info("the pbf file %s already exists, using the existing one", target_pbf)
-            return target_pbf
-        
-       
+
+            #### RECURSION
+            subtree_tasks += self.schedulePart(part_scheduler, child, new_source_task, new_land_task, new_source_pbf, new_staging_path, new_target_dir, zoom_interval_conf, land_simplification)
+
+            if create_map:
+                subtree_tasks.append(part_scheduler.add(staging_path + current_part_name + '.release',
+                                                        self.release_land_action(staging_path + current_part_name),
+                                                        subtree_tasks, always_run=True))
+            tasks += subtree_tasks
+
+        return tasks
+
+    def split_action(self, source_pbf, staging_dir, part_names, pbf_results):
+        def action():
+            pbf_results.update(self.call_create_pbfs(source_pbf, staging_dir, part_names))
+        return action
+
+    def pbf_action(self, pbf_results, current_part_name, pbf_path):
+        def action():
+            try:
+                if current_part_name not in pbf_results:
+                    # the split was done by the resumed run, its pbfs are only used if they are complete
+                    if not PATH.exists(pbf_path) or not journal.is_complete(pbf_path):
+                        raise ProcessingException("the pbf %s of the resumed run is missing or incomplete" % pbf_path)
+                elif isinstance(pbf_results[current_part_name], ProcessingException):
+                    raise pbf_results[current_part_name]
+            except ProcessingException, e:
+                self.logger.warning("%s, skipping all sub parts", str(e))
+                raise
+        return action
+
+    def land_action(self, region, land_simplification):
+        def action():
+            self.landExtractor.make_sea_polygon_file(region)
+            self.landExtractor.extract_land_polygons(region, self.pbf_staging_path, land_simplification)
+        return action
+
+    def release_land_action(self, region):
+        def action():
+            self.landExtractor.release_clipped_land(region)
+        return action
+
+    def map_action(self, source_pbf, staging_dir, target_dir, current_part_name, area_filter, start_zoom, preferred_languages,
+                   zoom_interval_conf, storage_type, lat, lon, fingerprint, clip_simplification=None):
+        '''
+        creates the map of a part, with a clip simplification the land is clipped first (for streamed land)
+        '''
+        def action():
+            if clip_simplification is not None:
+                self.landExtractor.extract_land_polygons(staging_dir + current_part_name, self.pbf_staging_path, clip_simplification)
+            try:
+                self.call_create_map(source_pbf, staging_dir, target_dir, current_part_name, area_filter, start_zoom,
+                                     preferred_languages, zoom_interval_conf, storage_type, lat, lon, fingerprint)
+            except ProcessingException, e:
+                self.logger.warning("%s", str(e))
+                raise
+        return action
+
+    def map_memory_estimate(self, source_pbf, staging_dir, current_part_name, area_filter, storage_type):
+        def estimate():
+            heap = self.map_writer_settings(source_pbf, staging_dir, current_part_name, area_filter, storage_type)[1]
+            self.map_heaps[staging_dir + current_part_name] = heap
+            return heap
+        return estimate
+
+    def map_writer_settings(self, source_pbf, staging_dir, current_part_name, area_filter, storage_type=None, source_size=None):
+        '''
+        returns storage type and heap in MB for the map writer, the storage type is chosen
+        from the estimated size of the part's data if it is not configured
+        '''
+        input_size = self.map_input_size(source_pbf, staging_dir, current_part_name, area_filter, source_size)
+        max_heap = self.jvm_heap or self.memory_budget or costmodel.physical_memory()
+        return costmodel.choose_map_writer(input_size, max_heap, storage_type)
+
+    def map_input_size(self, source_pbf, staging_dir, current_part_name, area_filter, source_size=None):
+        '''
+        estimated size in MB of the data the map writer reads, by default from the size of the source pbf
+        '''
+        if source_size is None:
+            source_size = costmodel.pbf_size(self.pbf_staging_path + source_pbf)
+        if not area_filter:
+            return source_size
+        return costmodel.part_input_size(source_size, self.source_area(source_pbf),
+                                         self.landExtractor.region_area(staging_dir + current_part_name))
+
+    def pbf_size_estimate(self, pbf):
+        '''
+        size in MB of a pbf, estimated from the size of its source for pbfs that were not created yet
+        '''
+        if PATH.exists(self.pbf_staging_path + pbf) or pbf not in self.pbf_sources:
+            return costmodel.pbf_size(self.pbf_staging_path + pbf)
+        source_pbf = self.pbf_sources[pbf]
+        return costmodel.part_input_size(self.pbf_size_estimate(source_pbf), self.source_area(source_pbf),
+                                         self.landExtractor.region_area(pbf[:-len('.osm.pbf')]))
+
+    def split_cost(self, source_pbf, staging_dir, part_names):
+        def estimate():
+            vertices = sum(self.landExtractor.region_extract_vertices(staging_dir + name) or 0 for name in part_names)
+            return costmodel.extract_estimate(staging_dir.rstrip('/'), self.pbf_size_estimate(source_pbf),
+                                              [self.pbf_size_estimate(staging_dir + name + '.osm.pbf') for name in part_names],
+                                              vertices)
+        return estimate
+
+    def land_cost(self, region):
+        def estimate():
+            return costmodel.land_estimate(region, self.landExtractor.region_area(region), self.landExtractor.land_format)
+        return estimate
+
+    def map_cost(self, source_pbf, staging_dir, current_part_name, area_filter, storage_type):
+        def estimate():
+            source_size = self.pbf_size_estimate(source_pbf)
+            input_size = self.map_input_size(source_pbf, staging_dir, current_part_name, area_filter, source_size)
+            (map_storage_type, heap) = self.map_writer_settings(source_pbf, staging_dir, current_part_name, area_filter,
+                                                                storage_type, source_size)
+            vertices = 0
+            if area_filter:
+                vertices = self.landExtractor.region_vertices(staging_dir + current_part_name) or 0
+            return costmodel.map_estimate(staging_dir + current_part_name, input_size, map_storage_type, heap, vertices)
+        return estimate
+
+    def stream_map_cost(self, map_cost, region):
+        '''
+        the cost of a map task that also clips the land it streams into the map writer
+        '''
+        def estimate():
+            map_estimate = map_cost()
+            land_estimate = self.land_cost(region)()
+            map_estimate.seconds += land_estimate.seconds
+            map_estimate.memory += costmodel.land_memory(self.landExtractor.region_area(region))
+            map_estimate.stages += land_estimate.stages
+            return map_estimate
+        return estimate
+
+    def stream_map_memory(self, map_memory, region):
+        '''
+        the memory of a map task that also holds the clipped land it streams into the map writer
+        '''
+        def estimate():
+            return map_memory() + costmodel.land_memory(self.landExtractor.region_area(region))
+        return estimate
+
+    def disk_estimate(self, cost):
+        '''
+        the disk in MB a task writes, only estimated if the disk is limited
+        '''
+        if not self.disk_budget:
+            return 0
+        def estimate():
+            return cost().disk
+        return estimate
+
+    def source_area(self, source_pbf):
+        '''
+        area of the polygon a source pbf was extracted with, None if unknown
+        '''
+        area = None
+        if source_pbf.endswith('.osm.pbf'):
+            area = self.landExtractor.region_area(source_pbf[:-len('.osm.pbf')])
+        if area is None and source_pbf == self.initial_source_pbf:
+            # the initial source pbf without a polygon is the planet
+            area = costmodel.WORLD_AREA
+        return area
+
+    def osmosis_environment(self, heap):
+        '''
+        environment for an osmosis call with the given maximum heap in MB, the heap is only
+        set if a per-job heap or a memory budget is configured. With a memory budget the JVM
+        would otherwise take its default heap instead of the memory the call was admitted with
+        '''
+        env = dict(os.environ)
+        if (self.jvm_heap or self.memory_budget) and heap:
+            env['JAVACMD_OPTIONS'] = (env.get('JAVACMD_OPTIONS', '') + ' -Xmx%dm' % heap).strip()
+        return env
+
+    def call_create_pbfs(self, source_pbf, staging_dir, part_names):
+        '''
+        creates the pbf files of several parts from the same source pbf with a single osmosis call,
+        the source is read once and teed into one bounding polygon filter per part.
+        returns a dict mapping each part name to its pbf file or to the ProcessingException for the part
+        '''
+        results = {}
+        pending = []
+        for current_part_name in part_names:
+            # set the path to the pbf file
+            target_pbf = staging_dir + current_part_name + '.osm.pbf'
+            target_pbf_path = check_create_path(self.pbf_staging_path+target_pbf)
+            if self.manifest.is_current('pbf:' + target_pbf, target_pbf_path, self.pbf_fingerprint(source_pbf, staging_dir, current_part_name)):
+                self.logger.info("the pbf file %s is up to date, using the existing one", target_pbf)
+                results[current_part_name] = target_pbf
+                continue
+
+            polygons_path = self.landExtractor.region_extract_polygon(staging_dir + current_part_name)
+            if not PATH.exists(polygons_path):
+                results[current_part_name] = ProcessingException('cannot create pbf %s , polygon is missing: %s' % (target_pbf, polygons_path))
+                continue
+            pending.append((current_part_name, target_pbf, target_pbf_path, polygons_path))
+
+        if not pending:
+            return results
+
         # check whether source pbf exists and has non-zero size (irrelevant for dry run)
         source_pbf_path = self.pbf_staging_path + source_pbf
         if not self.dry_run:
-            if not PATH.exists(source_pbf_path):
-                raise ProcessingException('cannot create %s, source pbf is missing: %s' % (target_pbf,source_pbf_path))
-            if PATH.getsize(source_pbf_path) == 0:
-                raise ProcessingException('cannot create %s, source pbf is empty: %s' % (target_pbf,source_pbf_path))
-    
-        polygons_path = self.polygons_path + staging_dir + current_part_name+'.poly'
-        if not PATH.exists(polygons_path):
-            raise ProcessingException('cannot create pbf %s , polygon is missing: %s' % (target_pbf, polygons_path))
-        
-        
-        
-          
+            for (current_part_name, target_pbf, target_pbf_path, polygons_path) in pending:
+                if not PATH.exists(source_pbf_path):
+                    results[current_part_name] = ProcessingException('cannot create %s, source pbf is missing: %s' % (target_pbf,source_pbf_path))
+                elif PATH.getsize(source_pbf_path) == 0:
+                    results[current_part_name] = ProcessingException('cannot create %s, source pbf is empty: %s' % (target_pbf,source_pbf_path))
+            pending = [p for p in pending if p[0] not in results]
+            if not pending:
+                return results
+
         osmosis_call = [self.osmosis_path, '--rb',source_pbf_path]
-        osmosis_call += ['--bp','completeWays=yes','completeRelations=yes','clipIncompleteEntities=false','file=%s'%polygons_path]
-        osmosis_call += ['--wb','omitmetadata=false','compress=deflate','file=%s'%target_pbf_path]
-        logfile_path = check_create_path(self.logging_path + staging_dir + current_part_name + '.pbf.log')
+        if len(pending) > 1:
+            osmosis_call += ['--tee', str(len(pending))]
+        for (current_part_name, target_pbf, target_pbf_path, polygons_path) in pending:
+            osmosis_call += ['--bp','completeWays=yes','completeRelations=yes','clipIncompleteEntities=false','file=%s'%polygons_path]
+            osmosis_call += ['--wb','omitmetadata=false','compress=deflate','file=%s'%target_pbf_path]
+
+        # every part has its own filter and writer in the same jvm
+        heap = costmodel.extract_heap(len(pending))
+
+        if len(pending) == 1:
+            logfile_path = check_create_path(self.logging_path + staging_dir + pending[0][0] + '.pbf.log')
+        else:
+            logfile_path = check_create_path(self.logging_path + staging_dir + 'split.pbf.log')
         logfile = open(logfile_path,'a')
         try:
             self.logger.debug("calling: %s"," ".join(osmosis_call))
             if not self.dry_run:
-                subprocess.check_call(osmosis_call,stderr=logfile)
+                # the extract is a stage of the part whose sub parts are extracted
+                with instrumentation.stage(staging_dir.rstrip('/'), instrumentation.PBF_STAGE,
+                                           inputs=[source_pbf_path], outputs=[p[2] for p in pending]):
+                    self.executor.check_call(osmosis_call, logfile, heap, self.osmosis_environment(heap),
+                                             inputs=[source_pbf_path], outputs=[p[2] for p in pending])
             else:
-                subprocess.check_call(['touch',target_pbf_path])
+                subprocess.check_call(['touch'] + [p[2] for p in pending])
             logfile.close()
-            
-            if not self.dry_run and PATH.getsize(target_pbf_path) == 0:
-                raise ProcessingException('error creating %s, resulting pbf is empty' % (target_pbf_path))
-            
-            return target_pbf
         except CalledProcessError:
             logfile.close()
-            raise ProcessingException("call to osmosis raised an error, see logs at %s for further details"%logfile_path)
+            error = ProcessingException("call to osmosis raised an error, see logs at %s for further details"%logfile_path)
+            self.remove_partial_pbfs(pending)
+            for p in pending:
+                results[p[0]] = error
+            return results
         except OSError,e:
-            raise ProcessingException("osmosis executable not found: %s"%e)
-    
-    def call_create_map(self, source_pbf, staging_dir, target_dir, current_part_name, area_filter, start_zoom, preferred_languages, zoom_interval_conf, storage_type='ram', lat=None,lon=None):
+            logfile.close()
+            error = ProcessingException("osmosis executable not found: %s"%e)
+            for p in pending:
+                results[p[0]] = error
+            return results
+
+        for (current_part_name, target_pbf, target_pbf_path, polygons_path) in pending:
+            if not self.dry_run and PATH.getsize(target_pbf_path) == 0:
+                results[current_part_name] = ProcessingException('error creating %s, resulting pbf is empty' % (target_pbf_path))
+            else:
+                results[current_part_name] = target_pbf
+                if not self.dry_run:
+                    self.manifest.record('pbf:' + target_pbf, self.pbf_fingerprints[target_pbf])
+        self.manifest.save()
+        return results
+
+    def remove_partial_pbfs(self, pending):
+        # a failed call may leave incomplete pbfs behind that would otherwise be reused by the next run
+        for p in pending:
+            if PATH.exists(p[2]):
+                self.logger.debug("removing incomplete pbf file %s", p[2])
+                os.remove(p[2])
+
+    def call_create_map(self, source_pbf, staging_dir, target_dir, current_part_name, area_filter, start_zoom, preferred_languages, zoom_interval_conf, storage_type=None, lat=None,lon=None, fingerprint=None):
         
         # set the path to the map file
         map_file = staging_dir + current_part_name + ".map"
@@ -204,13 +835,11 @@ class MapCreator:
         
         # read in the sea and land areas
         sea_path = self.landExtractor.sea_path(staging_dir + current_part_name)
-        osmosis_call += ['--rx','file=%s'%sea_path]
-        osmosis_call += ['--sort']
+        osmosis_call += land_reader(sea_path)
         osmosis_call += ['--merge']
 
         land_path = self.landExtractor.land_path(staging_dir + current_part_name)
-        osmosis_call += ['--rx','file=%s'%land_path]
-        osmosis_call += ['--sort']
+        osmosis_call += land_reader(land_path)
         osmosis_call += ['--merge']
 
         
@@ -218,6 +847,9 @@ class MapCreator:
         map_file_path = check_create_path(self.map_staging_path + map_file)        
         osmosis_call += ['--mw','file=%s'%map_file_path]
         osmosis_call += ['%s'%zoom_interval_conf]
+        storage_type, heap = self.map_writer_settings(source_pbf, staging_dir, current_part_name, area_filter, storage_type)
+        # the scheduler reserved the heap estimated when the task became ready
+        heap = self.map_heaps.pop(staging_dir + current_part_name, heap)
         osmosis_call += ['type=%s'%storage_type]
         osmosis_call += ['map-start-zoom=%s'%start_zoom]
         osmosis_call += ['preferred-languages=%s'%preferred_languages]
@@ -227,13 +859,29 @@ class MapCreator:
         if lat != None and lon != None:
             osmosis_call += ['map-start-position=%0.8f,%0.8f'%(lat,lon)]
                             
+        land_stream = None
+        stream_errors = []
+        if self.landExtractor.streams_land() and not self.dry_run:
+            land_stream = landextraction.LandStream(self.landExtractor, staging_dir + current_part_name, self.pbf_staging_path)
+
         #### CALL TO OSMOSIS #####
         logfile_path = check_create_path(self.logging_path + staging_dir + current_part_name + '.map.log')
         logfile = open(logfile_path,'a')
         try:
             self.logger.debug("calling: %s"," ".join(osmosis_call))
             if not self.dry_run:
-                subprocess.check_call(osmosis_call,stderr=logfile)
+                with instrumentation.stage(staging_dir + current_part_name, 'map write',
+                                           inputs=[source_pbf_path, sea_path, land_path], outputs=[map_file_path]):
+                    if land_stream:
+                        land_stream.start()
+                    try:
+                        # the named pipes of streamed land are only readable here
+                        self.executor.check_call(osmosis_call, logfile, heap, self.osmosis_environment(heap),
+                                                 inputs=[source_pbf_path, sea_path, land_path], outputs=[map_file_path],
+                                                 local=land_stream is not None)
+                    finally:
+                        if land_stream:
+                            stream_errors = land_stream.finish()
             else:
                 subprocess.check_call(['touch',map_file_path])
             logfile.close()
@@ -242,6 +890,9 @@ class MapCreator:
             raise ProcessingException("call to osmosis raised an error, see logs at %s for further details"%logfile_path)
         except OSError,e:
             raise ProcessingException("osmosis executable not found: %s"%e)             
+
+        if stream_errors:
+            raise ProcessingException("could not stream land and sea for %s: %s" % (map_file, "; ".join(stream_errors)))
         
         if not self.dry_run and PATH.getsize(map_file_path) == 0:
             raise ProcessingException("resulting map file size for %s is zero, keeping old map file" % map_file)
@@ -251,15 +902,34 @@ class MapCreator:
         self.logger.debug("calling: %s"," ".join(move_call))
         if not self.dry_run:
             try:
-                subprocess.check_call(move_call)
+                with instrumentation.stage(staging_dir + current_part_name, 'move', outputs=[map_file_target_path]):
+                    instrumentation.check_call(move_call)
             except:        
                 raise ProcessingException("could not move created map %s to target directory" % map_file)
+            if fingerprint:
+                self.manifest.record('map:' + target_dir + current_part_name + '.map', fingerprint, self.map_inputs.get(fingerprint))
+                self.manifest.save()
         
 def check_create_path(path):
     directory = PATH.dirname(path)
     if not PATH.exists(directory):
-        os.makedirs(directory)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # the directory may have been created concurrently by another task
+            if not PATH.isdir(directory):
+                raise
     return path
+def format_seconds(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+def land_reader(path):
+    '''
+    osmosis arguments reading a land or sea file, pbf files are already sorted
+    '''
+    if path.endswith('.pbf'):
+        return ['--rb', path]
+    return ['--rx', 'file=%s' % path, '--sort']
 def normalize_path(path):
     path = path.strip()
     if path and not path.endswith('/'):
@@ -275,7 +945,7 @@ def main():
     
     ######## SETUP OPTION PARSER AND READ COMMAND LINE ARGS ##########
     
-    usage = "usage: %prog -c CONFIGURATION_FILE [-d]"
+    usage = "usage: %prog -c CONFIGURATION_FILE [-d] [-j JOBS] [-r] [--changes CHANGES_FILE [--ignore-unlocated-changes]] [--plan] [--offline]"
     option_parser = OptionParser(usage,version='1.0')
     option_parser.add_option("-c", "--configuration-file", dest="configuration_file",
                              action='store',help="the path to the XML configuration file")
@@ -285,6 +955,27 @@ def main():
     option_parser.add_option("-l", "--logging-conf", dest="logging_config_file",
                              action='store', default='logging.conf',
                              help="path to the logging configuration [default=logging.conf]")
+    option_parser.add_option("-j", "--jobs", dest="jobs",
+                             action='store', type='int', default=1,
+                             help="number of osmosis calls to run concurrently [default=1]")
+    option_parser.add_option("-r", "--resume", dest="resume",
+                             action='store_true', default=False,
+                             help="continue the last run, only tasks that did not finish are run again [default=false]")
+    option_parser.add_option("--changes", dest="changes_file",
+                             action='store',
+                             help="only create the parts touched by the changes in this osm change file (.osc, .osc.gz) "
+                                  "or file of 'minlon,minlat,maxlon,maxlat' lines")
+    option_parser.add_option("--ignore-unlocated-changes", dest="ignore_unlocated_changes",
+                             action='store_true', default=False,
+                             help="changed ways and relations without changed nodes in the changes file do not mark "
+                                  "any part as changed, instead of all parts [default=false]")
+    option_parser.add_option("--plan", dest="plan",
+                             action='store_true', default=False,
+                             help="only print the estimated duration, memory and disk of all tasks and when they run "
+                                  "with the given number of jobs [default=false]")
+    option_parser.add_option("--offline", dest="offline",
+                             action='store_true', default=False,
+                             help="use the local copy of the land polygons without checking for a new version [default=false]")
     (options, args) = option_parser.parse_args()
            
     if len(args) != 0:
@@ -327,6 +1018,26 @@ def main():
     osmosis_path = root.get('osmosis-path',default='osmosis')
     land_simplification = root.get('land-simplification', 0)
     zoom_interval_conf = root.get('zoom-interval-conf',default='')
+    memory_budget = int(root.get('memory-budget', default=0))
+    disk_budget = int(root.get('staging-disk-budget', default=0))
+    jvm_heap = int(root.get('jvm-heap', default=0))
+    land_clip = root.get('land-clip', default='bbox')
+    land_format = root.get('land-format', default='osm')
+    land_polygons_url = root.get('land-polygons-url')
+    osmosis_worker = root.get('osmosis-worker')
+    if osmosis_worker:
+        osmosis_worker = shlex.split(osmosis_worker)
+    osmosis_worker_heap = int(root.get('osmosis-worker-heap', default=0))
+    if osmosis_worker and not osmosis_worker_heap:
+        sys.exit("osmosis-worker-heap must be set to the maximum heap of the osmosis workers")
+    build_nodes = root.get('build-nodes')
+    # the token is kept out of the configuration file
+    build_node_token = os.environ.get(buildnode.TOKEN_VARIABLE)
+    if build_nodes and not build_node_token and any(isinstance(node, executors.TcpNode)
+                                                    for node in executors.parse_nodes(build_nodes)):
+        sys.exit("the build nodes need the token set in the %s environment variable" % buildnode.TOKEN_VARIABLE)
+    auto_create_pbf = root.get('auto-create-pbf', 'false') == 'true'
+    extract_polygon_buffer = float(root.get('extract-polygon-buffer', default=0))
     if zoom_interval_conf != "":
         zoom_interval_conf = "zoom-interval-conf=" + zoom_interval_conf
 
@@ -362,11 +1073,37 @@ def main():
     
     ########### START PROCESSING ############
 
+    changed_area = None
+    if options.changes_file:
+        if not PATH.isfile(options.changes_file):
+            sys.exit("the changes file at '%s' could not be found" % options.changes_file)
+        changed_area = osmchange.read_changed_area(options.changes_file, options.ignore_unlocated_changes)
+
     logger.info("start creating maps from configuration at: '%s'", options.configuration_file)
     creator = MapCreator(full_osmosis_path,pbf_staging_path, map_staging_path, polygons_path,
                          initial_source_pbf, map_target_path, logging_path,
-                         default_start_zoom, default_preferred_languages, options.dry_run)
-    creator.evalPart(root, initial_source_pbf, '', '', zoom_interval_conf, land_simplification)                
+                         default_start_zoom, default_preferred_languages, options.dry_run or options.plan,
+                         memory_budget, jvm_heap, land_clip, land_format, changed_area, options.resume, disk_budget,
+                         land_polygons_url, options.offline, osmosis_worker, osmosis_worker_heap, build_nodes,
+                         extract_polygon_buffer, build_node_token)
+    # broken polygons fail the run before the first osmosis call
+    polygon_errors = creator.prepare_parts(root)
+    if polygon_errors:
+        for error in polygon_errors:
+            logger.error(error)
+        sys.exit("%d parts have missing or invalid polygons, no part was processed" % len(polygon_errors))
+    if auto_create_pbf:
+        creator.insert_pbf_extracts(root, initial_source_pbf)
+    if options.plan:
+        creator.print_schedule(root, initial_source_pbf, zoom_interval_conf, land_simplification, options.jobs)
+        return
+    if changed_area is not None:
+        creator.print_plan(root, initial_source_pbf, zoom_interval_conf, land_simplification)
+    # runs with a single job are scheduled as well, so they are recorded in the journal
+    try:
+        creator.evalPartParallel(root, initial_source_pbf, zoom_interval_conf, land_simplification, options.jobs)
+    except KeyboardInterrupt:
+        sys.exit("interrupted")
 
 def setup_logging(logging_path, dry_run):
     
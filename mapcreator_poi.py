@@ -22,22 +22,24 @@ logging.RotatingFileHandler = RotatingFileHandler
 logging.SMTPHandler = SMTPHandler
 import os
 import os.path as PATH
+import shlex
 import subprocess
 import sys
+import buildmanifest
+import costmodel
+import instrumentation
+import journal
 import landextraction
-import time
+import osmosisworker
+import scheduler
 
 
 # Added a few simple checks for both speedup and to avoid corruption:
-# Mapfiles that are created in the last 30 days are not recreated
+# Map, poi and pbf files are not recreated if their inputs did not change, see buildmanifest
 # Newly generated mapfiles will not overwrite old mapfiles if they are significantly smaller. 
 # This is to avoid a somewhat corrupted run to destroy an existing good file. 
 # All of this should be configurable, of course
 
-def file_is_new(path):
-    """returns true if the file has been modified in the last 30 days"""
-    return PATH.exists(path) and time.time() - PATH.getmtime(path) < (30 * 24 * 60 * 60)
-
 def can_overwrite_old_file(old, new):
     """returns true if the old file does not exist and the new file is not significantly smaller"""
     if not PATH.exists(old):
@@ -52,7 +54,8 @@ class MapCreator:
     classdocs
     '''
     def __init__(self, osmosis_path, pbf_staging_path, map_staging_path, poi_staging_path, polygons_path,
-                  initial_source_pbf, target_path, poi_target_path, logging_path, default_start_zoom, default_preferred_languages, dry_run=False):
+                  initial_source_pbf, target_path, poi_target_path, logging_path, default_start_zoom, default_preferred_languages, dry_run=False,
+                  land_polygons_url=None, offline=False, single_pass=False, memory_budget=0, jvm_heap=0, resume=False):
         '''
         Constructor
         '''
@@ -68,186 +71,552 @@ class MapCreator:
         self.default_start_zoom = default_start_zoom
         self.default_preferred_languages = default_preferred_languages 
         self.dry_run = dry_run
+        # memory in MB available to all concurrent osmosis calls and to a single call, 0 if not limited
+        self.memory_budget = memory_budget
+        self.jvm_heap = jvm_heap
+        # continue the run recorded in the task journal instead of starting a new one
+        self.resume = resume
+        # write the map and the poi file of a part in one osmosis call
+        self.single_pass = single_pass
+        # long running osmosis workers, set by main
+        self.osmosis_workers = None
         
         self.logger = logging.getLogger("mapcreator")
         self.landExtractor = landextraction.LandExtractor(self.pbf_staging_path, self.polygons_path, self.dry_run)
 
         self.logger.info("start downloading new land polygons")
-        self.landExtractor.download_land_polygons(self.pbf_staging_path)
-        
+        self.landExtractor.download_land_polygons(self.pbf_staging_path, land_polygons_url, offline)
+        # the heaps the map tasks were admitted with by part, passed on to their map writers
+        self.map_heaps = {}
 
-    def evalPart(self, subtree, source_pbf, staging_path, poi_staging_path, target_dir, poi_target_dir, zoom_interval_conf, land_simplification):
+        # fingerprints of the inputs of all created files, files with unchanged inputs are not created again
+        self.manifest = buildmanifest.BuildManifest(self.pbf_staging_path + 'build-manifest.json')
+        self.pbf_fingerprints = {}
+        self.osmosis_version_info = None
+        self.land_version_info = None
         
-        error_occurred = False
-        
-        for child in subtree:            
+
+    def current_part_names(self, subtree, source_pbf, staging_path, target_dir, poi_target_dir, zoom_interval_conf, land_simplification):
+        return set(child.get('name') for child in subtree
+                   if self.part_is_current(child, source_pbf, staging_path, target_dir, poi_target_dir, zoom_interval_conf, land_simplification))
+
+    def part_is_current(self, child, source_pbf, staging_path, target_dir, poi_target_dir, zoom_interval_conf, land_simplification):
+        '''
+        returns true if the map and poi files of the part and those of all its sub parts were created from unchanged inputs
+        '''
+        current_part_name = child.get('name')
+        (create_map, create_poi, create_pbf, defines_hierarchy, storage_type, map_start_zoom,
+         map_start_lat, map_start_lon, preferred_languages) = self.read_part_attributes(child)
+        area_filter = not(create_pbf or PATH.basename(source_pbf).startswith(current_part_name))
+
+        if create_pbf:
+            self.pbf_fingerprint(source_pbf, staging_path, current_part_name)
+            new_source_pbf = staging_path + current_part_name + '.osm.pbf'
+        else:
+            new_source_pbf = source_pbf
+
+        if create_map:
+            map_fingerprint = self.map_fingerprint(new_source_pbf, staging_path, current_part_name, area_filter, map_start_zoom, preferred_languages,
+                                                   zoom_interval_conf, storage_type, map_start_lat, map_start_lon, land_simplification)
+            if not self.output_is_current(self.target_path, 'map', target_dir + current_part_name + '.map', map_fingerprint):
+                return False
+
+        if create_poi:
+            poi_fingerprint = self.poi_fingerprint(new_source_pbf, staging_path, current_part_name, area_filter, preferred_languages)
+            if not self.output_is_current(self.poi_target_path, 'poi', poi_target_dir + current_part_name + '.poi', poi_fingerprint):
+                return False
+
+        if defines_hierarchy:
+            new_target_dir = target_dir + current_part_name + '/'
+            new_poi_target_dir = poi_target_dir + current_part_name + '/'
+        else:
+            new_target_dir = target_dir
+            new_poi_target_dir = poi_target_dir
+        new_staging_path = staging_path + current_part_name + '/'
+        return all(self.part_is_current(sub_part, new_source_pbf, new_staging_path, new_target_dir, new_poi_target_dir,
+                                        zoom_interval_conf, land_simplification)
+                   for sub_part in child)
+
+    def output_is_current(self, target_path, output_type, output_file, fingerprint):
+        return self.manifest.is_current(output_type + ':' + output_file, target_path + output_file, fingerprint)
+
+    def source_fingerprint(self, source_pbf):
+        '''
+        fingerprint of a source pbf, for pbfs created from the configuration the fingerprint of their inputs
+        '''
+        if source_pbf not in self.pbf_fingerprints:
+            source_pbf_path = self.pbf_staging_path + source_pbf
+            if not PATH.exists(source_pbf_path):
+                return None
+            self.pbf_fingerprints[source_pbf] = self.manifest.pbf_version(source_pbf_path)
+        return self.pbf_fingerprints[source_pbf]
+
+    def pbf_fingerprint(self, source_pbf, staging_dir, current_part_name):
+        fingerprint = buildmanifest.fingerprint('pbf', self.source_fingerprint(source_pbf),
+                                                self.polygon_digest(staging_dir + current_part_name), self.osmosis_version())
+        self.pbf_fingerprints[staging_dir + current_part_name + '.osm.pbf'] = fingerprint
+        return fingerprint
+
+    def map_fingerprint(self, source_pbf, staging_dir, current_part_name, area_filter, start_zoom, preferred_languages,
+                        zoom_interval_conf, storage_type, lat, lon, land_simplification):
+        return buildmanifest.fingerprint('map', self.source_fingerprint(source_pbf), self.polygon_digest(staging_dir + current_part_name),
+                                         area_filter, self.land_version(), land_simplification, self.landExtractor.clip_to_polygon,
+                                         zoom_interval_conf, preferred_languages, storage_type, start_zoom, lat, lon, self.osmosis_version())
+
+    def poi_fingerprint(self, source_pbf, staging_dir, current_part_name, area_filter, preferred_languages):
+        return buildmanifest.fingerprint('poi', self.source_fingerprint(source_pbf), self.polygon_digest(staging_dir + current_part_name),
+                                         area_filter, preferred_languages, self.osmosis_version())
+
+    def polygon_digest(self, region):
+        polygon_file_path = self.polygons_path + region + '.poly'
+        if not PATH.exists(polygon_file_path):
+            return None
+        return self.manifest.file_digest(polygon_file_path)
+
+    def land_version(self):
+        if self.land_version_info is None:
+            shapefile = self.landExtractor.land_polygon_shapefile(self.pbf_staging_path)
+            if PATH.exists(shapefile):
+                self.land_version_info = self.manifest.file_digest(shapefile)
+        return self.land_version_info
+
+    def osmosis_version(self):
+        if self.osmosis_version_info is None:
+            self.osmosis_version_info = buildmanifest.osmosis_version(self.osmosis_path)
+        return self.osmosis_version_info
+
+    def write_report(self):
+        '''
+        writes the timings and resource usage of all stages of the run to the logging path
+        '''
+        report = instrumentation.report()
+        try:
+            report.write_json(check_create_path(self.logging_path + 'run-report.json'))
+            report.write_csv(self.logging_path + 'run-report.csv')
+        except (IOError, OSError), e:
+            self.logger.warning("could not write run report: %s", e)
+
+    def read_part_attributes(self, child):
+        create_map = child.get('create-map', default='true') == 'true'
+        create_poi = child.get('create-poi', default='true') == 'true'
+        create_pbf = child.get('create-pbf', default='false') == 'true'
+        defines_hierarchy = child.get('defines-hierarchy', default='true') == 'true'
+        # None if the storage type should be chosen automatically
+        storage_type = child.get('type')
+        map_start_zoom = child.get('map-start-zoom', default=self.default_start_zoom)
+        # lat/lon maybe None
+        map_start_lat = child.get('map-start-lat')
+        map_start_lon = child.get('map-start-lon')
+        preferred_languages = child.get('preferred-languages', self.default_preferred_languages)
+        # if not None, convert lat/lon to float
+        if map_start_lat:
+            map_start_lat = float(map_start_lat)
+        if map_start_lon:
+            map_start_lon = float(map_start_lon)
+        return (create_map, create_poi, create_pbf, defines_hierarchy, storage_type, map_start_zoom,
+                map_start_lat, map_start_lon, preferred_languages)
+
+    def evalPartParallel(self, subtree, source_pbf, zoom_interval_conf, land_simplification, jobs):
+        '''
+        processes all parts of the configuration: the osmosis calls of the parts are scheduled as tasks
+        and independent calls run concurrently with the given number of jobs. the task states are recorded
+        in a journal in the logging path, so an interrupted run can be resumed
+        '''
+        task_journal = None
+        if not self.dry_run:
+            task_journal = journal.TaskJournal(check_create_path(self.logging_path + 'journal.sqlite'), self.resume)
+        part_scheduler = scheduler.PartScheduler(jobs, self.memory_budget, task_journal)
+        self.schedulePart(part_scheduler, subtree, None, source_pbf, '', '', '', '', zoom_interval_conf, land_simplification)
+        self.reserve_land_index(part_scheduler)
+        try:
+            return part_scheduler.run()
+        except KeyboardInterrupt:
+            if task_journal:
+                self.logger.error("the run was interrupted, run it again with --resume to continue it")
+            raise
+        finally:
+            self.landExtractor.land_index_listener = None
+            if task_journal:
+                task_journal.close()
+
+    def reserve_land_index(self, part_scheduler):
+        '''
+        the land polygon index is held by this process for the rest of the run once it is loaded,
+        so its memory is taken off the budget of the osmosis calls then
+        '''
+        def reserve(land_index):
+            memory = costmodel.land_index_memory(len(land_index.polygons), land_index.vertices)
+            self.logger.info("the land polygon index takes about %d MB of the memory budget", memory)
+            part_scheduler.reserve(memory)
+        self.landExtractor.land_index_listener = reserve
+        if self.landExtractor.land_index is not None:
+            reserve(self.landExtractor.land_index)
+
+    def schedulePart(self, part_scheduler, subtree, source_task, source_pbf, staging_path, poi_staging_path, target_dir, poi_target_dir, zoom_interval_conf, land_simplification):
+        '''
+        adds the tasks for all parts in the subtree to the scheduler, returns the added tasks.
+        a part waits for the task creating its source pbf. created pbfs are intermediate files of
+        the scheduler, they are removed once all tasks reading them succeeded.
+        '''
+        tasks = []
+
+        current_parts = self.current_part_names(subtree, source_pbf, staging_path, target_dir, poi_target_dir, zoom_interval_conf, land_simplification)
+
+        # one task creates the pbfs of all sibling parts, the per part tasks report its results
+        pbf_results = {}
+        pbf_part_names = [name for name in self.pbf_part_names(subtree) if name not in current_parts]
+        if pbf_part_names:
+            split_task = part_scheduler.add(staging_path + ':split',
+                                            self.split_action(source_pbf, staging_path, pbf_part_names, pbf_results),
+                                            [source_task], memory=costmodel.extract_heap(len(pbf_part_names)),
+                                            outputs=[self.pbf_staging_path + staging_path + name + '.osm.pbf' for name in pbf_part_names],
+                                            intermediate=True, inputs=[self.pbf_staging_path + source_pbf])
+            tasks.append(split_task)
+
+        for child in subtree:
             current_part_name = child.get('name')
-            self.logger.info("evaluating part '%s'", staging_path + current_part_name)
-            
-            # get attributes from xml element
-            create_map = child.get('create-map', default='true') == 'true'
-            create_poi = child.get('create-poi', default='true') == 'true'
-            create_pbf = child.get('create-pbf', default='false') == 'true'
-            defines_hierarchy = child.get('defines-hierarchy', default='true') == 'true'
-            storage_type = child.get('type',default='ram')
-            map_start_zoom = child.get('map-start-zoom', default=self.default_start_zoom)
-            # lat/lon maybe None
-            map_start_lat = child.get('map-start-lat')
-            map_start_lon = child.get('map-start-lon')
-            preferred_languages = child.get('preferred-languages', self.default_preferred_languages)
-            # if not None, convert lat/lon to float
-            if map_start_lat:
-                map_start_lat = float(map_start_lat)
-            if map_start_lon:
-                map_start_lon = float(map_start_lon)
-                
-            
-            # we do not need to filter the area during map creation if either a pbf was created (with a filter)
-            # or the source pbf equals the current part
+            if current_part_name in current_parts:
+                self.logger.info("part '%s' is up to date, skipping it and all sub parts", staging_path + current_part_name)
+                continue
+            self.logger.info("scheduling part '%s'", staging_path + current_part_name)
+
+            (create_map, create_poi, create_pbf, defines_hierarchy, storage_type, map_start_zoom,
+             map_start_lat, map_start_lon, preferred_languages) = self.read_part_attributes(child)
+
             area_filter = not(create_pbf or PATH.basename(source_pbf).startswith(current_part_name))
-                
-            if create_pbf: 
-                # create pbf
-                try:        
-                    # the new source pbf for the subtree and this child is the newly created one
-                    new_source_pbf = self.call_create_pbf(source_pbf, staging_path, current_part_name)                                        
-                except ProcessingException, e:
-                    error_occurred = True
-                    self.logger.warning("%s, skipping all sub parts", str(e))
-                    #print "an error occurred while creating pbf for '%s', no further processing of sub-parts will take part, error message: %s" % (current_part_name, e)
-                    # we need to skip processing of sub parts
-                    continue                
+
+            subtree_tasks = []
+            if create_pbf:
+                new_source_pbf = staging_path + current_part_name + '.osm.pbf'
+                pbf_task = part_scheduler.add(staging_path + current_part_name + '.osm.pbf',
+                                              self.pbf_action(pbf_results, current_part_name, self.pbf_staging_path + new_source_pbf),
+                                              [split_task], outputs=[self.pbf_staging_path + new_source_pbf])
+                new_source_task = pbf_task
+                subtree_tasks.append(pbf_task)
             else:
-                # we didn't create a new pbf, so the new source pbf is the old one
                 new_source_pbf = source_pbf
-                
-            if create_map:
-                self.landExtractor.make_sea_polygon_file(staging_path + current_part_name)
-                self.landExtractor.extract_land_polygons(staging_path + current_part_name, self.pbf_staging_path, land_simplification)
-                try:
-                    self.call_create_map(new_source_pbf, staging_path, target_dir, current_part_name, area_filter, map_start_zoom, preferred_languages, zoom_interval_conf, storage_type, map_start_lat, map_start_lon)
-                except ProcessingException, e:
-                    error_occurred = True
-                    self.logger.warning("%s", str(e))
-                    #print "an error occurred while creating map for '%s', error message: %s" % (current_part_name, e)
-                    # errors while creating the map file do not harm any sub parts
-                    # continue with processing sub parts
+                new_source_task = source_task
 
+            if create_map:
+                map_fingerprint = self.map_fingerprint(new_source_pbf, staging_path, current_part_name, area_filter, map_start_zoom, preferred_languages,
+                                                       zoom_interval_conf, storage_type, map_start_lat, map_start_lon, land_simplification)
+                if self.output_is_current(self.target_path, 'map', target_dir + current_part_name + '.map', map_fingerprint):
+                    self.logger.info("map '%s' is up to date", target_dir + current_part_name)
+                    create_map = False
             if create_poi:
-                try:
-                    self.call_create_poi(new_source_pbf, poi_staging_path, poi_target_dir, current_part_name, area_filter, preferred_languages)
-                except ProcessingException, e:
-                    error_occurred = True
-                    self.logger.warning("%s", str(e))
-                    #print "an error occurred while creating map for '%s', error message: %s" % (current_part_name, e)
-                    # errors while creating the map file do not harm any sub parts
-                    # continue with processing sub parts
-
-            
+                poi_fingerprint = self.poi_fingerprint(new_source_pbf, staging_path, current_part_name, area_filter, preferred_languages)
+                if self.output_is_current(self.poi_target_path, 'poi', poi_target_dir + current_part_name + '.poi', poi_fingerprint):
+                    self.logger.info("poi '%s' is up to date", poi_target_dir + current_part_name)
+                    create_poi = False
+
+            single_pass = self.single_pass and create_map and create_poi
+            map_memory = self.map_memory_estimate(new_source_pbf, staging_path, current_part_name, area_filter, storage_type)
+            if single_pass:
+                subtree_tasks.append(part_scheduler.add(staging_path + current_part_name + '.map+poi',
+                                                        self.map_poi_action(new_source_pbf, staging_path, target_dir, poi_staging_path, poi_target_dir,
+                                                                            current_part_name, area_filter, map_start_zoom, preferred_languages,
+                                                                            zoom_interval_conf, storage_type, map_start_lat, map_start_lon,
+                                                                            land_simplification, map_fingerprint, poi_fingerprint),
+                                                        [new_source_task], memory=map_memory, inputs=[self.pbf_staging_path + new_source_pbf],
+                                                        outputs=[self.target_path + target_dir + current_part_name + '.map',
+                                                                 self.poi_target_path + poi_target_dir + current_part_name + '.poi']))
+            if create_map and not single_pass:
+                subtree_tasks.append(part_scheduler.add(staging_path + current_part_name + '.map',
+                                                        self.map_action(new_source_pbf, staging_path, target_dir, current_part_name, area_filter,
+                                                                        map_start_zoom, preferred_languages, zoom_interval_conf, storage_type,
+                                                                        map_start_lat, map_start_lon, land_simplification, map_fingerprint),
+                                                        [new_source_task], memory=map_memory, inputs=[self.pbf_staging_path + new_source_pbf],
+                                                        outputs=[self.target_path + target_dir + current_part_name + '.map']))
+
+            if create_poi and not single_pass:
+                subtree_tasks.append(part_scheduler.add(poi_staging_path + current_part_name + '.poi',
+                                                        self.poi_action(new_source_pbf, poi_staging_path, poi_target_dir, current_part_name,
+                                                                        area_filter, preferred_languages, poi_fingerprint),
+                                                        [new_source_task], inputs=[self.pbf_staging_path + new_source_pbf],
+                                                        outputs=[self.poi_target_path + poi_target_dir + current_part_name + '.poi']))
+
             if defines_hierarchy:
-                # this part defines a new level in the output hierarchy
                 new_target_dir = target_dir + child.get('name') + '/'
                 new_poi_target_dir = poi_target_dir + child.get('name') + '/'
             else:
-                new_target_dir = target_dir;
-                new_poi_target_dir =poi_target_dir;
-        
+                new_target_dir = target_dir
+                new_poi_target_dir = poi_target_dir
+
             new_staging_path = staging_path + child.get('name') + '/'
             new_poi_staging_path = poi_staging_path + child.get('name') + '/'
-            
-            #### RECURSION         
-            subpart_error = self.evalPart(child, new_source_pbf, new_staging_path, new_poi_staging_path, new_target_dir, new_poi_target_dir, zoom_interval_conf, land_simplification)
-            error_occurred = subpart_error or error_occurred
-            
-            # clean up files
-            pbf_file_path = self.pbf_staging_path+new_source_pbf
-            if create_pbf and PATH.exists(pbf_file_path):
-                if not error_occurred:
-                    self.logger.debug("removing pbf file %s",pbf_file_path)
-                    os.remove(pbf_file_path)
-                else:
-                    self.logger.debug("error occurred in sub part, keeping pbf file %s",pbf_file_path)
-                
-        return error_occurred
-                
-    
-    def call_create_pbf(self, source_pbf, staging_dir, current_part_name):
-        
-        # set the path to the pbf file
-        target_pbf = staging_dir + current_part_name + '.osm.pbf'
-        target_pbf_path = check_create_path(self.pbf_staging_path+target_pbf)
-        if file_is_new(target_pbf_path):
-            return target_pbf
-       
+
+            #### RECURSION
+            subtree_tasks += self.schedulePart(part_scheduler, child, new_source_task, new_source_pbf, new_staging_path, new_poi_staging_path,
+                                               new_target_dir, new_poi_target_dir, zoom_interval_conf, land_simplification)
+
+            if create_map:
+                subtree_tasks.append(part_scheduler.add(staging_path + current_part_name + '.release',
+                                                        self.release_land_action(staging_path + current_part_name),
+                                                        subtree_tasks, always_run=True))
+
+            tasks += subtree_tasks
+
+        return tasks
+
+    def split_action(self, source_pbf, staging_dir, part_names, pbf_results):
+        def action():
+            pbf_results.update(self.call_create_pbfs(source_pbf, staging_dir, part_names))
+        return action
+
+    def pbf_action(self, pbf_results, current_part_name, pbf_path):
+        def action():
+            try:
+                if current_part_name not in pbf_results:
+                    # the split was done by the resumed run, its pbfs are only used if they are complete
+                    if not PATH.exists(pbf_path) or not journal.is_complete(pbf_path):
+                        raise ProcessingException("the pbf %s of the resumed run is missing or incomplete" % pbf_path)
+                elif isinstance(pbf_results[current_part_name], ProcessingException):
+                    raise pbf_results[current_part_name]
+            except ProcessingException, e:
+                self.logger.warning("%s, skipping all sub parts", str(e))
+                raise
+        return action
+
+    def map_action(self, source_pbf, staging_dir, target_dir, current_part_name, area_filter, start_zoom, preferred_languages,
+                   zoom_interval_conf, storage_type, lat, lon, land_simplification, fingerprint):
+        def action():
+            self.landExtractor.make_sea_polygon_file(staging_dir + current_part_name)
+            self.landExtractor.extract_land_polygons(staging_dir + current_part_name, self.pbf_staging_path, land_simplification)
+            try:
+                self.call_create_map(source_pbf, staging_dir, target_dir, current_part_name, area_filter, start_zoom,
+                                     preferred_languages, zoom_interval_conf, storage_type, lat, lon, fingerprint)
+            except ProcessingException, e:
+                self.logger.warning("%s", str(e))
+                raise
+        return action
+
+    def map_poi_action(self, source_pbf, staging_dir, target_dir, poi_staging_dir, poi_target_dir, current_part_name, area_filter, start_zoom,
+                       preferred_languages, zoom_interval_conf, storage_type, lat, lon, land_simplification, map_fingerprint, poi_fingerprint):
+        def action():
+            self.landExtractor.make_sea_polygon_file(staging_dir + current_part_name)
+            self.landExtractor.extract_land_polygons(staging_dir + current_part_name, self.pbf_staging_path, land_simplification)
+            try:
+                self.call_create_map_poi(source_pbf, staging_dir, target_dir, poi_staging_dir, poi_target_dir, current_part_name, area_filter,
+                                         start_zoom, preferred_languages, zoom_interval_conf, storage_type, lat, lon, map_fingerprint, poi_fingerprint)
+            except ProcessingException, e:
+                self.logger.warning("%s", str(e))
+                raise
+        return action
+
+    def release_land_action(self, region):
+        def action():
+            self.landExtractor.release_clipped_land(region)
+        return action
+
+    def poi_action(self, source_pbf, poi_staging_dir, poi_target_dir, current_part_name, area_filter, preferred_languages, fingerprint):
+        def action():
+            try:
+                self.call_create_poi(source_pbf, poi_staging_dir, poi_target_dir, current_part_name, area_filter, preferred_languages, fingerprint)
+            except ProcessingException, e:
+                self.logger.warning("%s", str(e))
+                raise
+        return action
+
+    def pbf_part_names(self, subtree):
+        return [child.get('name') for child in subtree if self.read_part_attributes(child)[2]]
+
+    def call_create_pbfs(self, source_pbf, staging_dir, part_names):
+        '''
+        creates the pbf files of several parts from the same source pbf with a single osmosis call,
+        the source is read once and teed into one bounding polygon filter per part.
+        returns a dict mapping each part name to its pbf file or to the ProcessingException for the part
+        '''
+        results = {}
+        pending = []
+        for current_part_name in part_names:
+            # set the path to the pbf file
+            target_pbf = staging_dir + current_part_name + '.osm.pbf'
+            target_pbf_path = check_create_path(self.pbf_staging_path+target_pbf)
+            fingerprint = self.pbf_fingerprint(source_pbf, staging_dir, current_part_name)
+            if self.output_is_current(self.pbf_staging_path, 'pbf', target_pbf, fingerprint):
+                self.logger.info("the pbf file %s is up to date, using the existing one", target_pbf)
+                results[current_part_name] = target_pbf
+                continue
+
+            polygons_path = self.polygons_path + staging_dir + current_part_name+'.poly'
+            if not PATH.exists(polygons_path):
+                results[current_part_name] = ProcessingException('cannot create pbf %s , polygon is missing: %s' % (target_pbf, polygons_path))
+                continue
+            pending.append((current_part_name, target_pbf, target_pbf_path, polygons_path, fingerprint))
+
+        if not pending:
+            return results
+
         # check whether source pbf exists and has non-zero size (irrelevant for dry run)
         source_pbf_path = self.pbf_staging_path + source_pbf
         if not self.dry_run:
+            error = None
             if not PATH.exists(source_pbf_path):
-                raise ProcessingException('cannot create %s, source pbf is missing: %s' % (target_pbf,source_pbf_path))
-            if PATH.getsize(source_pbf_path) == 0:
-                raise ProcessingException('cannot create %s, source pbf is empty: %s' % (target_pbf,source_pbf_path))
-    
-        polygons_path = self.polygons_path + staging_dir + current_part_name+'.poly'
-        if not PATH.exists(polygons_path):
-            raise ProcessingException('cannot create pbf %s , polygon is missing: %s' % (target_pbf, polygons_path))
-        
-        
-        
-          
+                error = 'source pbf is missing'
+            elif PATH.getsize(source_pbf_path) == 0:
+                error = 'source pbf is empty'
+            if error:
+                for p in pending:
+                    results[p[0]] = ProcessingException('cannot create %s, %s: %s' % (p[1], error, source_pbf_path))
+                return results
+
         osmosis_call = [self.osmosis_path, '--rb',source_pbf_path]
-        osmosis_call += ['--bp','completeWays=yes','completeRelations=yes','clipIncompleteEntities=false','file=%s'%polygons_path]
-        osmosis_call += ['--wb','omitmetadata=false','compress=deflate','file=%s'%target_pbf_path]
-        logfile_path = check_create_path(self.logging_path + staging_dir + current_part_name + '.pbf.log')
+        if len(pending) > 1:
+            osmosis_call += ['--tee', str(len(pending))]
+        for p in pending:
+            osmosis_call += ['--bp','completeWays=yes','completeRelations=yes','clipIncompleteEntities=false','file=%s'%p[3]]
+            osmosis_call += ['--wb','omitmetadata=false','compress=deflate','file=%s'%p[2]]
+
+        if len(pending) == 1:
+            logfile_path = check_create_path(self.logging_path + staging_dir + pending[0][0] + '.pbf.log')
+        else:
+            logfile_path = check_create_path(self.logging_path + staging_dir + 'split.pbf.log')
         logfile = open(logfile_path,'a')
         try:
             self.logger.debug("calling: %s"," ".join(osmosis_call))
             if not self.dry_run:
-                subprocess.check_call(osmosis_call,stderr=logfile)
+                # the extract is a stage of the part whose sub parts are extracted
+                with instrumentation.stage(staging_dir.rstrip('/'), instrumentation.PBF_STAGE,
+                                           inputs=[source_pbf_path], outputs=[p[2] for p in pending]):
+                    heap = self.worker_heap(costmodel.extract_heap(len(pending)))
+                    osmosisworker.check_call(self.osmosis_workers, osmosis_call, logfile, heap, self.osmosis_environment(heap))
             else:
-                subprocess.check_call(['touch',target_pbf_path])
+                subprocess.check_call(['touch'] + [p[2] for p in pending])
             logfile.close()
-            
-            if not self.dry_run and PATH.getsize(target_pbf_path) == 0:
-                raise ProcessingException('error creating %s, resulting pbf is empty' % (target_pbf_path))
-            
-            return target_pbf
         except CalledProcessError:
             logfile.close()
-            raise ProcessingException("call to osmosis raised an error, see logs at %s for further details"%logfile_path)
+            error = ProcessingException("call to osmosis raised an error, see logs at %s for further details"%logfile_path)
+            for p in pending:
+                # an incomplete pbf would otherwise be reused by the next run
+                if PATH.exists(p[2]):
+                    os.remove(p[2])
+                results[p[0]] = error
+            return results
         except OSError,e:
-            raise ProcessingException("osmosis executable not found: %s"%e)
+            logfile.close()
+            error = ProcessingException("osmosis executable not found: %s"%e)
+            for p in pending:
+                results[p[0]] = error
+            return results
+
+        for (current_part_name, target_pbf, target_pbf_path, polygons_path, fingerprint) in pending:
+            if not self.dry_run and PATH.getsize(target_pbf_path) == 0:
+                results[current_part_name] = ProcessingException('error creating %s, resulting pbf is empty' % (target_pbf_path))
+            else:
+                results[current_part_name] = target_pbf
+                if not self.dry_run:
+                    self.manifest.record('pbf:' + target_pbf, fingerprint)
+        self.manifest.save()
+        return results
     
-    def call_create_map(self, source_pbf, staging_dir, target_dir, current_part_name, area_filter, start_zoom,preferred_languages, zoom_interval_conf, storage_type='ram', lat=None,lon=None):
+    def call_create_map(self, source_pbf, staging_dir, target_dir, current_part_name, area_filter, start_zoom,preferred_languages, zoom_interval_conf, storage_type=None, lat=None,lon=None, fingerprint=None):
         
         # set the path to the map file
         map_file = staging_dir + current_part_name + ".map"
+        map_file_target_path = check_create_path(self.target_path + target_dir+current_part_name + '.map')   
+
+        (osmosis_call, source_pbf_path) = self.source_call(source_pbf, staging_dir, current_part_name, area_filter, 'map ' + map_file)
+        (storage_type, heap) = self.admitted_map_writer(source_pbf, staging_dir, current_part_name, area_filter, storage_type)
+        (map_call, map_file_path, land_inputs) = self.map_writer_call(staging_dir, current_part_name, start_zoom, preferred_languages,
+                                                                      zoom_interval_conf, storage_type, lat, lon)
+        osmosis_call += map_call
+
+        #### CALL TO OSMOSIS #####
+        self.run_osmosis(osmosis_call, staging_dir + current_part_name + '.map.log', staging_dir + current_part_name, 'map write',
+                         [source_pbf_path] + land_inputs, [map_file_path], heap)
+
+        self.install_output(map_file_path, map_file_target_path, staging_dir + current_part_name, 'map',
+                            'map:' + target_dir + current_part_name + '.map', fingerprint)
+
+    def call_create_poi(self, source_pbf, poi_staging_dir, poi_target_dir, current_part_name, area_filter, preferred_languages, fingerprint=None):
         
-        # check whether source pbf exists and has non-zero size (irrelevant for dry run)
-        source_pbf_path = self.pbf_staging_path + source_pbf
+        # set the path to the map file
+        poi_file = poi_staging_dir + current_part_name + ".poi"
+        poi_file_target_path = check_create_path(self.poi_target_path + poi_target_dir+current_part_name + '.poi')                
+        
+        (osmosis_call, source_pbf_path) = self.source_call(source_pbf, poi_staging_dir, current_part_name, area_filter, 'poi ' + poi_file)
+        (poi_call, poi_file_path) = self.poi_writer_call(poi_staging_dir, current_part_name)
+        osmosis_call += poi_call
 
-        map_file_target_path = check_create_path(self.target_path + target_dir+current_part_name + '.map')   
-        if file_is_new(map_file_target_path):
-            return
+        #### CALL TO OSMOSIS #####
+        self.run_osmosis(osmosis_call, poi_staging_dir + current_part_name + '.poi.log', poi_staging_dir + current_part_name, 'poi write',
+                         [source_pbf_path], [poi_file_path])
+
+        self.install_output(poi_file_path, poi_file_target_path, poi_staging_dir + current_part_name, 'poi',
+                            'poi:' + poi_target_dir + current_part_name + '.poi', fingerprint)
 
+    def call_create_map_poi(self, source_pbf, staging_dir, target_dir, poi_staging_dir, poi_target_dir, current_part_name, area_filter,
+                            start_zoom, preferred_languages, zoom_interval_conf, storage_type=None, lat=None, lon=None,
+                            map_fingerprint=None, poi_fingerprint=None):
+        '''
+        creates the map and the poi file of a part in a single osmosis call, the source pbf is read and filtered by
+        the polygon once and teed into the map writer and the poi writer
+        '''
+        map_file = staging_dir + current_part_name + ".map"
+        map_file_target_path = check_create_path(self.target_path + target_dir + current_part_name + '.map')
+        poi_file_target_path = check_create_path(self.poi_target_path + poi_target_dir + current_part_name + '.poi')
+
+        (osmosis_call, source_pbf_path) = self.source_call(source_pbf, staging_dir, current_part_name, area_filter, 'map and poi ' + map_file)
+        (storage_type, heap) = self.admitted_map_writer(source_pbf, staging_dir, current_part_name, area_filter, storage_type)
+        (map_call, map_file_path, land_inputs) = self.map_writer_call(staging_dir, current_part_name, start_zoom, preferred_languages,
+                                                                      zoom_interval_conf, storage_type, lat, lon, 'map')
+        (poi_call, poi_file_path) = self.poi_writer_call(poi_staging_dir, current_part_name, 'poi')
+        # the outputs of the tee are named, so the map writer pipeline and the poi writer do not
+        # depend on the order osmosis connects default pipes in
+        osmosis_call += ['--tee', '2', 'outPipe.0=map', 'outPipe.1=poi'] + map_call + poi_call
+
+        #### CALL TO OSMOSIS #####
+        self.run_osmosis(osmosis_call, staging_dir + current_part_name + '.map-poi.log', staging_dir + current_part_name, 'map poi write',
+                         [source_pbf_path] + land_inputs, [map_file_path, poi_file_path], heap)
+
+        # the map and the poi file are installed independently, a small map does not keep a good poi file from being installed
+        errors = []
+        for (file_path, target_path, output_type, key, fingerprint) in [
+                (map_file_path, map_file_target_path, 'map', 'map:' + target_dir + current_part_name + '.map', map_fingerprint),
+                (poi_file_path, poi_file_target_path, 'poi', 'poi:' + poi_target_dir + current_part_name + '.poi', poi_fingerprint)]:
+            try:
+                self.install_output(file_path, target_path, staging_dir + current_part_name, output_type, key, fingerprint)
+            except ProcessingException, e:
+                errors.append(str(e))
+        if errors:
+            raise ProcessingException(", ".join(errors))
+
+    def source_call(self, source_pbf, staging_dir, current_part_name, area_filter, output_name):
+        '''
+        the start of an osmosis call reading the source pbf, filtered by the polygon of the part if area_filter
+        is set. returns the call and the path of the source pbf
+        '''
+        # check whether source pbf exists and has non-zero size (irrelevant for dry run)
+        source_pbf_path = self.pbf_staging_path + source_pbf
         if not self.dry_run:
             if not PATH.exists(source_pbf_path):
-                raise ProcessingException('cannot create map %s, source pbf is missing: %s' % (map_file,source_pbf_path))
+                raise ProcessingException('cannot create %s, source pbf is missing: %s' % (output_name,source_pbf_path))
             if PATH.getsize(source_pbf_path) == 0:
-                raise ProcessingException('cannot create map %s, source pbf is empty: %s' % (map_file,source_pbf_path))            
+                raise ProcessingException('cannot create %s, source pbf is empty: %s' % (output_name,source_pbf_path))            
         
         osmosis_call = [self.osmosis_path,'--rb', source_pbf_path]
         
         if area_filter:
             polygon_file_path = self.polygons_path+ staging_dir+current_part_name + '.poly'
             if not PATH.exists(polygon_file_path):
-                raise ProcessingException('cannot create map %s, polygon is missing: %s' % (map_file, polygon_file_path))
+                raise ProcessingException('cannot create %s, polygon is missing: %s' % (output_name, polygon_file_path))
             osmosis_call += ['--bp','completeWays=yes','completeRelations=yes','clipIncompleteEntities=false','file=%s'%polygon_file_path]
-        
+        return (osmosis_call, source_pbf_path)
+
+    def map_writer_call(self, staging_dir, current_part_name, start_zoom, preferred_languages, zoom_interval_conf, storage_type, lat, lon,
+                        input_pipe=None):
+        '''
+        the osmosis tasks merging the sea and land into the data and writing the map file,
+        returns them with the path of the map file and the paths of the sea and land files.
+        the data is read from the named input pipe if one is given, otherwise from the default pipe
+        '''
         # read in the sea and land areas
         sea_path = self.landExtractor.sea_path(staging_dir + current_part_name)
-        osmosis_call += ['--rx','file=%s'%sea_path]
+        osmosis_call = ['--rx','file=%s'%sea_path]
         osmosis_call += ['--sort']
         osmosis_call += ['--merge']
+        if input_pipe:
+            osmosis_call += ['inPipe.0=%s'%input_pipe]
 
         land_path = self.landExtractor.land_path(staging_dir + current_part_name)
         osmosis_call += ['--rx','file=%s'%land_path]
@@ -256,7 +625,7 @@ class MapCreator:
 
         
         # construct complete path from relative path
-        map_file_path = check_create_path(self.map_staging_path + map_file)        
+        map_file_path = check_create_path(self.map_staging_path + staging_dir + current_part_name + ".map")        
         osmosis_call += ['--mw','file=%s'%map_file_path]
         osmosis_call += ['%s'%zoom_interval_conf]
         osmosis_call += ['type=%s'%storage_type]
@@ -267,108 +636,136 @@ class MapCreator:
 
         if lat != None and lon != None:
             osmosis_call += ['map-start-position=%0.8f,%0.8f'%(lat,lon)]
-                            
-        #### CALL TO OSMOSIS #####
-        logfile_path = check_create_path(self.logging_path + staging_dir + current_part_name + '.map.log')
-        logfile = open(logfile_path,'a')
-        try:
-            self.logger.debug("calling: %s"," ".join(osmosis_call))
-            if not self.dry_run:
-                subprocess.check_call(osmosis_call,stderr=logfile)
-            else:
-                subprocess.check_call(['touch',map_file_path])
-            logfile.close()
-        except CalledProcessError:
-            logfile.close()        
-            raise ProcessingException("call to osmosis raised an error, see logs at %s for further details"%logfile_path)
-        except OSError,e:
-            raise ProcessingException("osmosis executable not found: %s"%e)             
-        
-        if not self.dry_run and PATH.getsize(map_file_path) == 0:
-            raise ProcessingException("resulting map file size for %s is zero, keeping old map file" % map_file)
-        
-        if not can_overwrite_old_file(map_file_target_path, map_file_path):
-            return
-        move_call = ["mv",map_file_path, map_file_target_path]
-        self.logger.debug("calling: %s"," ".join(move_call))
-        if not self.dry_run:
-            try:
-                subprocess.check_call(move_call)
-            except:        
-                raise ProcessingException("could not move created map %s to target directory" % map_file)
-        
-
-    def call_create_poi(self, source_pbf, poi_staging_dir, poi_target_dir, current_part_name, area_filter, preferred_languages):
-        
-        # set the path to the map file
-        poi_file = poi_staging_dir + current_part_name + ".poi"
+        return (osmosis_call, map_file_path, [sea_path, land_path])
 
-        poi_file_target_path = check_create_path(self.poi_target_path + poi_target_dir+current_part_name + '.poi')                
-        if file_is_new(poi_file_target_path):
-            return
-        
-        # check whether source pbf exists and has non-zero size (irrelevant for dry run)
-        source_pbf_path = self.pbf_staging_path + source_pbf
-        if not self.dry_run:
-            if not PATH.exists(source_pbf_path):
-                raise ProcessingException('cannot create map %s, source pbf is missing: %s' % (map_file,source_pbf_path))
-            if PATH.getsize(source_pbf_path) == 0:
-                raise ProcessingException('cannot create map %s, source pbf is empty: %s' % (map_file,source_pbf_path))            
-        
-        osmosis_call = [self.osmosis_path,'--rb', source_pbf_path]
-        
-        if area_filter:
-            polygon_file_path = self.polygons_path+ poi_staging_dir+current_part_name + '.poly'
-            if not PATH.exists(polygon_file_path):
-                raise ProcessingException('cannot create poi %s, polygon is missing: %s' % (poi_file, polygon_file_path))
-            osmosis_call += ['--bp','completeWays=yes','completeRelations=yes','clipIncompleteEntities=false','file=%s'%polygon_file_path]
-                
+    def poi_writer_call(self, poi_staging_dir, current_part_name, input_pipe=None):
+        '''
+        the osmosis task writing the poi file, returns it with the path of the poi file.
+        the data is read from the named input pipe if one is given, otherwise from the default pipe
+        '''
         # construct complete path from relative path
-        poi_file_path = check_create_path(self.poi_staging_path + poi_file)        
+        poi_file_path = check_create_path(self.poi_staging_path + poi_staging_dir + current_part_name + ".poi")        
 #        osmosis_call += ['--pw','file=%s'%poi_file_path,'preferred-language=en','ways=true','all-tags=false']
-        osmosis_call += ['--pw','file=%s'%poi_file_path]
+        osmosis_call = ['--pw','file=%s'%poi_file_path]
+        if input_pipe:
+            osmosis_call += ['inPipe.0=%s'%input_pipe]
 #        osmosis_call += ['--pw','file=%s'%poi_file_path,'ways=true','all-tags=false']
         #osmosis_call += ['preferred-languages=%s'%preferred_languages]
         bbox = self.landExtractor.region_bbox(poi_staging_dir + current_part_name)
         osmosis_call += ['bbox=%s,%s,%s,%s'%(str(bbox[1]), str(bbox[0]),str(bbox[3]),str(bbox[2]))]
+        return (osmosis_call, poi_file_path)
 
-                            
-        #### CALL TO OSMOSIS #####
-        logfile_path = check_create_path(self.logging_path + poi_staging_dir + current_part_name + '.poi.log')
+    def map_memory_estimate(self, source_pbf, staging_dir, current_part_name, area_filter, storage_type):
+        def estimate():
+            heap = self.map_writer_settings(source_pbf, staging_dir, current_part_name, area_filter, storage_type)[1]
+            self.map_heaps[staging_dir + current_part_name] = heap
+            return heap
+        return estimate
+
+    def admitted_map_writer(self, source_pbf, staging_dir, current_part_name, area_filter, storage_type):
+        '''
+        returns storage type and heap in MB for the map writer of a part, the heap is the one the
+        scheduler admitted the task with if it was estimated when the task became ready
+        '''
+        (storage_type, heap) = self.map_writer_settings(source_pbf, staging_dir, current_part_name, area_filter, storage_type)
+        return (storage_type, self.map_heaps.pop(staging_dir + current_part_name, heap))
+
+    def map_writer_settings(self, source_pbf, staging_dir, current_part_name, area_filter, storage_type=None):
+        '''
+        returns storage type and heap in MB for the map writer, the storage type is chosen
+        from the estimated size of the part's data if it is not configured
+        '''
+        input_size = costmodel.pbf_size(self.pbf_staging_path + source_pbf)
+        if area_filter:
+            input_size = costmodel.part_input_size(input_size, self.source_area(source_pbf),
+                                                   self.landExtractor.region_area(staging_dir + current_part_name))
+        max_heap = self.jvm_heap or self.memory_budget or costmodel.physical_memory()
+        return costmodel.choose_map_writer(input_size, max_heap, storage_type)
+
+    def source_area(self, source_pbf):
+        '''
+        area of the polygon a source pbf was extracted with, None if unknown
+        '''
+        area = None
+        if source_pbf.endswith('.osm.pbf'):
+            area = self.landExtractor.region_area(source_pbf[:-len('.osm.pbf')])
+        if area is None and source_pbf == self.initial_source_pbf:
+            # the initial source pbf without a polygon is the planet
+            area = costmodel.WORLD_AREA
+        return area
+
+    def worker_heap(self, heap):
+        '''
+        the heap an osmosis call is limited to, without a per-job heap or a memory budget
+        the JVM takes its default heap and any worker can run the call
+        '''
+        if self.jvm_heap or self.memory_budget:
+            return heap
+        return 0
+
+    def osmosis_environment(self, heap):
+        '''
+        environment for an osmosis call with the given maximum heap in MB, no heap is set for 0
+        '''
+        env = dict(os.environ)
+        if heap:
+            env['JAVACMD_OPTIONS'] = (env.get('JAVACMD_OPTIONS', '') + ' -Xmx%dm' % heap).strip()
+        return env
+
+    def run_osmosis(self, osmosis_call, log_name, part, stage_name, inputs, outputs, heap=0):
+        '''
+        runs an osmosis call logging to the log file of the given name, in a dry run only the outputs are created.
+        heap is the maximum heap in MB the call was admitted with, 0 if unknown
+        '''
+        heap = self.worker_heap(heap)
+        logfile_path = check_create_path(self.logging_path + log_name)
         logfile = open(logfile_path,'a')
         try:
-            self.logger.warning("calling: %s"," ".join(osmosis_call))
+            self.logger.debug("calling: %s"," ".join(osmosis_call))
             if not self.dry_run:
-                subprocess.check_call(osmosis_call,stderr=logfile)
+                with instrumentation.stage(part, stage_name, inputs=inputs, outputs=outputs):
+                    osmosisworker.check_call(self.osmosis_workers, osmosis_call, logfile, heap, self.osmosis_environment(heap))
             else:
-                subprocess.check_call(['touch',map_file_path])
+                subprocess.check_call(['touch'] + outputs)
             logfile.close()
         except CalledProcessError:
             logfile.close()        
             raise ProcessingException("call to osmosis raised an error, see logs at %s for further details"%logfile_path)
         except OSError,e:
             raise ProcessingException("osmosis executable not found: %s"%e)             
+
+    def install_output(self, file_path, target_path, part, output_type, manifest_key, fingerprint):
+        '''
+        moves a created map or poi file to its target path unless it is empty or much smaller than the old one
+        '''
+        if not self.dry_run and PATH.getsize(file_path) == 0:
+            raise ProcessingException("resulting %s file size for %s is zero, keeping old %s file" % (output_type, file_path, output_type))
         
-        if not self.dry_run and PATH.getsize(poi_file_path) == 0:
-            raise ProcessingException("resulting map file size for %s is zero, keeping old map file" % map_file)
-        
-        if not can_overwrite_old_file(poi_file_target_path, poi_file_path):
+        if not can_overwrite_old_file(target_path, file_path):
             return
 
-        move_call = ["mv",poi_file_path, poi_file_target_path]
+        move_call = ["mv",file_path, target_path]
         self.logger.debug("calling: %s"," ".join(move_call))
         if not self.dry_run:
             try:
-                subprocess.check_call(move_call)
+                with instrumentation.stage(part, 'move', outputs=[target_path]):
+                    instrumentation.check_call(move_call)
             except:        
-                raise ProcessingException("could not move created poi file  %s to target directory" % poi_file)
+                raise ProcessingException("could not move created %s file %s to target directory" % (output_type, file_path))
+            if fingerprint:
+                self.manifest.record(manifest_key, fingerprint)
+                self.manifest.save()
         
 
-
 def check_create_path(path):
     directory = PATH.dirname(path)
     if not PATH.exists(directory):
-        os.makedirs(directory)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # the directory may have been created concurrently by another task
+            if not PATH.isdir(directory):
+                raise
     return path
 def normalize_path(path):
     path = path.strip()
@@ -385,7 +782,7 @@ def main():
     
     ######## SETUP OPTION PARSER AND READ COMMAND LINE ARGS ##########
     
-    usage = "usage: %prog -c CONFIGURATION_FILE [-d]"
+    usage = "usage: %prog -c CONFIGURATION_FILE [-d] [-j JOBS] [-r] [--offline]"
     option_parser = OptionParser(usage,version='1.0')
     option_parser.add_option("-c", "--configuration-file", dest="configuration_file",
                              action='store',help="the path to the XML configuration file")
@@ -395,6 +792,15 @@ def main():
     option_parser.add_option("-l", "--logging-conf", dest="logging_config_file",
                              action='store', default='logging.conf',
                              help="path to the logging configuration [default=logging.conf]")
+    option_parser.add_option("-j", "--jobs", dest="jobs",
+                             action='store', type='int', default=1,
+                             help="number of osmosis calls to run concurrently [default=1]")
+    option_parser.add_option("-r", "--resume", dest="resume",
+                             action='store_true', default=False,
+                             help="continue the last run, only tasks that did not finish are run again [default=false]")
+    option_parser.add_option("--offline", dest="offline",
+                             action='store_true', default=False,
+                             help="use the local copy of the land polygons without checking for a new version [default=false]")
     (options, args) = option_parser.parse_args()
            
     if len(args) != 0:
@@ -439,6 +845,11 @@ def main():
     osmosis_path = root.get('osmosis-path',default='osmosis')
     land_simplification = root.get('land-simplification', 0)
     zoom_interval_conf = root.get('zoom-interval-conf',default='')
+    land_polygons_url = root.get('land-polygons-url')
+    osmosis_worker = root.get('osmosis-worker')
+    single_pass = root.get('map-poi-single-pass', 'false') == 'true'
+    memory_budget = int(root.get('memory-budget', default=0))
+    jvm_heap = int(root.get('jvm-heap', default=0))
     if zoom_interval_conf != "":
         zoom_interval_conf = "zoom-interval-conf=" + zoom_interval_conf
 
@@ -477,8 +888,24 @@ def main():
     logger.info("start creating maps from configuration at: '%s'", options.configuration_file)
     creator = MapCreator(full_osmosis_path,pbf_staging_path, map_staging_path, poi_staging_path, polygons_path,
                          initial_source_pbf, map_target_path, poi_target_path, logging_path,
-                         default_start_zoom, default_preferred_languages, options.dry_run)
-    creator.evalPart(root, initial_source_pbf, '', '', '', '', zoom_interval_conf, land_simplification)                
+                         default_start_zoom, default_preferred_languages, options.dry_run, land_polygons_url, options.offline, single_pass,
+                         memory_budget, jvm_heap, options.resume)
+    if osmosis_worker and not options.dry_run:
+        # the workers have no known heap, calls limited to a heap by the memory budget run in new osmosis processes
+        creator.osmosis_workers = osmosisworker.WorkerPool(shlex.split(osmosis_worker), options.jobs,
+                                                           log_dir=check_create_path(creator.logging_path + 'workers/'))
+    # runs with a single job are scheduled as well, so they are recorded in the journal
+    try:
+        creator.evalPartParallel(root, initial_source_pbf, zoom_interval_conf, land_simplification, options.jobs)
+    except KeyboardInterrupt:
+        sys.exit("interrupted")
+    finally:
+        if creator.osmosis_workers:
+            creator.osmosis_workers.close()
+        creator.write_report()
+        # values computed during the run are written once at its end
+        creator.manifest.save()
+        creator.landExtractor.polygon_cache.save()
 
 def setup_logging(logging_path, dry_run):
     
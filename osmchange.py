@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+The area touched by an OSM change file, used to only regenerate the parts
+that contain changes.
+
+The change file is reduced to the grid cells of the changed nodes. Changed
+ways and relations are located by the changed nodes they reference. Changes
+that cannot be located from the file itself (e.g. tag changes of a way whose
+nodes did not change) mark every part as changed, unless they are explicitly
+ignored, then they are only counted and reported.
+
+A change file only has the new position of a moved node, so the part the node
+was moved out of is not marked as changed by the move, its map keeps the
+node at the old position.
+
+Instead of a change file, a text file with one bounding box
+'minlon,minlat,maxlon,maxlat' per line can be given, e.g. computed from the
+full geometries of the changed entities, including the old positions of
+moved nodes.
+'''
+
+import gzip
+import logging
+import math
+from shapely.geometry import box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+# size of the grid cells in degrees changed nodes are snapped to
+CELL_SIZE = 0.1
+
+
+class ChangedArea:
+    '''
+    the changed areas as boxes in a spatial index, everywhere if all parts count as changed
+    '''
+
+    def __init__(self, boxes, unlocated=0, everywhere=False):
+        self.boxes = boxes
+        self.unlocated = unlocated
+        self.everywhere = everywhere
+        self.tree = STRtree(boxes) if boxes else None
+
+    def intersects(self, geometry):
+        if self.everywhere:
+            return True
+        if self.tree is None:
+            return False
+        result = self.tree.query(geometry)
+        # shapely < 2 returns the geometries of a query instead of their indices
+        if len(result) and not hasattr(result[0], 'geom_type'):
+            result = [self.boxes[i] for i in result]
+        prepared = prep(geometry)
+        return any(prepared.intersects(b) for b in result)
+
+
+def read_changed_area(path, ignore_unlocated=False):
+    '''
+    reads an osm change file (.osc or .osc.gz) or a file of bounding boxes
+    '''
+    if path.endswith('.osc') or path.endswith('.osc.gz'):
+        return read_change_file(path, ignore_unlocated)
+    return read_bbox_file(path)
+
+
+def read_change_file(path, ignore_unlocated=False):
+    logger = logging.getLogger("mapcreator")
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    else:
+        f = open(path, 'rb')
+    node_cells = {}
+    cells = set()
+    located_ways = set()
+    unlocated = 0
+    try:
+        for (event, element) in ElementTree.iterparse(f):
+            if element.tag == 'node':
+                if element.get('lat') is not None and element.get('lon') is not None:
+                    cell = grid_cell(float(element.get('lon')), float(element.get('lat')))
+                    node_cells[element.get('id')] = cell
+                    cells.add(cell)
+                else:
+                    unlocated += 1
+                element.clear()
+            elif element.tag == 'way':
+                if any(nd.get('ref') in node_cells for nd in element.findall('nd')):
+                    located_ways.add(element.get('id'))
+                else:
+                    unlocated += 1
+                element.clear()
+            elif element.tag == 'relation':
+                members = element.findall('member')
+                if not any((m.get('type') == 'node' and m.get('ref') in node_cells) or
+                           (m.get('type') == 'way' and m.get('ref') in located_ways) for m in members):
+                    unlocated += 1
+                element.clear()
+            elif element.tag in ('create', 'modify', 'delete'):
+                element.clear()
+    finally:
+        f.close()
+    if unlocated and ignore_unlocated:
+        logger.warning("%d changed entities in %s could not be located, they do not mark any part as changed", unlocated, path)
+    elif unlocated:
+        logger.warning("%d changed entities in %s could not be located, all parts are treated as changed", unlocated, path)
+    return ChangedArea([box(x * CELL_SIZE, y * CELL_SIZE, (x + 1) * CELL_SIZE, (y + 1) * CELL_SIZE) for (x, y) in cells],
+                       unlocated, unlocated > 0 and not ignore_unlocated)
+
+
+def read_bbox_file(path):
+    boxes = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            (minlon, minlat, maxlon, maxlat) = [float(v) for v in line.split(',')]
+            boxes.append(box(minlon, minlat, maxlon, maxlat))
+    return ChangedArea(boxes)
+
+
+def grid_cell(lon, lat):
+    return (int(math.floor(lon / CELL_SIZE)), int(math.floor(lat / CELL_SIZE)))
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Pool of long running osmosis processes, so the calls of small parts do not
+pay for starting a JVM and loading the osmosis plugins every time.
+
+A worker reads one call per line from its stdin: the path of the log file
+followed by the osmosis arguments, separated by tabs. It appends the output
+of the call to the log file and answers with a line 'exit <status>'. The
+worker for osmosis is resources/OsmosisWorker.java, resources/stub-osmosis-worker
+is a stand-in for tests and benchmarks.
+
+Calls are run by a new osmosis process as before if no worker is configured,
+all workers are busy, the call needs more heap than the workers have or the
+worker dies during the call. Calls needing a heap also run in a new process
+if the heap of the workers is not known.
+'''
+
+import logging
+import os
+import subprocess
+import threading
+
+import instrumentation
+
+
+class Worker:
+    '''
+    a running worker process, it runs one call at a time
+    '''
+    def __init__(self, command, env=None, log_path=None):
+        log = open(log_path or os.devnull, 'a')
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log,
+                                            env=env, close_fds=True)
+        finally:
+            log.close()
+        self.calls = 0
+
+    def run(self, args, log_path):
+        '''
+        runs the osmosis call with the given arguments, returns its exit status
+        '''
+        self.process.stdin.write('\t'.join([log_path] + list(args)) + '\n')
+        self.process.stdin.flush()
+        reply = self.process.stdout.readline().split()
+        if len(reply) != 2 or reply[0] != 'exit':
+            raise IOError("worker %d exited" % self.process.pid)
+        self.calls += 1
+        return int(reply[1])
+
+    def close(self):
+        try:
+            # the worker exits at the end of its input
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+
+
+class WorkerPool:
+    '''
+    at most size workers started with the command, each with a maximum heap in MB (0 if unknown,
+    then only calls without a heap estimate run on the workers)
+    '''
+    def __init__(self, command, size, heap=0, env=None, log_dir=None):
+        self.logger = logging.getLogger("mapcreator")
+        self.command = command
+        self.size = size
+        self.heap = heap
+        self.env = env
+        self.log_dir = log_dir
+        self.lock = threading.Lock()
+        self.workers = []
+        self.idle = []
+        # set once a worker could not be started or failed before completing a call
+        self.disabled = False
+
+    def run(self, args, logfile, heap=0):
+        '''
+        runs the osmosis call with the arguments on a worker and returns true, raises CalledProcessError
+        if the call failed. returns false if the call has to be run by a new osmosis process.
+        '''
+        if heap and (not self.heap or heap > self.heap):
+            return False
+        if any('\t' in arg or '\n' in arg for arg in args):
+            return False
+        worker = self.acquire()
+        if worker is None:
+            return False
+        try:
+            status = worker.run(args, logfile.name)
+        except (IOError, OSError, ValueError), e:
+            self.logger.warning("osmosis worker failed, running the call in a new osmosis process: %s", e)
+            self.discard(worker)
+            return False
+        with self.lock:
+            self.idle.append(worker)
+        if status:
+            raise subprocess.CalledProcessError(status, args)
+        return True
+
+    def acquire(self):
+        with self.lock:
+            if self.disabled:
+                return None
+            if self.idle:
+                return self.idle.pop()
+            if len(self.workers) >= self.size:
+                return None
+            log_path = None
+            if self.log_dir:
+                log_path = os.path.join(self.log_dir, 'osmosis-worker-%d.log' % len(self.workers))
+            try:
+                worker = Worker(self.command, self.env, log_path)
+            except OSError, e:
+                self.logger.warning("could not start osmosis worker %s, using new osmosis processes: %s",
+                                    " ".join(self.command), e)
+                self.disabled = True
+                return None
+            self.logger.debug("started osmosis worker %d", worker.process.pid)
+            self.workers.append(worker)
+            return worker
+
+    def discard(self, worker):
+        with self.lock:
+            self.workers.remove(worker)
+            if not worker.calls:
+                self.logger.warning("osmosis worker failed before completing a call, using new osmosis processes")
+                self.disabled = True
+        try:
+            worker.process.kill()
+        except OSError:
+            pass
+        worker.close()
+
+    def close(self):
+        '''
+        stops all workers, they must be idle
+        '''
+        with self.lock:
+            workers = self.workers
+            self.workers = []
+            self.idle = []
+        for worker in workers:
+            worker.close()
+
+
+def check_call(pool, call, logfile, heap=0, env=None):
+    '''
+    runs an osmosis call on a worker of the pool or, if there is no pool or the pool cannot run it,
+    in a new osmosis process like instrumentation.check_call
+    '''
+    if pool is not None and pool.run(call[1:], logfile, heap):
+        return 0
+    return instrumentation.check_call(call, stderr=logfile, env=env)
@@ -0,0 +1,343 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Minimal writer for OSM PBF files, used to write the land and sea data
+directly in the format osmosis reads fastest.
+
+Nodes are written as dense nodes, ids and coordinates delta coded, and every
+block is zlib compressed. Entities have to be added with increasing ids per
+type. Ways and relations are written after all nodes, so the file is sorted
+by type then id and can be merged by osmosis without sorting it first.
+
+http://wiki.openstreetmap.org/wiki/PBF_Format
+'''
+
+import cStringIO
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import zlib
+
+# entities per block and the maximum number of way refs in a block,
+# keeping the uncompressed blocks well below the 16MB limit
+BLOCK_ENTITIES = 8000
+BLOCK_REFS = 1000000
+
+GRANULARITY = 100
+DATE_GRANULARITY = 1000
+
+# metadata of all written entities, the same as in the osm xml files
+VERSION = 1
+TIMESTAMP = -1
+CHANGESET = -1
+
+MEMBER_TYPES = {'node': 0, 'way': 1, 'relation': 2}
+
+WIRE_VARINT = 0
+WIRE_BYTES = 2
+
+
+def varint(value):
+    # negative values of non zigzag types are encoded as 64 bit two's complement
+    if value < 0:
+        value &= 0xFFFFFFFFFFFFFFFF
+    out = []
+    while value > 0x7f:
+        out.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+
+def zigzag(value):
+    if value >= 0:
+        return value << 1
+    return ((-value) << 1) - 1
+
+
+def key(field, wire_type):
+    return varint((field << 3) | wire_type)
+
+
+def uint_field(field, value):
+    return key(field, WIRE_VARINT) + varint(value)
+
+
+def sint_field(field, value):
+    return key(field, WIRE_VARINT) + varint(zigzag(value))
+
+
+def bytes_field(field, value):
+    return key(field, WIRE_BYTES) + varint(len(value)) + value
+
+
+def packed_uint(field, values):
+    return bytes_field(field, ''.join([varint(v) for v in values]))
+
+
+def packed_sint(field, values):
+    return bytes_field(field, ''.join([varint(zigzag(v)) for v in values]))
+
+
+def deltas(values):
+    previous = 0
+    result = []
+    for value in values:
+        result.append(value - previous)
+        previous = value
+    return result
+
+
+def file_block(block_type, data):
+    '''
+    a zlib compressed blob with its header, as written to the file
+    '''
+    blob = uint_field(2, len(data)) + bytes_field(3, zlib.compress(data))
+    header = bytes_field(1, block_type) + uint_field(3, len(blob))
+    return struct.pack('!I', len(header)) + header + blob
+
+
+def header_block(writing_program):
+    return (bytes_field(4, 'OsmSchema-V0.6') + bytes_field(4, 'DenseNodes') +
+            bytes_field(5, 'Sort.Type_then_ID') + bytes_field(16, writing_program))
+
+
+class StringTable:
+
+    def __init__(self):
+        # index 0 is reserved as delimiter
+        self.strings = ['']
+        self.indices = {'': 0}
+
+    def index(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        else:
+            value = str(value)
+        i = self.indices.get(value)
+        if i is None:
+            i = len(self.strings)
+            self.strings.append(value)
+            self.indices[value] = i
+        return i
+
+    def encode(self):
+        return ''.join([bytes_field(1, s) for s in self.strings])
+
+
+def primitive_block(strings, group):
+    return bytes_field(1, strings.encode()) + bytes_field(2, group) + uint_field(17, GRANULARITY) + uint_field(18, DATE_GRANULARITY)
+
+
+def info():
+    return uint_field(1, VERSION) + uint_field(2, TIMESTAMP) + uint_field(3, CHANGESET)
+
+
+def dense_nodes_block(nodes):
+    '''
+    a block of (id, lon, lat, tags) nodes
+    '''
+    strings = StringTable()
+    ids = []
+    lats = []
+    lons = []
+    keys_vals = []
+    for (node_id, lon, lat, tags) in nodes:
+        ids.append(node_id)
+        lats.append(int(round(lat * 1e9 / GRANULARITY)))
+        lons.append(int(round(lon * 1e9 / GRANULARITY)))
+        for (k, v) in tags:
+            keys_vals.append(strings.index(k))
+            keys_vals.append(strings.index(v))
+        keys_vals.append(0)
+    count = len(nodes)
+    dense_info = (packed_uint(1, [VERSION] * count) + packed_sint(2, [TIMESTAMP] + [0] * (count - 1)) +
+                  packed_sint(3, [CHANGESET] + [0] * (count - 1)) + packed_sint(4, [0] * count) +
+                  packed_sint(5, [0] * count))
+    dense = packed_sint(1, deltas(ids)) + bytes_field(5, dense_info) + packed_sint(8, deltas(lats)) + packed_sint(9, deltas(lons))
+    if len(keys_vals) > count:
+        dense += packed_uint(10, keys_vals)
+    return primitive_block(strings, bytes_field(2, dense))
+
+
+def ways_block(ways):
+    '''
+    a block of (id, refs, tags) ways
+    '''
+    strings = StringTable()
+    group = []
+    for (way_id, refs, tags) in ways:
+        way = uint_field(1, way_id)
+        if tags:
+            way += packed_uint(2, [strings.index(k) for (k, v) in tags])
+            way += packed_uint(3, [strings.index(v) for (k, v) in tags])
+        way += bytes_field(4, info()) + packed_sint(8, deltas(refs))
+        group.append(bytes_field(3, way))
+    return primitive_block(strings, ''.join(group))
+
+
+def relations_block(relations):
+    '''
+    a block of (id, members, tags) relations, members are (type, ref, role) tuples
+    '''
+    strings = StringTable()
+    group = []
+    for (relation_id, members, tags) in relations:
+        relation = uint_field(1, relation_id)
+        if tags:
+            relation += packed_uint(2, [strings.index(k) for (k, v) in tags])
+            relation += packed_uint(3, [strings.index(v) for (k, v) in tags])
+        relation += bytes_field(4, info())
+        relation += packed_uint(8, [strings.index(role) for (member_type, ref, role) in members])
+        relation += packed_sint(9, deltas([ref for (member_type, ref, role) in members]))
+        relation += packed_uint(10, [MEMBER_TYPES[member_type] for (member_type, ref, role) in members])
+        group.append(bytes_field(4, relation))
+    return primitive_block(strings, ''.join(group))
+
+
+def read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def decode_fields(data):
+    '''
+    the (field, value) pairs of a message, values of length delimited fields are strings
+    '''
+    fields = []
+    pos = 0
+    while pos < len(data):
+        field_key, pos = read_varint(data, pos)
+        if field_key & 7 == WIRE_VARINT:
+            value, pos = read_varint(data, pos)
+        elif field_key & 7 == WIRE_BYTES:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        else:
+            raise ValueError("unsupported wire type %d" % (field_key & 7))
+        fields.append((field_key >> 3, value))
+    return fields
+
+
+def read_header(path):
+    '''
+    the fields of the header block of a pbf file, e.g. the replication
+    timestamp (32) and sequence number (33) of planet files
+    '''
+    with open(path, 'rb') as f:
+        header_length = struct.unpack('!I', f.read(4))[0]
+        blob_header = dict(decode_fields(f.read(header_length)))
+        if blob_header.get(1) != 'OSMHeader':
+            raise ValueError("%s does not start with a header block" % path)
+        blob = dict(decode_fields(f.read(blob_header[3])))
+    if 3 in blob:
+        data = zlib.decompress(blob[3])
+    else:
+        data = blob[1]
+    return dict(decode_fields(data))
+
+
+def is_complete(path):
+    '''
+    returns true if the file consists of complete blocks, i.e. it was not truncated while it was written
+    '''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        position = 0
+        while position < size:
+            if position + 4 > size:
+                return False
+            f.seek(position)
+            header_length = struct.unpack('!I', f.read(4))[0]
+            if position + 4 + header_length > size:
+                return False
+            try:
+                blob_header = dict(decode_fields(f.read(header_length)))
+            except (IndexError, ValueError):
+                return False
+            if 3 not in blob_header:
+                return False
+            position += 4 + header_length + blob_header[3]
+        return position == size and size > 0
+
+
+class PbfWriter:
+    '''
+    Writes nodes, ways and relations to a pbf file. Nodes are written as soon as a
+    block is full, ways are spooled to a temporary file and relations kept in memory
+    until the file is closed, as they have to follow the nodes. When writing to a
+    named pipe, nothing is written to disk: the compressed way blocks are kept in memory.
+    '''
+
+    def __init__(self, path, writing_program='mapcreator'):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(file_block('OSMHeader', header_block(writing_program)))
+        if stat.S_ISFIFO(os.fstat(self.file.fileno()).st_mode):
+            self.way_spool = cStringIO.StringIO()
+        else:
+            self.way_spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+        self.nodes = []
+        self.ways = []
+        self.way_refs = 0
+        self.relations = []
+        self.last_ids = {}
+        self.closed = False
+
+    def check_order(self, entity_type, entity_id):
+        if entity_id <= self.last_ids.get(entity_type, entity_id - 1):
+            raise ValueError("%s %s added after %s %s, ids must increase" %
+                             (entity_type, entity_id, entity_type, self.last_ids[entity_type]))
+        self.last_ids[entity_type] = entity_id
+
+    def add_node(self, node_id, lon, lat, tags=()):
+        self.check_order('node', node_id)
+        self.nodes.append((node_id, lon, lat, tags))
+        if len(self.nodes) >= BLOCK_ENTITIES:
+            self.flush_nodes()
+
+    def add_way(self, way_id, refs, tags=()):
+        self.check_order('way', way_id)
+        self.ways.append((way_id, refs, tags))
+        self.way_refs += len(refs)
+        if len(self.ways) >= BLOCK_ENTITIES or self.way_refs >= BLOCK_REFS:
+            self.flush_ways()
+
+    def add_relation(self, relation_id, members, tags=()):
+        self.check_order('relation', relation_id)
+        self.relations.append((relation_id, members, tags))
+
+    def flush_nodes(self):
+        if self.nodes:
+            self.file.write(file_block('OSMData', dense_nodes_block(self.nodes)))
+            self.nodes = []
+
+    def flush_ways(self):
+        if self.ways:
+            self.way_spool.write(file_block('OSMData', ways_block(self.ways)))
+            self.ways = []
+            self.way_refs = 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush_nodes()
+        self.flush_ways()
+        self.way_spool.seek(0)
+        shutil.copyfileobj(self.way_spool, self.file)
+        self.way_spool.close()
+        for i in range(0, len(self.relations), BLOCK_ENTITIES):
+            self.file.write(file_block('OSMData', relations_block(self.relations[i:i + BLOCK_ENTITIES])))
+        self.relations = []
+        self.file.close()
+        self.closed = True
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Cache for values derived from polygon files, e.g. bounding boxes and areas.
+
+Values are kept in memory and in a json file on disk, so they are computed
+once per polygon and not again on subsequent runs. An entry is only valid as
+long as the modification time and size of its polygon file are unchanged.
+New values are only written to disk by save, which the caller calls once per
+stage or at the end of the run.
+'''
+
+import json
+import logging
+import os
+import threading
+
+
+class PolygonCache:
+
+    def __init__(self, cache_file=None):
+        self.logger = logging.getLogger("mapcreator")
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.entries = {}
+        # true if there are values that were not saved yet
+        self.dirty = False
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError), e:
+                self.logger.warning("ignoring invalid polygon cache %s: %s", cache_file, e)
+
+    def get(self, polygon_file, name, compute):
+        '''
+        returns the value stored under name for the polygon file, calls compute
+        with the polygon file to create it if there is no valid entry
+        '''
+        path = os.path.abspath(polygon_file)
+        stamp = file_stamp(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry['stamp'] == stamp and name in entry['values']:
+                return from_json(entry['values'][name])
+
+        value = compute(polygon_file)
+        self._store(path, stamp, name, value)
+        return value
+
+    def put(self, polygon_file, name, value):
+        '''
+        stores a value for the polygon file, replacing the one stored under the same name
+        '''
+        path = os.path.abspath(polygon_file)
+        self._store(path, file_stamp(path), name, value)
+
+    def _store(self, path, stamp, name, value):
+        with self.lock:
+            entry = self.entries.get(path)
+            if not entry or entry['stamp'] != stamp:
+                entry = {'stamp': stamp, 'values': {}}
+                self.entries[path] = entry
+            entry['values'][name] = value
+            self.dirty = True
+
+    def entry(self, polygon_file):
+        '''
+        all values stored for the polygon file with the stamp they are valid for, None if there are none
+        '''
+        with self.lock:
+            return self.entries.get(os.path.abspath(polygon_file))
+
+    def add_entries(self, entries):
+        '''
+        stores entries of another cache, e.g. of a worker process, by the absolute path of their polygon files
+        '''
+        with self.lock:
+            for (path, entry) in entries.items():
+                current = self.entries.get(path)
+                if current and current['stamp'] == entry['stamp']:
+                    current['values'].update(entry['values'])
+                else:
+                    self.entries[path] = entry
+            self.dirty = self.dirty or bool(entries)
+
+    def save(self):
+        '''
+        writes the cache to disk if values were added since it was last written
+        '''
+        if not self.cache_file:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_file = self.cache_file + '.tmp'
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(self.entries, f)
+                os.rename(tmp_file, self.cache_file)
+                self.dirty = False
+            except (IOError, OSError), e:
+                self.logger.warning("could not write polygon cache %s: %s", self.cache_file, e)
+
+
+def file_stamp(path):
+    '''
+    modification time and size of a file, changes whenever the file is modified
+    '''
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def from_json(value):
+    # json turns tuples (bounding boxes) into lists
+    if isinstance(value, list):
+        return tuple(value)
+    return value
@@ -0,0 +1,46 @@
+import java.io.BufferedReader;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.util.Arrays;
+
+import org.openstreetmap.osmosis.core.Osmosis;
+
+/**
+ * Runs osmosis calls in a single JVM for osmosisworker.py. Every line of the
+ * input is a call: the path of its log file followed by the osmosis
+ * arguments, separated by tabs. The reply is a line 'exit <status>'.
+ *
+ * Compile and start it with the osmosis libraries (and the mapsforge writer
+ * plugin) on the class path, e.g.
+ *   javac -cp "/opt/osmosis/lib/default/*" OsmosisWorker.java
+ *   java -Xmx4g -cp "/opt/osmosis/lib/default/*:." OsmosisWorker
+ */
+public class OsmosisWorker {
+
+    public static void main(String[] args) throws Exception {
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        PrintStream out = System.out;
+        PrintStream err = System.err;
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] fields = line.split("\t", -1);
+            int status = 0;
+            PrintStream log = new PrintStream(new FileOutputStream(fields[0], true), true, "UTF-8");
+            System.setOut(log);
+            System.setErr(log);
+            try {
+                Osmosis.run(Arrays.copyOfRange(fields, 1, fields.length));
+            } catch (Throwable t) {
+                t.printStackTrace(log);
+                status = 1;
+            } finally {
+                System.setOut(out);
+                System.setErr(err);
+                log.close();
+            }
+            out.println("exit " + status);
+            out.flush();
+        }
+    }
+}
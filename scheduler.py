@@ -0,0 +1,389 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Dependency aware task scheduler used to process the parts of a configuration
+concurrently.
+
+A task becomes ready once all of its dependencies have finished. Tasks whose
+dependencies failed are skipped, unless they are marked to always run (this
+is used for the clean up of intermediate files). At most 'jobs' tasks are
+executed at the same time, every task runs in its own worker thread and the
+expensive work is done in the osmosis child processes it spawns.
+
+If a memory budget is given, a task is only started if its estimated memory
+fits into what the running tasks leave of the budget. If none of the ready
+tasks fits while nothing is running, the first of them is started anyway, so
+a task exceeding the budget on its own runs alone rather than never.
+
+The outputs of intermediate tasks are only kept until the tasks reading them
+are done: every intermediate file counts the tasks that declared it as input
+and is removed as soon as all of them succeeded, so the files a failed task
+needs to be run again are kept. With a disk budget, a task is only started
+if its estimated disk fits into what the intermediate files and the running
+tasks leave of the budget, with the same exception as for memory.
+
+With a journal, the state changes of all tasks and the outputs of finished
+tasks are recorded. Tasks the journal of a resumed run reports as done are
+not run again, as long as their outputs are valid or have been consumed by
+dependent tasks that are not run again either.
+
+To plan a run, the execution can be simulated with estimated durations of
+the tasks, following the same rules without running any of them.
+'''
+
+import logging
+import os
+import shutil
+import threading
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class Task:
+    '''
+    a unit of work, the action is called without arguments and signals
+    failure by raising an exception. The memory (in MB) may be a function, it is
+    evaluated once the task becomes ready, i.e. after its inputs were created.
+    The outputs are the paths of the files the task creates, the outputs of an
+    intermediate task are removed once the tasks having them as inputs are done.
+    The disk (in MB) the task writes may be a function like the memory. The cost
+    is a function returning the estimated resources of the task, used to plan a run.
+    '''
+    def __init__(self, name, action, dependencies=None, always_run=False, memory=0, outputs=None, cost=None,
+                 intermediate=False, inputs=None, disk=0):
+        self.name = name
+        self.action = action
+        self.dependencies = list(dependencies or [])
+        self.always_run = always_run
+        self.memory = memory
+        self.outputs = list(outputs or [])
+        self.cost = cost
+        self.intermediate = intermediate
+        self.inputs = list(inputs or [])
+        self.disk = disk
+        # the intermediate files the task creates and reads
+        self.artifacts = []
+        self.input_artifacts = []
+        self.dependents = []
+        self.state = PENDING
+        self.error = None
+
+    def finished(self):
+        return self.state in (DONE, FAILED, SKIPPED)
+
+    def succeeded(self):
+        return self.state == DONE
+
+
+class Artifact:
+    '''
+    an intermediate file or directory, created by one task and read by others
+    '''
+    def __init__(self, path, producer):
+        self.path = path
+        self.producer = producer
+        self.consumers = []
+        # MB on disk while the file exists
+        self.size = 0
+        self.removed = False
+
+    def consumed(self):
+        return self.producer.finished() and all(c.finished() for c in self.consumers)
+
+    def removable(self):
+        return self.producer.succeeded() and all(c.succeeded() for c in self.consumers)
+
+
+class PartScheduler:
+    '''
+    executes a DAG of tasks with at most 'jobs' tasks running at the same time
+    '''
+    def __init__(self, jobs=1, memory_budget=0, journal=None, disk_budget=0):
+        self.jobs = max(1, int(jobs))
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.journal = journal
+        self.logger = logging.getLogger("mapcreator")
+        self.tasks = []
+        self.artifacts = {}
+        self.ready = []
+        self.running = 0
+        self.memory_in_use = 0
+        # MB of the existing intermediate files and the disk estimates of the running tasks
+        self.disk_in_use = 0
+        self.condition = threading.Condition()
+        # set once the run was interrupted by Ctrl-C
+        self.interrupted = False
+
+    def add(self, name, action, dependencies=None, always_run=False, memory=0, outputs=None, cost=None,
+            intermediate=False, inputs=None, disk=0):
+        '''
+        adds a new task, dependencies and the tasks creating its inputs must have been added before
+        '''
+        dependencies = [d for d in (dependencies or []) if d is not None]
+        task = Task(name, action, dependencies, always_run, memory, outputs, cost, intermediate, inputs, disk)
+        for dependency in dependencies:
+            dependency.dependents.append(task)
+        for path in task.inputs:
+            # inputs that are not intermediate, like the initial source pbf, are never removed
+            if path in self.artifacts:
+                self.artifacts[path].consumers.append(task)
+                task.input_artifacts.append(self.artifacts[path])
+        if intermediate:
+            for path in task.outputs:
+                self.artifacts[path] = Artifact(path, task)
+                task.artifacts.append(self.artifacts[path])
+        self.tasks.append(task)
+        return task
+
+    def reserve(self, memory):
+        '''
+        takes memory (in MB) held outside of the tasks, e.g. by the scheduling process itself,
+        off the memory budget for the rest of the run
+        '''
+        self.condition.acquire()
+        try:
+            self.memory_in_use += memory
+        finally:
+            self.condition.release()
+
+    def run(self):
+        '''
+        runs all tasks, returns true if any of the tasks failed or was skipped
+        '''
+        if self.journal:
+            self._restore()
+        self.condition.acquire()
+        try:
+            for task in self.tasks:
+                if task.state == DONE:
+                    self._release_artifacts(task)
+            for task in self.tasks:
+                self._update(task)
+            while not all(task.finished() for task in self.tasks):
+                while self.ready and self.running < self.jobs:
+                    task = self._next_ready()
+                    if task is None:
+                        break
+                    self._start(task)
+                # with a timeout the wait can be interrupted by Ctrl-C
+                self.condition.wait(1.0)
+        except KeyboardInterrupt:
+            # the osmosis calls of the running tasks got the interrupt as well, the tasks are
+            # left running in the journal, so a resumed run starts them again
+            self.interrupted = True
+            self.logger.warning("interrupted while %d tasks were running", self.running)
+            raise
+        finally:
+            self.condition.release()
+        return any(not task.succeeded() for task in self.tasks)
+
+    def simulate(self, duration):
+        '''
+        plans the execution of all tasks without running them, assuming none of them fails.
+        duration returns the estimated seconds of a task, the memory and disk of the tasks
+        must be numbers. The disk of an intermediate task is assumed to be shared evenly by
+        its outputs. returns (task, start, end) for all tasks in the order they are started,
+        the peak memory and the peak disk
+        '''
+        waiting = dict((task, len(task.dependencies)) for task in self.tasks)
+        consumers = dict((artifact, len(artifact.consumers)) for artifact in self.artifacts.values())
+        ready = [task for task in self.tasks if not task.dependencies]
+        running = []
+        memory_in_use = disk_in_use = peak_memory = peak_disk = 0
+        now = 0.0
+        schedule = []
+        while ready or running:
+            while len(running) < self.jobs:
+                task = next((t for t in ready if fits(self.memory_budget, max(1, len(running)), memory_in_use, t,
+                                                      self.disk_budget, disk_in_use)), None)
+                if task is None and not running:
+                    task = ready[0]
+                if task is None:
+                    break
+                ready.remove(task)
+                end = now + duration(task)
+                running.append((end, len(schedule), task))
+                memory_in_use += task.memory
+                disk_in_use += task.disk
+                peak_memory = max(peak_memory, memory_in_use)
+                peak_disk = max(peak_disk, disk_in_use)
+                schedule.append((task, now, end))
+            running.sort()
+            (now, index, task) = running.pop(0)
+            memory_in_use -= task.memory
+            for artifact in task.artifacts:
+                if not consumers[artifact]:
+                    disk_in_use -= float(task.disk) / len(task.artifacts)
+            if not task.artifacts:
+                disk_in_use -= task.disk
+            for artifact in task.input_artifacts:
+                consumers[artifact] -= 1
+                if not consumers[artifact]:
+                    disk_in_use -= float(artifact.producer.disk) / len(artifact.producer.artifacts)
+            for dependent in task.dependents:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+        return (schedule, peak_memory, peak_disk)
+
+    def _restore(self):
+        # dependents were added after their dependencies, so they are restored first
+        for task in reversed(self.tasks):
+            if not task.outputs:
+                continue
+            consumers = [d for d in task.dependents if d.outputs]
+            if self.journal.was_done(task.name) or (self.journal.was_finished(task.name) and consumers and
+                                                    all(d.state == DONE for d in consumers)):
+                self.logger.info("task '%s' was done in the resumed run", task.name)
+                task.state = DONE
+        for task in self.tasks:
+            if task.state == PENDING:
+                self.journal.set_state(task.name, PENDING)
+
+    def _next_ready(self):
+        # tasks are started in the order they were added to the scheduler, skipping those
+        # that do not fit into the remaining budgets, e.g. next to kept intermediate files
+        for task in self.ready:
+            if self._admissible(task):
+                self.ready.remove(task)
+                return task
+        if self.running == 0 and self.ready:
+            return self.ready.pop(0)
+        return None
+
+    def _admissible(self, task):
+        return fits(self.memory_budget, max(1, self.running), self.memory_in_use, task,
+                    self.disk_budget, self.disk_in_use)
+
+    def _start(self, task):
+        task.state = RUNNING
+        self.running += 1
+        self.memory_in_use += task.memory
+        self.disk_in_use += task.disk
+        if self.memory_budget:
+            self.logger.debug("starting task '%s' with %d MB, %d of %d MB in use", task.name,
+                              task.memory, self.memory_in_use, self.memory_budget)
+        if self.disk_budget:
+            self.logger.debug("starting task '%s' writing %d MB, %d of %d MB disk in use", task.name,
+                              task.disk, self.disk_in_use, self.disk_budget)
+        if self.journal:
+            self.journal.set_state(task.name, RUNNING)
+        worker = threading.Thread(target=self._execute, args=(task,), name=task.name)
+        worker.daemon = True
+        worker.start()
+
+    def _execute(self, task):
+        try:
+            task.action()
+            state = DONE
+        except Exception, e:
+            task.error = e
+            state = FAILED
+        if self.journal and not self.interrupted:
+            try:
+                if state == DONE:
+                    self.journal.set_state(task.name, state, task.outputs)
+                else:
+                    self.journal.set_state(task.name, state, error=str(task.error))
+            except Exception, e:
+                self.logger.warning("could not record state of task '%s' in the journal: %s", task.name, e)
+        self.condition.acquire()
+        try:
+            task.state = state
+            self.running -= 1
+            self.memory_in_use -= task.memory
+            self.disk_in_use -= task.disk
+            self._finished(task)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def _finished(self, task):
+        self._release_artifacts(task)
+        for dependent in task.dependents:
+            self._update(dependent)
+
+    def _release_artifacts(self, task):
+        '''
+        accounts for the intermediate files a finished task created and removes
+        those that all of the tasks reading them have successfully read
+        '''
+        if task.succeeded():
+            for artifact in task.artifacts:
+                artifact.size = path_size(artifact.path)
+                self.disk_in_use += artifact.size
+        for artifact in task.artifacts + task.input_artifacts:
+            if artifact.removed or not artifact.consumed():
+                continue
+            if not artifact.removable():
+                self.logger.debug("a task reading %s failed, keeping it", artifact.path)
+                continue
+            if os.path.exists(artifact.path):
+                self.logger.debug("removing intermediate file %s", artifact.path)
+                try:
+                    if os.path.isdir(artifact.path):
+                        shutil.rmtree(artifact.path)
+                    else:
+                        os.remove(artifact.path)
+                except OSError, e:
+                    self.logger.warning("could not remove intermediate file %s: %s", artifact.path, e)
+                    continue
+            artifact.removed = True
+            self.disk_in_use -= artifact.size
+
+    def _update(self, task):
+        '''
+        moves a pending task to the ready list or skips it once all of its
+        dependencies have finished
+        '''
+        if task.state != PENDING or task in self.ready:
+            return
+        if not all(d.finished() for d in task.dependencies):
+            return
+        if task.always_run or all(d.succeeded() for d in task.dependencies):
+            if callable(task.memory):
+                try:
+                    task.memory = task.memory()
+                except Exception, e:
+                    self.logger.warning("could not estimate memory of task '%s': %s", task.name, e)
+                    task.memory = 0
+            if callable(task.disk):
+                try:
+                    task.disk = task.disk()
+                except Exception, e:
+                    self.logger.warning("could not estimate disk of task '%s': %s", task.name, e)
+                    task.disk = 0
+            self.ready.append(task)
+        else:
+            self.logger.debug("skipping task '%s', a dependency failed", task.name)
+            task.state = SKIPPED
+            if self.journal:
+                self.journal.set_state(task.name, SKIPPED)
+            self._finished(task)
+
+
+def fits(memory_budget, running, memory_in_use, task, disk_budget=0, disk_in_use=0):
+    '''
+    returns true if the task can be started next to the running tasks
+    '''
+    if running == 0:
+        return True
+    if memory_budget and memory_in_use + task.memory > memory_budget:
+        return False
+    return not disk_budget or disk_in_use + task.disk <= disk_budget
+
+
+def path_size(path):
+    '''
+    size in MB of a file or of all files in a directory, 0 if it does not exist
+    '''
+    if os.path.isdir(path):
+        return sum(path_size(os.path.join(path, name)) for name in os.listdir(path))
+    if os.path.exists(path):
+        return float(os.path.getsize(path)) / (1024 * 1024)
+    return 0
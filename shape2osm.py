@@ -159,6 +159,8 @@ Max_Waylength = 1500000
 # ======================================================================
 
 import sys
+import threading
+import osmpbf
 
 try:
     try:
@@ -173,226 +175,349 @@ except ImportError:
     print "OGR Python Bindings not installed.\n%s" % gdal_install
     sys.exit(1)
 
-def close_file():
-    """ Internal. Close an open file."""
-    global open_file
-    if not open_file.closed: 
-        open_file.write("</osm>")
-        open_file.close()
-
-def start_new_file():
-    """ Internal. Open a new file, closing existing file if neccesary."""
-    global open_file, file_counter
-    file_counter += 1
-    if open_file:
-        close_file()
-    open_file = open("%s.osm" % (file_name), "w")
-    print >>open_file, "<osm version='0.6'>"
-
 def clean_attr(val):
     """Internal. Hacky way to make attribute XML safe."""
     val = str(val)
     val = val.replace("&", "&amp;").replace("'", "&quot;").replace("<", "&lt;").replace(">", "&gt;").strip()
     return val
 
-def add_ring_nodes(ring):
-    """Internal. Write the outer ring nodes."""
-    global open_file, id_counter
-    ringways = []
-    ids = []
-    firstnode = id_counter
-    if range(ring.GetPointCount() - 1) == 0 or ring.GetPointCount() == 0:
-        print >>sys.stderr, "Degenerate ring." 
-        return    
-    for count in range(ring.GetPointCount() - 1):
-        ids.append(id_counter)
-        print >>open_file, "<node timestamp='1969-12-31T23:59:59Z' changeset='-1' id='%s' version='1' lon='%s' lat='%s' />" % (id_counter, ring.GetX(count), ring.GetY(count))
-        id_counter += 1
-        if (count > 0) and ((count % (Max_Waylength - 1)) == 0):
-            ringways.append(ids)
-            ids = []
-	    ids.append(id_counter - 1)
-    ids.append(firstnode)
-    ringways.append(ids)
-    return ringways    
-
-def add_ring_way(ring): 
-    """Internal. write out the 'holes' in a polygon."""
-    global open_file, id_counter
-    ids = []
-    ringways = []
-    for count in range(ring.GetPointCount() - 1):
-        ids.append(id_counter)
-        print >>open_file, "<node timestamp='1969-12-31T23:59:59Z' changeset='-1' version='1' id='%s' lon='%s' lat='%s' />" % (id_counter, ring.GetX(count), ring.GetY(count))
-        id_counter += 1
-    if len(ids) == 0:
-        return None
-    print >>open_file, "<way timestamp='1969-12-31T23:59:59Z' changeset='-1' id='%s' version='1'>" % id_counter
-    way_id = id_counter
-    id_counter += 1
-    count = 0
-    for i in ids:
-        print >>open_file, "<nd ref='%s' />" % i
-        count += 1
-        if count >= Max_Waylength - 1:
-            count = 0
-            print >>open_file, "</way>"
-            ringways.append(way_id)
-            print >>open_file, "<way timestamp='1969-12-31T23:59:59Z' changeset='-1'id='%s' version='1'>" % id_counter
-            way_id = id_counter
-            id_counter += 1
-            print >>open_file, "<nd ref='%s' />" % i
-    print >>open_file, "<nd ref='%s' />" % ids[0]
-    print >>open_file, "</way>"
-    ringways.append(way_id)
-
-    return ringways
-
-open_file = None
-
-file_name = None 
-
-id_counter = 22951459320
-
-file_counter = 0
-counter = 0
-
-class AppError(Exception): pass
-
-def run(filename, slice_count=1, obj_count=100000000, output_location=None, no_source=False):
-    """Run the converter. Requires open_file, file_name, id_counter,
-    file_counter, counter to be defined in global space; not really a very good
-    singleton."""
-    global id_counter, file_counter, counter, file_name, open_file, namespace
-    
-    if no_source:
-        namespace=None
-
-    if output_location:
-       file_name = output_location
-
-    ds = ogr.Open(filename)
-    if not ds:
-        raise AppError("OGR Could not open the file %s" % filename)
-    l = ds.GetLayer(0)
-   
-    max_objs_per_file = obj_count 
-
-    extent = l.GetExtent()
-    if extent[0] < -180 or extent[0] > 180 or extent[2] < -90 or extent[2] > 90:
-        raise AppError("Extent does not look like degrees; are you sure it is? \n(%s, %s, %s, %s)" % (extent[0], extent[2], extent[1], extent[3]))  
-    slice_width = (extent[1] - extent[0]) / slice_count
-
-    seen = {}
-
-    print "Running %s slices with %s base filename against shapefile %s" % (
-            slice_count, file_name, filename)
-
-    for i in range(slice_count): 
+NODE = "<node timestamp='1969-12-31T23:59:59Z' changeset='-1' id='%s' version='1' lon='%s' lat='%s' />"
+INNER_NODE = "<node timestamp='1969-12-31T23:59:59Z' changeset='-1' version='1' id='%s' lon='%s' lat='%s' />"
+WAY = "<way timestamp='1969-12-31T23:59:59Z' changeset='-1' id='%s' version='1'>"
+SPLIT_WAY = "<way timestamp='1969-12-31T23:59:59Z' changeset='-1'id='%s' version='1'>"
+ND = "<nd ref='%s' />"
+TAG = "<tag k='%s' v='%s' />"
 
-        l.ResetReading()
-        l.SetSpatialFilterRect(extent[0] + slice_width * i, extent[2], extent[0] + (slice_width * (i + 1)), extent[3])
+# number of output lines collected before they are written to the file
+WRITE_BUFFER_LINES = 65536
 
-        start_new_file()
-        f = l.GetNextFeature()
-        
-        obj_counter = 0
-        last_obj_split = 0
+class AppError(Exception): pass
 
-        while f:
-            start_id_counter = id_counter
-            if f.GetFID() in seen:
-                f = l.GetNextFeature()
-                continue
-            seen[f.GetFID()] = True             
-
-#            done = False
-#            while f.GetField(ignoreField) in ignoreValues:
-#                if l.GetNextFeature() == None:
-#                    done = True
-#                    break
-#                f = l.GetNextFeature()
-#            if done == True:
-#                break
+class IdSequence:
+    """The ids of the converted nodes, ways and relations. Converters running at
+    the same time take their ids from one sequence, so no two objects of the
+    shapefiles converted by a process have the same id."""
+
+    def __init__(self, start_id):
+        self.next_id = start_id
+        self.lock = threading.Lock()
+
+    def take(self, count=1):
+        """Reserve count consecutive ids and return the first one."""
+        with self.lock:
+            first_id = self.next_id
+            self.next_id += count
+            return first_id
+
+# the sequence used by all converters that are not given one of their own
+ids = IdSequence(22951459320)
+
+class ShapeConverter:
+    """Converts the polygons of a shapefile to OSM. All state of a conversion
+    is kept in the converter, so several shapefiles can be converted at the
+    same time, in threads or in processes. Lines are collected and written
+    to the file in large blocks. The ids are taken from the module's id sequence
+    unless another one is given."""
+
+    def __init__(self, output_location=None, slice_count=1, obj_count=100000000, no_source=False, id_sequence=None):
+        self.file_name = output_location
+        self.slice_count = slice_count
+        self.max_objs_per_file = obj_count
+        if no_source:
+            self.namespace = None
+        else:
+            self.namespace = namespace
+        self.open_file = None
+        self.lines = []
+        self.ids = id_sequence or ids
+        # number of ids taken by this converter
+        self.id_count = 0
+        self.file_counter = 0
+        self.counter = 0
+
+    def new_ids(self, count=1):
+        """ Internal. Take count consecutive ids and return the first one."""
+        self.id_count += count
+        return self.ids.take(count)
+
+    def write(self, line):
+        """ Internal. Buffer a line of output."""
+        self.lines.append(line)
+        if len(self.lines) >= WRITE_BUFFER_LINES:
+            self.flush()
+
+    def write_lines(self, lines):
+        """ Internal. Buffer several lines of output."""
+        self.lines.extend(lines)
+        if len(self.lines) >= WRITE_BUFFER_LINES:
+            self.flush()
+
+    def flush(self):
+        """ Internal. Write the buffered lines to the open file."""
+        if self.lines:
+            self.lines.append("")
+            self.open_file.write("\n".join(self.lines))
+            self.lines = []
+
+    def close_file(self):
+        """ Internal. Close an open file."""
+        if not self.open_file.closed: 
+            self.flush()
+            self.open_file.write("</osm>")
+            self.open_file.close()
+
+    def start_new_file(self):
+        """ Internal. Open a new file, closing existing file if neccesary."""
+        self.file_counter += 1
+        if self.open_file:
+            self.close_file()
+        self.open_file = open("%s.osm" % (self.file_name), "w")
+        self.write("<osm version='0.6'>")
+
+    def add_ring_nodes(self, ring):
+        """Internal. Write the outer ring nodes."""
+        point_count = ring.GetPointCount()
+        if point_count == 0:
+            print >>sys.stderr, "Degenerate ring." 
+            return
+        points = ring.GetPoints()[:point_count - 1]
+        firstnode = self.new_ids(len(points))
+        self.emit_nodes(firstnode, points)
+        # split the ring into ways of at most Max_Waylength nodes, consecutive ways share a node
+        ringways = []
+        ids = [firstnode]
+        for count in xrange(1, len(points)):
+            ids.append(firstnode + count)
+            if (count % (Max_Waylength - 1)) == 0:
+                ringways.append(ids)
+                ids = [firstnode + count]
+        if not points:
+            ids = []
+        ids.append(firstnode)
+        ringways.append(ids)
+        return ringways    
+
+    def add_ring_way(self, ring): 
+        """Internal. write out the 'holes' in a polygon."""
+        if ring.GetPointCount() == 0:
+            return None
+        points = ring.GetPoints()[:ring.GetPointCount() - 1]
+        if len(points) == 0:
+            return None
+        first_id = self.new_ids(len(points))
+        ids = range(first_id, first_id + len(points))
+        self.emit_nodes(first_id, points, inner=True)
+        # split the ring into ways, a following way starts with the last node of the previous one
+        ways = [(self.new_ids(), [])]
+        count = 0
+        for i in ids:
+            ways[-1][1].append(i)
+            count += 1
+            if count >= Max_Waylength - 1:
+                count = 0
+                ways.append((self.new_ids(), [i]))
+        ways[-1][1].append(ids[0])
+        self.emit_inner_ways(ways)
+
+        return [way_id for (way_id, refs) in ways]
+
+    def emit_nodes(self, first_id, points, inner=False):
+        """Internal. Write the nodes of a ring with consecutive ids."""
+        if inner:
+            template = INNER_NODE
+        else:
+            template = NODE
+        self.write_lines([template % (node_id, point[0], point[1])
+                          for (node_id, point) in zip(xrange(first_id, first_id + len(points)), points)])
+
+    def emit_way(self, way_id, refs, tags):
+        """Internal. Write a tagged outer way."""
+        lines = [WAY % way_id]
+        lines.extend([ND % ref for ref in refs])
+        lines.extend([TAG % (k, clean_attr(v)) for (k, v) in tags])
+        lines.append("</way>")
+        self.write_lines(lines)
+
+    def emit_inner_ways(self, ways):
+        """Internal. Write the untagged ways of an inner ring."""
+        lines = []
+        for (index, (way_id, refs)) in enumerate(ways):
+            if index == 0:
+                lines.append(WAY % way_id)
+            else:
+                lines.append(SPLIT_WAY % way_id)
+            lines.extend([ND % ref for ref in refs])
+            lines.append("</way>")
+        self.write_lines(lines)
+
+    def emit_relation(self, relation_id, outerways, innerways):
+        """Internal. Write a multipolygon relation."""
+        lines = ["<relation timestamp='1969-12-31T23:59:59Z' changeset='-1' id='%s' version='1' ><tag k='type' v='multipolygon' />" % relation_id]
+        lines.extend(['<member type="way" ref="%s" role="outer" />' % way for way in outerways])
+        lines.extend(['<member type="way" ref="%s" role="inner" />' % way for way in innerways])
+        lines.append("</relation>")
+        self.write_lines(lines)
+
+    def feature_tags(self, f):
+        """Internal. The (key, value) tags of an outer way of a feature."""
+        pairs = []
+        field_count = f.GetFieldCount()
+        fields  = {}
+        for field in range(field_count):
+            value = f.GetFieldAsString(field)
+            name = f.GetFieldDefnRef(field).GetName()
+            if self.namespace and name and value and name not in boring_tags:
+                pairs.append(("%s:%s" % (self.namespace, name), value))
+            fields[name.lower()] = value
+        tags={}
+#Perform the specified field mappting
+        for tag_name, map_value in tag_mapping:
+            if hasattr(map_value, '__call__'):
+                tag_values = map_value(fields)
+                if tag_values:
+                    for tag in tag_values:
+                        tags[tag[0]] = tag[1]
+            else:
+                if tag_name in fields:
+                    tags[map_value] = fields[tag_name].title()
+        for key, value in tags.items():
+            if key and value:
+                pairs.append((key, value))
+#Write fixed tabs                    
+        for name, value in fixed_tags.items():
+            pairs.append((name, value))
+        return pairs
+
+    def convert(self, filename):
+        """Convert the shapefile to one or more OSM files. Instead of the
+        file name an already opened OGR data source may be given."""
+        if isinstance(filename, basestring):
+            ds = ogr.Open(filename)
+        else:
+            ds = filename
+            filename = ds.GetName()
+        if not ds:
+            raise AppError("OGR Could not open the file %s" % filename)
+        l = ds.GetLayer(0)
+       
+        max_objs_per_file = self.max_objs_per_file
+
+        extent = l.GetExtent()
+        if extent[0] < -180 or extent[0] > 180 or extent[2] < -90 or extent[2] > 90:
+            raise AppError("Extent does not look like degrees; are you sure it is? \n(%s, %s, %s, %s)" % (extent[0], extent[2], extent[1], extent[3]))  
+        slice_width = (extent[1] - extent[0]) / self.slice_count
+
+        # features can only be seen twice if they overlap several slices
+        seen = set()
+
+        print "Running %s slices with %s base filename against shapefile %s" % (
+                self.slice_count, self.file_name, filename)
+
+        for i in range(self.slice_count): 
+
+            l.ResetReading()
+            l.SetSpatialFilterRect(extent[0] + slice_width * i, extent[2], extent[0] + (slice_width * (i + 1)), extent[3])
+
+            self.start_new_file()
+            f = l.GetNextFeature()
             
-            outerways = []
-	    innerways = []
-        
-            geom = f.GetGeometryRef()
-            ring = geom.GetGeometryRef(0)
-
-            objcount = ring.GetPointCount()
-            for i in range(1, geom.GetGeometryCount()):
-	        objcount += geom.GetGeometryRef(i).GetPointCount()
-	        objcount += 1
-
-            if (obj_counter - last_obj_split + objcount) > max_objs_per_file:
-                print "Splitting file with %s objs" % (obj_counter - last_obj_split)
-                start_new_file()
-                last_obj_split = obj_counter
-
-            if objcount > max_objs_per_file:
-                print "Warning: a feature contains %i objects which is more than the %i object limit.  It will be placed in a file by itself." % (objcount, max_objs_per_file)
-
-            ringways = add_ring_nodes(ring)
-            if not ringways or len(ringways) == 0:
-                f = l.GetNextFeature()
-                continue
+            obj_counter = 0
+            last_obj_split = 0
+
+            while f:
+                start_id_count = self.id_count
+                if self.slice_count > 1:
+                    if f.GetFID() in seen:
+                        f = l.GetNextFeature()
+                        continue
+                    seen.add(f.GetFID())
+
+                outerways = []
+                innerways = []
+            
+                geom = f.GetGeometryRef()
+                ring = geom.GetGeometryRef(0)
+
+                objcount = ring.GetPointCount()
+                for j in range(1, geom.GetGeometryCount()):
+                    objcount += geom.GetGeometryRef(j).GetPointCount()
+                    objcount += 1
+
+                if (obj_counter - last_obj_split + objcount) > max_objs_per_file:
+                    print "Splitting file with %s objs" % (obj_counter - last_obj_split)
+                    self.start_new_file()
+                    last_obj_split = obj_counter
+
+                if objcount > max_objs_per_file:
+                    print "Warning: a feature contains %i objects which is more than the %i object limit.  It will be placed in a file by itself." % (objcount, max_objs_per_file)
+
+                ringways = self.add_ring_nodes(ring)
+                if not ringways or len(ringways) == 0:
+                    f = l.GetNextFeature()
+                    continue
 # Write out the outer ways in the relation
-            for count in range( len(ringways) ):
-                ids = ringways[count]
-                if ids and len(ids) > 1: 
-                    print >>open_file, "<way timestamp='1969-12-31T23:59:59Z' changeset='-1' id='%s' version='1'>" % id_counter
-                    outerways.append(id_counter) 
-                    id_counter += 1
-                    for i in ids:
-                        print >>open_file, "<nd ref='%s' />" % i
+                tags = None
+                for ids in ringways:
+                    if ids and len(ids) > 1: 
+                        outerways.append(self.new_ids())
 #Write out the fields for the way
-                    field_count = f.GetFieldCount()
-                    fields  = {}
-                    for field in range(field_count):
-                        value = f.GetFieldAsString(field)
-                        name = f.GetFieldDefnRef(field).GetName()
-                        if namespace and name and value and name not in boring_tags:
-                            print >>open_file, "<tag k='%s:%s' v='%s' />" % (namespace, name, clean_attr(value))
-                        fields[name.lower()] = value
-                    tags={}
-#Perform the specified field mappting
-                    for tag_name, map_value in tag_mapping:
-                        if hasattr(map_value, '__call__'):
-                            tag_values = map_value(fields)
-                            if tag_values:
-                                for tag in tag_values:
-                                    tags[tag[0]] = tag[1]
-                        else:
-                            if tag_name in fields:
-                                tags[map_value] = fields[tag_name].title()
-                    for key, value in tags.items():
-                        if key and value:
-                            print >>open_file, "<tag k='%s' v='%s' />" % (key, clean_attr(value))
-#Write fixed tabs                    
-                    for name, value in fixed_tags.items():
-                        print >>open_file, "<tag k='%s' v='%s' />" % (name, clean_attr(value))
-                    print >>open_file, "</way>"
-            if (geom.GetGeometryCount() > 1) or (len(ringways) > 1):
+                        if tags is None:
+                            tags = self.feature_tags(f)
+                        self.emit_way(outerways[-1], ids, tags)
+                if (geom.GetGeometryCount() > 1) or (len(ringways) > 1):
 #add the inner ways
-                for i in range(1, geom.GetGeometryCount()):
-                    ringways = add_ring_way(geom.GetGeometryRef(i)) 
-                    for way in ringways:
-                        innerways.append(way)
-                print >>open_file, "<relation timestamp='1969-12-31T23:59:59Z' changeset='-1' id='%s' version='1' ><tag k='type' v='multipolygon' />" % id_counter
-                id_counter += 1
-                for way in outerways:
-                    print >>open_file, '<member type="way" ref="%s" role="outer" />' % way
-                for way in innerways:
-                    print >>open_file, '<member type="way" ref="%s" role="inner" />' % way 
-                print >>open_file, "</relation>"    
-                
-            counter += 1
-            f = l.GetNextFeature()
-            obj_counter += (id_counter - start_id_counter)
-        
-        close_file()
+                    for j in range(1, geom.GetGeometryCount()):
+                        inner_ringways = self.add_ring_way(geom.GetGeometryRef(j)) 
+                        if inner_ringways:
+                            innerways.extend(inner_ringways)
+                    self.emit_relation(self.new_ids(), outerways, innerways)
+                    
+                self.counter += 1
+                f = l.GetNextFeature()
+                obj_counter += (self.id_count - start_id_count)
+            
+            self.close_file()
+
+class PbfShapeConverter(ShapeConverter):
+    """Converts the polygons of a shapefile to an OSM PBF file. The ids of
+    the converter increase per type, so the file is sorted."""
+
+    def start_new_file(self):
+        """ Internal. Open a new file, closing existing file if neccesary."""
+        self.file_counter += 1
+        if self.open_file:
+            self.close_file()
+        self.open_file = osmpbf.PbfWriter("%s.osm.pbf" % (self.file_name), "shape2osm")
+
+    def close_file(self):
+        """ Internal. Close an open file."""
+        self.open_file.close()
+
+    def emit_nodes(self, first_id, points, inner=False):
+        for (node_id, point) in zip(xrange(first_id, first_id + len(points)), points):
+            self.open_file.add_node(node_id, point[0], point[1])
+
+    def emit_way(self, way_id, refs, tags):
+        self.open_file.add_way(way_id, refs, [(k, str(v).strip()) for (k, v) in tags])
+
+    def emit_inner_ways(self, ways):
+        for (way_id, refs) in ways:
+            self.open_file.add_way(way_id, refs)
+
+    def emit_relation(self, relation_id, outerways, innerways):
+        members = [('way', way, 'outer') for way in outerways] + [('way', way, 'inner') for way in innerways]
+        self.open_file.add_relation(relation_id, members, [('type', 'multipolygon')])
+
+def run(filename, slice_count=1, obj_count=100000000, output_location=None, no_source=False, output_format='osm'):
+    """Run the converter on a shapefile. Every call uses its own converter,
+    the node, way and relation ids continue the ids of the shapefiles converted
+    before. The output is written as osm xml or, with output_format 'pbf', as
+    osm pbf."""
+    if output_format == 'pbf':
+        converter = PbfShapeConverter(output_location, slice_count, obj_count, no_source)
+    else:
+        converter = ShapeConverter(output_location, slice_count, obj_count, no_source)
+    converter.convert(filename)
 
 if __name__ == "__main__":
     if DONT_RUN:
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the build manifest, run from the repository root with
+python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import buildmanifest
+
+
+class BuildManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manifest_file = os.path.join(self.directory, 'build-manifest.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_differs_only_in(self):
+        inputs = ['map', 'sequence:1', 'polygon', ('en', 'de'), 14]
+        manifest = buildmanifest.BuildManifest(self.manifest_file)
+        manifest.record('map:a.map', buildmanifest.fingerprint(*inputs), inputs)
+        manifest.record('map:b.map', buildmanifest.fingerprint(*inputs))
+        manifest.save()
+
+        # the inputs are kept in the manifest file
+        manifest = buildmanifest.BuildManifest(self.manifest_file)
+        self.assertTrue(manifest.differs_only_in('map:a.map', inputs, 1))
+        self.assertTrue(manifest.differs_only_in('map:a.map', ['map', 'sequence:2', 'polygon', ('en', 'de'), 14], 1))
+        self.assertFalse(manifest.differs_only_in('map:a.map', ['map', 'sequence:2', 'polygon', ('en',), 14], 1))
+        self.assertFalse(manifest.differs_only_in('map:a.map', ['map', 'sequence:2', 'polygon', ('en', 'de')], 1))
+        # outputs recorded without their inputs never differ in a single input only
+        self.assertFalse(manifest.differs_only_in('map:b.map', inputs, 1))
+        self.assertFalse(manifest.differs_only_in('map:c.map', inputs, 1))
+
+    def test_saved_only_on_save(self):
+        manifest = buildmanifest.BuildManifest(self.manifest_file)
+        manifest.record('map:a.map', 'a')
+        manifest.record('map:b.map', 'b')
+        self.assertFalse(os.path.exists(self.manifest_file))
+        manifest.save()
+        self.assertEqual('b', buildmanifest.BuildManifest(self.manifest_file).outputs['map:b.map'])
+        # nothing changed since, the file is not written again
+        os.remove(self.manifest_file)
+        manifest.save()
+        self.assertFalse(os.path.exists(self.manifest_file))
+        manifest.record('map:a.map', 'c')
+        manifest.save()
+        self.assertEqual('c', buildmanifest.BuildManifest(self.manifest_file).outputs['map:a.map'])
+        self.assertFalse(os.path.exists(self.manifest_file + '.tmp'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the build node server with the stub osmosis, run from the repository
+root with python -m unittest discover -s tests
+'''
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import buildnode
+
+STUB_OSMOSIS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resources', 'stub-osmosis')
+
+
+class NodeServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = buildnode.NodeServer(('127.0.0.1', 0), STUB_OSMOSIS, 'secret')
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def request(self, token):
+        return {'token': token, 'args': ['--wb', 'file=a.pbf'], 'cwd': self.directory, 'inputs': [], 'outputs': ['a.pbf']}
+
+    def test_call(self):
+        reply = buildnode.request_call('127.0.0.1', self.port, self.request('secret'))
+        self.assertEqual(0, reply['status'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'a.pbf')))
+
+    def test_invalid_token(self):
+        for token in ('guess', '', None, 7):
+            self.assertRaises(buildnode.NodeUnavailable, buildnode.request_call, '127.0.0.1', self.port, self.request(token))
+        request = self.request('secret')
+        del request['token']
+        self.assertRaises(buildnode.NodeUnavailable, buildnode.request_call, '127.0.0.1', self.port, request)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'a.pbf')))
+
+    def test_invalid_request(self):
+        connection = socket.create_connection(('127.0.0.1', self.port))
+        try:
+            stream = connection.makefile('rw')
+            stream.write('[]\n')
+            stream.flush()
+            reply = json.loads(stream.readline())
+            stream.close()
+        finally:
+            connection.close()
+        self.assertNotEqual(0, reply.get('status', 1))
+
+    def test_node_without_token_refuses_calls(self):
+        self.assertFalse(buildnode.valid_token(None, None))
+        self.assertFalse(buildnode.valid_token('', ''))
+        self.assertTrue(buildnode.valid_token('secret', u'secret'))
+
+
+if __name__ == '__main__':
+    unittest.main()
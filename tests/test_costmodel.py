@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the estimates used to plan a run, run from the repository root with
+python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import costmodel
+import instrumentation
+
+
+def record(part, stage, wall, status='done'):
+    return {'part': part, 'stage': stage, 'status': status, 'wall': wall, 'bytes_in': 0}
+
+
+class TimingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'timings.json')
+        report = instrumentation.RunReport()
+        report.add(record('europe', 'pbf extract', 30.0))
+        report.add(record('europe/germany', 'map write', 90.0))
+        report.add(record('europe/germany', 'move', 10.0))
+        report.add(record('europe/austria', 'map write', 50.0))
+        # the timings of failed stages are not recorded
+        report.add(record('europe/italy', 'map write', 999.0, 'failed'))
+        report.write_timings(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_recorded_wall_times(self):
+        timings = costmodel.Timings(self.path)
+        self.assertEqual(100.0, timings.wall('europe/germany', costmodel.MAP_STAGES))
+        self.assertEqual(None, timings.wall('europe/italy', costmodel.MAP_STAGES))
+        self.assertEqual(None, timings.wall('europe/germany', costmodel.EXTRACT_STAGES))
+
+    def test_calibrate(self):
+        extract = costmodel.Estimate(5.0, part='europe', stages=costmodel.EXTRACT_STAGES)
+        germany = costmodel.Estimate(10.0, part='europe/germany', stages=costmodel.MAP_STAGES)
+        austria = costmodel.Estimate(20.0, part='europe/austria', stages=costmodel.MAP_STAGES)
+        italy = costmodel.Estimate(40.0, part='europe/italy', stages=costmodel.MAP_STAGES)
+        land = costmodel.Estimate(7.0, part='europe/italy', stages=costmodel.LAND_STAGES)
+        costmodel.Timings(self.path).calibrate([extract, germany, austria, italy, land])
+        self.assertEqual(30.0, extract.seconds)
+        self.assertEqual(100.0, germany.seconds)
+        self.assertEqual(50.0, austria.seconds)
+        # the recorded maps took 150 s instead of the estimated 30 s
+        self.assertEqual(200.0, italy.seconds)
+        # no land was recorded, the estimate is kept
+        self.assertEqual(7.0, land.seconds)
+
+    def test_timings_of_earlier_runs_are_merged(self):
+        report = instrumentation.RunReport()
+        report.add(record('europe/austria', 'map write', 60.0))
+        report.write_timings(self.path)
+        timings = costmodel.Timings(self.path)
+        self.assertEqual(60.0, timings.wall('europe/austria', costmodel.MAP_STAGES))
+        self.assertEqual(100.0, timings.wall('europe/germany', costmodel.MAP_STAGES))
+
+    def test_missing_timings(self):
+        estimate = costmodel.Estimate(40.0, part='europe/italy', stages=costmodel.MAP_STAGES)
+        costmodel.Timings(os.path.join(self.directory, 'missing.json')).calibrate([estimate])
+        self.assertEqual(40.0, estimate.seconds)
+
+
+if __name__ == '__main__':
+    unittest.main()
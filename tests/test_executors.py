@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of distributing osmosis calls over build nodes running on localhost with
+the stub osmosis, run from the repository root with
+python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import buildnode
+import executors
+
+STUB_OSMOSIS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resources', 'stub-osmosis')
+TOKEN = 'secret'
+
+
+class NodeExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.servers = []
+        self.logfile = open(os.path.join(self.directory, 'osmosis.log'), 'a')
+        # the nodes resolve the paths of a call relative to the working directory of mapcreator
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.logfile.close()
+        shutil.rmtree(self.directory)
+
+    def node(self, slots=1):
+        server = buildnode.NodeServer(('127.0.0.1', 0), STUB_OSMOSIS, TOKEN)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return executors.TcpNode('127.0.0.1', server.server_address[1], slots, TOKEN)
+
+    def unreachable_node(self):
+        # a port nothing listens on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return executors.TcpNode('127.0.0.1', port, 1, TOKEN)
+
+    def check_call(self, executor, output, inputs=()):
+        call = [STUB_OSMOSIS, '--wb', 'file=' + output]
+        return executor.check_call(call, self.logfile, inputs=inputs, outputs=[output])
+
+    def test_unreachable_node_is_dropped(self):
+        unreachable = self.unreachable_node()
+        node = self.node()
+        executor = executors.NodeExecutor([unreachable, node])
+        self.assertEqual(0, self.check_call(executor, 'a.osm.pbf'))
+        self.assertTrue(unreachable.down)
+        self.assertFalse(node.down)
+        self.assertEqual(node, executor.locations['a.osm.pbf'])
+        self.assertTrue(os.path.exists('a.osm.pbf'))
+        self.assertEqual(0, node.running)
+
+    def test_node_with_other_token_is_dropped(self):
+        node = self.node()
+        node.token = 'guess'
+        executor = executors.NodeExecutor([node, executors.LocalNode()])
+        self.assertEqual(0, self.check_call(executor, 'a.osm.pbf'))
+        self.assertTrue(node.down)
+        self.assertEqual('local', executor.locations['a.osm.pbf'].name)
+
+    def test_calls_run_locally_without_nodes(self):
+        executor = executors.NodeExecutor([self.unreachable_node()])
+        self.assertEqual(0, self.check_call(executor, 'a.osm.pbf'))
+        self.assertTrue(os.path.exists('a.osm.pbf'))
+
+    def test_locality(self):
+        first = self.node()
+        second = self.node()
+        executor = executors.NodeExecutor([first, second])
+        # the first node is busy, so the pbf is created on the second one
+        self.assertEqual(first, executor.acquire([], False))
+        self.check_call(executor, 'germany.osm.pbf')
+        executor.release(first)
+        self.assertEqual(second, executor.locations['germany.osm.pbf'])
+        # both nodes are idle, the calls reading the pbf go to the node that created it
+        self.check_call(executor, 'bayern.map', inputs=['germany.osm.pbf'])
+        self.assertEqual(second, executor.locations['bayern.map'])
+        open('europe.osm.pbf', 'w').close()
+        self.check_call(executor, 'europe.map', inputs=['europe.osm.pbf'])
+        self.assertEqual(first, executor.locations['europe.map'])
+        # unless it has no free slot
+        self.assertEqual(second, executor.acquire(['germany.osm.pbf'], False))
+        self.check_call(executor, 'berlin.map', inputs=['germany.osm.pbf'])
+        executor.release(second)
+        self.assertEqual(first, executor.locations['berlin.map'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the land polygon cache against a local http server, run from the
+repository root with python -m unittest discover -s tests
+'''
+
+import BaseHTTPServer
+import os
+import shutil
+import SimpleHTTPServer
+import tempfile
+import threading
+import unittest
+import zipfile
+
+import landcache
+
+NAME = 'land-polygons'
+
+
+class ArchiveHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    '''
+    serves the files of the server's directory, with an ETag if the server has one and
+    Last-Modified only if the server sends it
+    '''
+
+    def do_GET(self):
+        self.server.requests.append(self.headers)
+        if self.server.etag and self.headers.getheader('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.server.downloads += 1
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_header(self, keyword, value):
+        if keyword == 'Last-Modified' and not self.server.last_modified:
+            return
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_header(self, keyword, value)
+
+    def end_headers(self):
+        if self.server.etag:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.send_header(self, 'ETag', self.server.etag)
+        SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+
+    def translate_path(self, path):
+        return os.path.join(self.server.directory, path.lstrip('/'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LandPolygonCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.served = os.path.join(self.directory, 'served')
+        self.data_dir = os.path.join(self.directory, 'data')
+        os.mkdir(self.served)
+        os.mkdir(self.data_dir)
+        self.write_archive('first')
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ArchiveHandler)
+        self.server.directory = self.served
+        self.server.etag = None
+        self.server.last_modified = False
+        self.server.requests = []
+        self.server.downloads = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/%s.zip' % (self.server.server_address[1], NAME)
+
+    def tearDown(self):
+        self.stop_server()
+        shutil.rmtree(self.directory)
+
+    def stop_server(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def write_archive(self, content):
+        with zipfile.ZipFile(os.path.join(self.served, NAME + '.zip'), 'w') as archive:
+            archive.writestr(NAME + '/land_polygons.shp', content)
+
+    def extracted(self):
+        with open(os.path.join(self.data_dir, NAME, 'land_polygons.shp')) as f:
+            return f.read()
+
+    def update(self, offline=False):
+        # a new cache every time, like a new run reading the info file
+        return landcache.LandPolygonCache(self.data_dir, NAME, self.url).update(offline)
+
+    def test_not_modified(self):
+        self.server.etag = '"1"'
+        self.assertTrue(self.update())
+        self.assertEqual('first', self.extracted())
+        self.assertFalse(self.update())
+        self.assertEqual('"1"', self.server.requests[-1].getheader('If-None-Match'))
+        self.assertEqual(1, self.server.downloads)
+
+        self.write_archive('second')
+        self.server.etag = '"2"'
+        self.assertTrue(self.update())
+        self.assertEqual('second', self.extracted())
+        self.assertEqual(2, self.server.downloads)
+
+    def test_last_modified(self):
+        self.server.last_modified = True
+        self.assertTrue(self.update())
+        self.assertFalse(self.update())
+        self.assertTrue(self.server.requests[-1].getheader('If-Modified-Since'))
+        self.assertEqual(None, self.server.requests[-1].getheader('If-None-Match'))
+
+    def test_server_without_validators(self):
+        self.assertTrue(self.update())
+        # the archive is downloaded again, but only extracted if it changed
+        self.assertFalse(self.update())
+        self.assertEqual(None, self.server.requests[-1].getheader('If-None-Match'))
+        self.assertEqual(None, self.server.requests[-1].getheader('If-Modified-Since'))
+        self.assertEqual(2, self.server.downloads)
+        self.write_archive('second')
+        self.assertTrue(self.update())
+        self.assertEqual('second', self.extracted())
+
+    def test_offline(self):
+        self.assertRaises(IOError, self.update, True)
+        self.assertTrue(self.update())
+        requests = len(self.server.requests)
+        self.assertFalse(self.update(True))
+        self.assertEqual(requests, len(self.server.requests))
+        self.assertEqual('first', self.extracted())
+
+    def test_server_unreachable(self):
+        self.assertTrue(self.update())
+        self.stop_server()
+        self.assertFalse(self.update())
+        self.assertEqual('first', self.extracted())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the polygon parsing and land clipping, run from the repository root with
+python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+# GDAL is only needed to read the land polygon shapefile
+try:
+    try:
+        from osgeo import ogr
+    except ImportError:
+        import ogr
+    import landextraction
+except ImportError:
+    sys.modules['ogr'] = types.ModuleType('ogr')
+    try:
+        import landextraction
+    finally:
+        del sys.modules['ogr']
+from shapely.geometry import MultiPolygon, Point, Polygon, box
+from shapely.ops import unary_union
+
+POLYGONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'polygons')
+
+HOLE = '''hole
+outer
+   0.0   0.0
+   10.0   0.0
+   10.0   10.0
+   0.0   10.0
+   0.0   0.0
+END
+!inner
+   2.5   2.5
+   4.0   2.5
+   4.0   4.0
+   2.5   2.5
+END
+END
+'''
+
+MULTI_PART = '''multi part
+1
+   -10.5   40.25
+   -5.0   40.25
+   -5.0   45.0
+   -10.5   40.25
+END
+2
+   5.0   50.0
+   15.0   50.0
+   15.0   55.0
+   5.0   55.0
+   5.0   50.0
+END
+!2 hole
+   6.0   51.0
+   7.0   51.0
+   7.0   52.0
+   6.0   51.0
+END
+3
+   1.0E1   -2.5E1
+   1.1E1   -2.5E1
+   1.1E1   -2.4E1
+   1.0E1   -2.5E1
+END
+END
+'''
+
+INDENTED_END = '''indented end
+1
+	8.0	47.0
+	9.0	47.0
+	9.0	48.0
+	8.0	47.0
+  END
+!hole
+	8.2	47.2
+	8.4	47.2
+	8.4	47.4
+	8.2	47.2
+	END
+ END
+'''
+
+
+def ring_coordinates(rings):
+    '''
+    the parsed rings with every vertex as a tuple, for both the arrays and the lists of the parsers
+    '''
+    return [([tuple(vertex) for vertex in outer], [[tuple(vertex) for vertex in hole] for hole in holes])
+            for (outer, holes) in rings]
+
+
+class ParsePolyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.extractor = landextraction.LandExtractor(self.directory, POLYGONS_DIR + '/')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertParsersAgree(self, text):
+        python_rings = self.extractor.parse_poly_rings_python(text.splitlines(True))
+        self.assertTrue(python_rings)
+        if landextraction.numpy is None:
+            return python_rings
+        numpy_rings = self.extractor.parse_poly_rings_numpy(text)
+        self.assertEqual(ring_coordinates(python_rings), ring_coordinates(numpy_rings))
+        self.assertEqual(MultiPolygon(python_rings).wkb, MultiPolygon(numpy_rings).wkb)
+        return python_rings
+
+    def test_shipped_polygons(self):
+        count = 0
+        for (directory, names, files) in os.walk(POLYGONS_DIR):
+            for name in sorted(files):
+                if name.endswith('.poly'):
+                    with open(os.path.join(directory, name)) as f:
+                        self.assertParsersAgree(f.read())
+                    count += 1
+        self.assertTrue(count > 100)
+
+    def test_hole(self):
+        rings = self.assertParsersAgree(HOLE)
+        self.assertEqual(1, len(rings))
+        self.assertEqual(1, len(rings[0][1]))
+        self.assertAlmostEqual(100 - 1.125, MultiPolygon(rings).area)
+
+    def test_multi_part(self):
+        rings = self.assertParsersAgree(MULTI_PART)
+        self.assertEqual([0, 1, 0], [len(holes) for (outer, holes) in rings])
+        self.assertEqual((10.0, -25.0), tuple(rings[2][0][0]))
+
+    def test_crlf(self):
+        rings = self.assertParsersAgree(HOLE.replace('\n', '\r\n'))
+        self.assertEqual(ring_coordinates(self.extractor.parse_poly_rings_python(HOLE.splitlines())),
+                         ring_coordinates(rings))
+        # the lines of a file opened in text mode keep their carriage returns
+        self.assertTrue(self.extractor.parse_poly(HOLE.replace('\n', '\r\n').splitlines(True)).equals(
+            self.extractor.parse_poly(HOLE)))
+
+    def test_indented_end(self):
+        rings = self.assertParsersAgree(INDENTED_END)
+        self.assertEqual(1, len(rings))
+        self.assertEqual(4, len(rings[0][0]))
+        self.assertEqual(1, len(rings[0][1]))
+
+
+class FieldDefn:
+    def __init__(self, name):
+        self.name = name
+
+    def GetName(self):
+        return self.name
+
+    def GetType(self):
+        return 0
+
+    def GetWidth(self):
+        return 10
+
+    def GetPrecision(self):
+        return 0
+
+
+class Geometry:
+    def __init__(self, polygon):
+        self.polygon = polygon
+
+    def ExportToWkb(self):
+        return self.polygon.wkb
+
+
+class Feature:
+    def __init__(self, polygon, fields):
+        self.polygon = polygon
+        self.fields = fields
+
+    def GetGeometryRef(self):
+        return Geometry(self.polygon)
+
+    def GetField(self, i):
+        return self.fields[i]
+
+
+class Layer:
+    def __init__(self, features):
+        self.features = list(features)
+
+    def GetName(self):
+        return 'land_polygons'
+
+    def GetLayerDefn(self):
+        return self
+
+    def GetFieldCount(self):
+        return 1
+
+    def GetFieldDefn(self, i):
+        return FieldDefn('FID')
+
+    def GetNextFeature(self):
+        if self.features:
+            return self.features.pop(0)
+        return None
+
+
+class DataSource:
+    '''
+    the parts of an ogr data source of land polygons the index reads
+    '''
+    def __init__(self, polygons):
+        self.layer = Layer(Feature(polygon, [i]) for (i, polygon) in enumerate(polygons))
+
+    def GetLayer(self, i):
+        return self.layer
+
+
+class IndexTree:
+    '''
+    a tree returning the indices of the polygons like the STRtree of shapely 2
+    '''
+    def __init__(self, polygons):
+        self.polygons = polygons
+
+    def query(self, geometry):
+        return [i for (i, polygon) in enumerate(self.polygons) if polygon.envelope.intersects(geometry.envelope)]
+
+
+def land_polygons():
+    '''
+    a grid of unit squares with a hole in one of them and a triangle across several squares
+    '''
+    polygons = [box(x, y, x + 1, y + 1) for x in range(6) for y in range(6)]
+    polygons[14] = Polygon(polygons[14].exterior.coords, [[(2.25, 2.25), (2.75, 2.25), (2.75, 2.75), (2.25, 2.25)]])
+    polygons.append(Polygon([(0.5, 5.5), (5.5, 0.5), (5.5, 5.5)]))
+    return polygons
+
+
+class LandPolygonIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.polygons = land_polygons()
+        self.index = landextraction.LandPolygonIndex(DataSource(self.polygons))
+
+    def assertClipsLikeIntersection(self, clip_geometry):
+        clipped = self.index.clip(clip_geometry)
+        expected = [(i, polygon.intersection(clip_geometry)) for (i, polygon) in enumerate(self.polygons)]
+        expected = [(i, geometry) for (i, geometry) in expected if geometry.area > 0]
+        # every clipped polygon keeps the attributes of its land polygon
+        self.assertEqual(sorted(set(i for (i, geometry) in expected)), sorted(set(a[0] for (p, a) in clipped)))
+        for (i, geometry) in expected:
+            parts = unary_union([p for (p, a) in clipped if a[0] == i])
+            self.assertAlmostEqual(0, parts.symmetric_difference(geometry).area)
+        self.assertTrue(all(p.geom_type == 'Polygon' for (p, a) in clipped))
+        return clipped
+
+    def test_read(self):
+        self.assertEqual(37, len(self.index.polygons))
+        self.assertEqual([[i] for i in range(37)], self.index.attributes)
+        self.assertEqual([('FID', 0, 10, 0)], self.index.fields)
+        self.assertEqual(36 * 5 + 4 + 4, self.index.vertices)
+
+    def test_clip_to_polygon(self):
+        self.assertClipsLikeIntersection(Point(3, 3).buffer(2))
+
+    def test_clip_to_box(self):
+        # the squares inside the box are not clipped at all
+        clipped = self.assertClipsLikeIntersection(box(0.5, 0.5, 4, 4))
+        self.assertIn(self.polygons[7].wkb, [p.wkb for (p, a) in clipped])
+
+    def test_clip_outside(self):
+        self.assertEqual([], self.index.clip(box(10, 10, 11, 11)))
+
+    def test_query_with_indices(self):
+        clip_geometry = Point(2, 4).buffer(1.5)
+        geometries = self.index.query(clip_geometry)
+        # the indices of shapely 2 and the geometries of older versions give the same land polygons
+        self.index.tree = IndexTree(self.polygons)
+        self.assertEqual(geometries, self.index.query(clip_geometry))
+        self.assertClipsLikeIntersection(clip_geometry)
+
+    @unittest.skipUnless(hasattr(landextraction.ogr, 'Open'), "GDAL is not installed")
+    def test_shapefile(self):
+        ogr = landextraction.ogr
+        directory = tempfile.mkdtemp()
+        try:
+            extractor = landextraction.LandExtractor(directory, POLYGONS_DIR + '/')
+            os.makedirs(os.path.join(directory, extractor.landfiles))
+            data_source = ogr.GetDriverByName("ESRI Shapefile").CreateDataSource(
+                os.path.join(directory, extractor.landfiles))
+            self.index.write_layer(data_source, zip(self.polygons, self.index.attributes))
+            data_source = None
+            loaded = []
+            extractor.land_index_listener = loaded.append
+            land_index = extractor.land_polygon_index(directory)
+            self.assertEqual([land_index], loaded)
+            self.assertEqual(len(self.polygons), len(land_index.polygons))
+            self.index = land_index
+            self.assertClipsLikeIntersection(Point(3, 3).buffer(2))
+        finally:
+            shutil.rmtree(directory)
+
+def write_polygon(path, coordinates):
+    with open(path, 'w') as f:
+        f.write('polygon\n1\n')
+        for (lon, lat) in coordinates + coordinates[:1]:
+            f.write('   %s   %s\n' % (lon, lat))
+        f.write('END\nEND\n')
+
+
+class ClippedLandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.polygon_dir = os.path.join(self.directory, 'polygons') + '/'
+        os.makedirs(self.polygon_dir + 'europe')
+        write_polygon(self.polygon_dir + 'europe.poly', [(0.4, 0.4), (5.6, 0.4), (5.6, 5.6), (3.1, 4.9), (0.4, 5.6)])
+        write_polygon(self.polygon_dir + 'europe/germany.poly', [(1.2, 1.3), (3.7, 1.5), (3.4, 3.9), (1.6, 3.3)])
+        # reaches out of the buffered polygon of europe
+        write_polygon(self.polygon_dir + 'europe/iceland.poly', [(4.5, 4.5), (5.5, 4.5), (5.8, 5.9), (4.5, 5.5)])
+        self.polygons = land_polygons()
+        self.index = landextraction.LandPolygonIndex(DataSource(self.polygons))
+        # the clipped land is taken from the extractor instead of the files written without GDAL
+        self.index.write_shapefile = lambda polygons, directory: None
+        self.shape2osm_run = landextraction.shape2osm.run
+        landextraction.shape2osm.run = lambda *args, **kwargs: None
+
+    def tearDown(self):
+        landextraction.shape2osm.run = self.shape2osm_run
+        shutil.rmtree(self.directory)
+
+    def extractor(self, clip_to_polygon):
+        extractor = landextraction.LandExtractor(os.path.join(self.directory, 'data'), self.polygon_dir,
+                                                 clip_to_polygon=clip_to_polygon)
+        extractor.land_index = self.index
+        return extractor
+
+    def clipped_land(self, extractor, region):
+        extractor.extract_land_polygons(region, self.directory)
+        return extractor.clipped_land[region][1]
+
+    def assertSameLand(self, expected, land):
+        self.assertEqual(sorted(set(a[0] for (p, a) in expected)), sorted(set(a[0] for (p, a) in land)))
+        for i in set(a[0] for (p, a) in expected):
+            difference = unary_union([p for (p, a) in expected if a[0] == i]).symmetric_difference(
+                unary_union([p for (p, a) in land if a[0] == i]))
+            self.assertAlmostEqual(0, difference.area)
+
+    def test_region_clip_geometry(self):
+        extractor = self.extractor(True)
+        polygon = extractor.read_polygon(self.polygon_dir + 'europe/germany.poly')
+        clip_geometry = extractor.region_clip_geometry('europe/germany')
+        # simplified with less than the buffer, the clip geometry still contains the polygon
+        self.assertTrue(clip_geometry.contains(polygon))
+        self.assertTrue(clip_geometry.within(polygon.buffer(landextraction.CLIP_BUFFER + 0.001)))
+        self.assertTrue(clip_geometry is extractor.region_clip_geometry('europe/germany'))
+        # a changed polygon gets a new clip geometry
+        write_polygon(self.polygon_dir + 'europe/germany.poly', [(1.2, 1.3), (3.7, 1.5), (3.4, 3.9)])
+        os.utime(self.polygon_dir + 'europe/germany.poly', (0, 0))
+        self.assertFalse(extractor.region_clip_geometry('europe/germany').contains(polygon))
+
+    def check_clipped_from_parent(self, clip_to_polygon):
+        extractor = self.extractor(clip_to_polygon)
+        self.clipped_land(extractor, 'europe')
+        if clip_to_polygon:
+            clip_geometry = extractor.region_clip_geometry('europe/germany')
+        else:
+            clip_geometry = box(*extractor.region_bbox('europe/germany'))
+        self.assertEqual('europe', extractor.enclosing_clipped_land('europe/germany', clip_geometry)[0])
+        self.assertSameLand(self.index.clip(clip_geometry), self.clipped_land(extractor, 'europe/germany'))
+
+    def test_clipped_from_parent_polygon(self):
+        self.check_clipped_from_parent(True)
+
+    def test_clipped_from_parent_bbox(self):
+        self.check_clipped_from_parent(False)
+
+    def test_parent_not_covering(self):
+        extractor = self.extractor(True)
+        self.clipped_land(extractor, 'europe')
+        clip_geometry = extractor.region_clip_geometry('europe/iceland')
+        self.assertEqual((None, None), extractor.enclosing_clipped_land('europe/iceland', clip_geometry))
+        # the land is clipped from the whole land polygon data instead
+        land = self.clipped_land(extractor, 'europe/iceland')
+        self.assertSameLand(self.index.clip(clip_geometry), land)
+        self.assertTrue(unary_union([p for (p, a) in land]).intersects(box(5.65, 5.65, 5.8, 5.8)))
+
+    def test_released_parent(self):
+        extractor = self.extractor(True)
+        self.clipped_land(extractor, 'europe')
+        extractor.release_clipped_land('europe')
+        self.assertEqual((None, None), extractor.enclosing_clipped_land(
+            'europe/germany', extractor.region_clip_geometry('europe/germany')))
+
+
+class ExtractPolygonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.polygon_dir = os.path.join(self.directory, 'polygons') + '/'
+        os.makedirs(self.polygon_dir)
+        self.polygon_file = self.polygon_dir + 'germany.poly'
+        # a detailed, jagged border: buffering and simplifying it removes most of its vertices
+        circle = Point(0, 0).buffer(1.0, 64).exterior.coords[:-1]
+        write_polygon(self.polygon_file, [(x + 0.01 * (i % 2), y) for (i, (x, y)) in enumerate(circle)])
+        self.extractor = landextraction.LandExtractor(os.path.join(self.directory, 'data'), self.polygon_dir,
+                                                      extract_buffer=0.05)
+        self.polygon = self.extractor.read_polygon(self.polygon_file)
+        self.simplification = landextraction.EXTRACT_SIMPLIFICATION
+
+    def tearDown(self):
+        landextraction.EXTRACT_SIMPLIFICATION = self.simplification
+        shutil.rmtree(self.directory)
+
+    def test_simplified_polygon(self):
+        (extract_file, vertices) = self.extractor.extract_polygon('germany')
+        self.assertNotEqual(self.polygon_file, extract_file)
+        with open(extract_file) as f:
+            simplified = self.extractor.parse_poly(f.read())
+        self.assertTrue(simplified.contains(self.polygon))
+        self.assertEqual(vertices, landextraction.vertex_count(simplified))
+        self.assertTrue(vertices < self.extractor.region_vertices('germany'))
+
+    def test_write_poly_round_trip(self):
+        path = os.path.join(self.directory, 'hole.poly')
+        polygon = self.extractor.parse_poly(HOLE)
+        landextraction.write_poly(polygon, 'hole', path)
+        with open(path) as f:
+            self.assertTrue(self.extractor.parse_poly(f.read()).equals(polygon))
+
+    def test_polygon_kept_if_not_contained(self):
+        # simplified by far more than the buffer, the polygon reaches out of it
+        landextraction.EXTRACT_SIMPLIFICATION = 5
+        self.assertEqual((self.polygon_file, self.extractor.region_vertices('germany')),
+                         self.extractor.extract_polygon('germany'))
+
+    def cache_extract_vertices(self, vertices):
+        self.extractor.polygon_cache.get(self.polygon_file, 'extract:%s:%s' % (
+            self.extractor.extract_buffer, landextraction.EXTRACT_SIMPLIFICATION), lambda polygon_file: vertices)
+
+    def test_removed_extract_polygon_is_written_again(self):
+        (extract_file, vertices) = self.extractor.extract_polygon('germany')
+        os.remove(extract_file)
+        self.assertEqual((extract_file, vertices), self.extractor.extract_polygon('germany'))
+        self.assertTrue(os.path.exists(extract_file))
+
+    def test_vertices_of_the_written_extract_polygon(self):
+        # e.g. counted by another version, the vertices of the polygon written again are returned
+        self.cache_extract_vertices(999)
+        (extract_file, vertices) = self.extractor.extract_polygon('germany')
+        with open(extract_file) as f:
+            self.assertEqual(landextraction.vertex_count(self.extractor.parse_poly(f.read())), vertices)
+        self.assertEqual((extract_file, vertices), self.extractor.extract_polygon('germany'))
+        # the region polygon if the extract polygon is no longer written
+        os.remove(extract_file)
+        landextraction.EXTRACT_SIMPLIFICATION = 5
+        self.cache_extract_vertices(vertices)
+        self.assertEqual((self.polygon_file, self.extractor.region_vertices('germany')),
+                         self.extractor.extract_polygon('germany'))
+
+
+if __name__ == '__main__':
+    unittest.main()
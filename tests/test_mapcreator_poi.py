@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the osmosis calls of mapcreator_poi, run from the repository root with
+python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+# the tests only build osmosis calls, GDAL is only imported
+try:
+    try:
+        from osgeo import ogr
+    except ImportError:
+        import ogr
+    import mapcreator_poi
+except ImportError:
+    sys.modules['ogr'] = types.ModuleType('ogr')
+    try:
+        import mapcreator_poi
+    finally:
+        del sys.modules['ogr']
+import landextraction
+import osmpbf
+
+POLYGON = '''germany
+1
+   5.8   47.2
+   15.1   47.2
+   15.1   55.1
+   5.8   55.1
+END
+END
+'''
+
+
+class CallRecorded(Exception):
+    pass
+
+
+class MapPoiCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        os.makedirs('polygons/europe')
+        with open('polygons/europe/germany.poly', 'w') as f:
+            f.write(POLYGON)
+        self.download_land_polygons = landextraction.LandExtractor.download_land_polygons
+        landextraction.LandExtractor.download_land_polygons = lambda self, *args: None
+        self.creator = mapcreator_poi.MapCreator('osmosis', 'data', 'maps', 'pois', 'polygons', 'planet.osm.pbf',
+                                                 'target', 'poi-target', 'logs', 14, 'en', dry_run=True, single_pass=True)
+        self.calls = []
+        def run_osmosis(osmosis_call, *args):
+            self.calls.append(osmosis_call)
+            raise CallRecorded()
+        self.creator.run_osmosis = run_osmosis
+
+    def tearDown(self):
+        landextraction.LandExtractor.download_land_polygons = self.download_land_polygons
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_map_poi_call(self):
+        self.assertRaises(CallRecorded, self.creator.call_create_map_poi, 'europe.osm.pbf', 'europe/', 'europe/',
+                          'europe/', 'europe/', 'germany', True, 14, 'en', '', 'hd')
+        self.assertEqual(1, len(self.calls))
+        # the bounding boxes are the ones of the polygon with a buffer
+        self.assertEqual(['osmosis', '--rb', 'data/europe.osm.pbf', '--bp', 'completeWays=yes', 'completeRelations=yes',
+                          'clipIncompleteEntities=false', 'file=polygons/europe/germany.poly',
+                          '--tee', '2', 'outPipe.0=map', 'outPipe.1=poi',
+                          '--rx', 'file=data/europe-germany-sea.osm', '--sort', '--merge', 'inPipe.0=map',
+                          '--rx', 'file=data/europe-germany.osm', '--sort', '--merge',
+                          '--mw', 'file=maps/europe/germany.map', '', 'type=hd', 'map-start-zoom=14', 'preferred-languages=en',
+                          'bbox=47.1,5.7,55.2,15.2',
+                          '--pw', 'file=pois/europe/germany.poi', 'inPipe.0=poi', 'bbox=47.1,5.7,55.2,15.2'],
+                         self.calls[0])
+
+
+    def test_storage_type_and_heap_from_memory_budget(self):
+        self.creator.memory_budget = 2000
+        heaps = []
+        def run_osmosis(osmosis_call, log_name, part, stage_name, inputs, outputs, heap=0):
+            self.calls.append(osmosis_call)
+            heaps.append(heap)
+        self.creator.run_osmosis = run_osmosis
+        # the heap the map task was admitted with is passed on to the map writer
+        self.creator.map_heaps['europe/germany'] = 500
+        self.creator.call_create_map_poi('europe.osm.pbf', 'europe/', 'europe/', 'europe/', 'europe/', 'germany',
+                                         True, 14, 'en', '')
+        self.assertIn('type=ram', self.calls[0])
+        self.assertEqual([500], heaps)
+        self.assertEqual({}, self.creator.map_heaps)
+
+    def test_heap_only_with_a_budget(self):
+        self.creator.memory_budget = 2000
+        self.assertEqual('-Xmx500m', self.creator.osmosis_environment(500)['JAVACMD_OPTIONS'].split()[-1])
+        self.assertEqual(500, self.creator.worker_heap(500))
+        self.creator.memory_budget = 0
+        # without a budget the JVM takes its default heap
+        self.assertEqual(0, self.creator.worker_heap(500))
+
+
+class SplitCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        os.makedirs('polygons/europe')
+        for name in ('germany', 'austria'):
+            with open('polygons/europe/%s.poly' % name, 'w') as f:
+                f.write(POLYGON)
+        os.makedirs('data')
+        with open('data/europe.osm.pbf', 'w') as f:
+            f.write('pbf')
+        self.download_land_polygons = landextraction.LandExtractor.download_land_polygons
+        landextraction.LandExtractor.download_land_polygons = lambda self, *args: None
+        self.creator = mapcreator_poi.MapCreator('osmosis', 'data', 'maps', 'pois', 'polygons', 'planet.osm.pbf',
+                                                 'target', 'poi-target', 'logs', 14, 'en')
+        self.creator.osmosis_version = lambda: 'osmosis'
+        self.calls = []
+        self.check_call = mapcreator_poi.osmosisworker.check_call
+        def check_call(workers, osmosis_call, logfile, *args):
+            self.calls.append(osmosis_call)
+            for arg in osmosis_call:
+                if arg.startswith('file=data/'):
+                    with open(arg[len('file='):], 'w') as f:
+                        f.write('pbf')
+        mapcreator_poi.osmosisworker.check_call = check_call
+
+    def tearDown(self):
+        mapcreator_poi.osmosisworker.check_call = self.check_call
+        landextraction.LandExtractor.download_land_polygons = self.download_land_polygons
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_sibling_pbfs_in_one_call(self):
+        results = self.creator.call_create_pbfs('europe.osm.pbf', 'europe/', ['germany', 'austria'])
+        self.assertEqual({'germany': 'europe/germany.osm.pbf', 'austria': 'europe/austria.osm.pbf'}, results)
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual(['osmosis', '--rb', 'data/europe.osm.pbf', '--tee', '2',
+                          '--bp', 'completeWays=yes', 'completeRelations=yes', 'clipIncompleteEntities=false',
+                          'file=polygons/europe/germany.poly',
+                          '--wb', 'omitmetadata=false', 'compress=deflate', 'file=data/europe/germany.osm.pbf',
+                          '--bp', 'completeWays=yes', 'completeRelations=yes', 'clipIncompleteEntities=false',
+                          'file=polygons/europe/austria.poly',
+                          '--wb', 'omitmetadata=false', 'compress=deflate', 'file=data/europe/austria.osm.pbf'],
+                         self.calls[0])
+
+    def test_missing_polygon_fails_only_its_part(self):
+        os.remove('polygons/europe/austria.poly')
+        results = self.creator.call_create_pbfs('europe.osm.pbf', 'europe/', ['germany', 'austria'])
+        self.assertEqual('europe/germany.osm.pbf', results['germany'])
+        self.assertTrue(isinstance(results['austria'], mapcreator_poi.ProcessingException))
+        self.assertEqual(['--rb', 'data/europe.osm.pbf', '--bp'], self.calls[0][1:4])
+
+    def test_pbf_of_resumed_split(self):
+        # the split was done by the resumed run, so there are no results of it
+        action = self.creator.pbf_action({}, 'germany', 'data/europe/germany.osm.pbf')
+        self.assertRaises(mapcreator_poi.ProcessingException, action)
+        # an incomplete pbf is not used either
+        os.makedirs('data/europe')
+        with open('data/europe/germany.osm.pbf', 'w') as f:
+            f.write('pbf')
+        self.assertRaises(mapcreator_poi.ProcessingException, action)
+        writer = osmpbf.PbfWriter('data/europe/germany.osm.pbf')
+        writer.add_node(1, 8.5, 47.25)
+        writer.close()
+        action()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of reading the changed area from osm change files, run from the repository
+root with python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from shapely.geometry import box
+
+import osmchange
+
+CHANGES = '''<osmChange version="0.6">
+<modify><node id="1" lat="48.1" lon="11.5"/></modify>
+<modify><way id="5"><nd ref="1"/><nd ref="2"/></way></modify>
+%s
+</osmChange>'''
+
+UNLOCATED_WAY = '<modify><way id="6"><nd ref="2"/><nd ref="3"/></way></modify>'
+
+
+class ChangedAreaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def change_file(self, entities=''):
+        path = os.path.join(self.directory, 'changes.osc')
+        with open(path, 'w') as f:
+            f.write(CHANGES % entities)
+        return path
+
+    def test_located_changes(self):
+        changed_area = osmchange.read_changed_area(self.change_file())
+        self.assertEqual(0, changed_area.unlocated)
+        self.assertTrue(changed_area.intersects(box(11, 48, 12, 49)))
+        self.assertFalse(changed_area.intersects(box(2, 48, 3, 49)))
+
+    def test_unlocated_changes_change_all_parts(self):
+        changed_area = osmchange.read_changed_area(self.change_file(UNLOCATED_WAY))
+        self.assertEqual(1, changed_area.unlocated)
+        self.assertTrue(changed_area.intersects(box(2, 48, 3, 49)))
+
+    def test_ignore_unlocated_changes(self):
+        changed_area = osmchange.read_changed_area(self.change_file(UNLOCATED_WAY), ignore_unlocated=True)
+        self.assertEqual(1, changed_area.unlocated)
+        self.assertTrue(changed_area.intersects(box(11, 48, 12, 49)))
+        self.assertFalse(changed_area.intersects(box(2, 48, 3, 49)))
+
+
+if __name__ == '__main__':
+    unittest.main()
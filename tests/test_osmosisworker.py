@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the osmosis worker pool with the stub worker, run from the repository
+root with python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import osmosisworker
+
+RESOURCES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resources')
+STUB_OSMOSIS = os.path.join(RESOURCES, 'stub-osmosis')
+STUB_WORKER = os.path.join(RESOURCES, 'stub-osmosis-worker')
+
+# a worker that answers the given number of calls without running them and then exits
+DYING_WORKER = '''
+import sys
+for call in range(%d):
+    sys.stdin.readline()
+    sys.stdout.write('exit 0\\n')
+    sys.stdout.flush()
+'''
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.logfile = open(os.path.join(self.directory, 'osmosis.log'), 'a')
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        self.logfile.close()
+        shutil.rmtree(self.directory)
+
+    def pool(self, command, size=1, heap=0):
+        pool = osmosisworker.WorkerPool(command, size, heap)
+        self.pools.append(pool)
+        return pool
+
+    def output(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_calls_run_on_worker(self):
+        pool = self.pool([sys.executable, STUB_WORKER])
+        self.assertTrue(pool.run(['--wb', 'file=' + self.output('a.pbf')], self.logfile))
+        self.assertTrue(pool.run(['--wb', 'file=' + self.output('b.pbf')], self.logfile))
+        self.assertEqual(1, len(pool.workers))
+        self.assertEqual(2, pool.workers[0].calls)
+        with open(self.output('b.pbf')) as f:
+            self.assertEqual('stub --wb\n', f.read())
+
+    def test_failed_call(self):
+        pool = self.pool([sys.executable, STUB_WORKER])
+        self.assertRaises(subprocess.CalledProcessError, pool.run,
+                          ['--wb', 'file=' + self.output('missing/a.pbf')], self.logfile)
+        # the worker is still used for the next call
+        self.assertTrue(pool.run(['--wb', 'file=' + self.output('a.pbf')], self.logfile))
+        self.assertEqual(1, len(pool.workers))
+
+    def test_heap(self):
+        pool = self.pool([sys.executable, STUB_WORKER], heap=1000)
+        self.assertTrue(pool.run(['--wb', 'file=' + self.output('a.pbf')], self.logfile, 500))
+        self.assertFalse(pool.run(['--wb', 'file=' + self.output('b.pbf')], self.logfile, 2000))
+        self.assertFalse(os.path.exists(self.output('b.pbf')))
+        # without a known worker heap only calls without a heap estimate run on the workers
+        pool = self.pool([sys.executable, STUB_WORKER])
+        self.assertFalse(pool.run(['--wb', 'file=' + self.output('c.pbf')], self.logfile, 500))
+        self.assertTrue(pool.run(['--wb', 'file=' + self.output('c.pbf')], self.logfile))
+
+    def test_worker_dies(self):
+        pool = self.pool([sys.executable, '-c', DYING_WORKER % 1])
+        self.assertTrue(pool.run(['--wb', 'file=' + self.output('a.pbf')], self.logfile))
+        # the call the worker died in runs in a new osmosis process
+        osmosis_call = ['sh', STUB_OSMOSIS, '--wb', 'file=' + self.output('b.pbf')]
+        self.assertEqual(0, osmosisworker.check_call(pool, osmosis_call, self.logfile))
+        self.assertTrue(os.path.exists(self.output('b.pbf')))
+        self.assertEqual([], pool.workers)
+        # the worker had completed a call, so the next call starts a new one
+        self.assertFalse(pool.disabled)
+        self.assertTrue(pool.run(['--wb', 'file=' + self.output('c.pbf')], self.logfile))
+        self.assertEqual(1, len(pool.workers))
+
+    def test_worker_dies_before_first_call(self):
+        pool = self.pool([sys.executable, '-c', DYING_WORKER % 0], size=2)
+        self.assertFalse(pool.run(['--wb', 'file=' + self.output('a.pbf')], self.logfile))
+        self.assertTrue(pool.disabled)
+        self.assertFalse(pool.run(['--wb', 'file=' + self.output('a.pbf')], self.logfile))
+        self.assertEqual([], pool.workers)
+
+    def test_worker_cannot_start(self):
+        pool = self.pool([self.output('missing-worker')])
+        self.assertFalse(pool.run(['--wb', 'file=' + self.output('a.pbf')], self.logfile))
+        self.assertTrue(pool.disabled)
+        osmosis_call = ['sh', STUB_OSMOSIS, '--wb', 'file=' + self.output('a.pbf')]
+        self.assertEqual(0, osmosisworker.check_call(pool, osmosis_call, self.logfile))
+        self.assertTrue(os.path.exists(self.output('a.pbf')))
+
+
+if __name__ == '__main__':
+    unittest.main()
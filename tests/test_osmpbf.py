@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the osm pbf writer, the written files are decoded again, run from the
+repository root with python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+import zlib
+
+import osmpbf
+
+
+def unpack(data, signed=False):
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = osmpbf.read_varint(data, pos)
+        if signed:
+            value = (value >> 1) ^ -(value & 1)
+        elif value >= 1 << 63:
+            value -= 1 << 64
+        values.append(value)
+    return values
+
+
+def undelta(values):
+    total = 0
+    result = []
+    for value in values:
+        total += value
+        result.append(total)
+    return result
+
+
+def read_blocks(path):
+    '''
+    the (type, decompressed data) of all blocks of a pbf file
+    '''
+    blocks = []
+    with open(path, 'rb') as f:
+        while True:
+            length = f.read(4)
+            if not length:
+                return blocks
+            blob_header = dict(osmpbf.decode_fields(f.read(struct.unpack('!I', length)[0])))
+            blob = dict(osmpbf.decode_fields(f.read(blob_header[3])))
+            data = zlib.decompress(blob[3])
+            assert len(data) == blob[2]
+            blocks.append((blob_header[1], data))
+
+
+def decode_entities(data):
+    '''
+    the nodes, ways and relations of a primitive block with their tags resolved
+    '''
+    fields = osmpbf.decode_fields(data)
+    strings = [value for (field, value) in osmpbf.decode_fields(dict(fields)[1])]
+    entities = []
+    for (field, group) in fields:
+        if field != 2:
+            continue
+        for (kind, message) in osmpbf.decode_fields(group):
+            entity = dict(osmpbf.decode_fields(message))
+            if kind == 2:
+                ids = undelta(unpack(entity[1], True))
+                lats = undelta(unpack(entity[8], True))
+                lons = undelta(unpack(entity[9], True))
+                keys_vals = unpack(entity.get(10, ''))
+                for (node_id, lat, lon) in zip(ids, lats, lons):
+                    tags = []
+                    while keys_vals and keys_vals[0]:
+                        tags.append((strings[keys_vals[0]], strings[keys_vals[1]]))
+                        keys_vals = keys_vals[2:]
+                    keys_vals = keys_vals[1:]
+                    entities.append(('node', node_id, (lon * 1e-7, lat * 1e-7), tags))
+                continue
+            tags = zip([strings[i] for i in unpack(entity.get(2, ''))], [strings[i] for i in unpack(entity.get(3, ''))])
+            if kind == 3:
+                entities.append(('way', entity[1], undelta(unpack(entity[8], True)), tags))
+            elif kind == 4:
+                members = zip([('node', 'way', 'relation')[t] for t in unpack(entity[10])],
+                              undelta(unpack(entity[9], True)), [strings[i] for i in unpack(entity[8])])
+                entities.append(('relation', entity[1], members, tags))
+    return entities
+
+
+class PbfWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'land.osm.pbf')
+        self.block_entities = osmpbf.BLOCK_ENTITIES
+
+    def tearDown(self):
+        osmpbf.BLOCK_ENTITIES = self.block_entities
+        shutil.rmtree(self.directory)
+
+    def write(self):
+        writer = osmpbf.PbfWriter(self.path)
+        writer.add_node(10, 8.5, 47.25)
+        writer.add_node(11, -8.5, -47.25, [('natural', 'sea')])
+        writer.add_node(13, 179.9999999, 0.0000001)
+        writer.add_way(20, [10, 11, 13, 10], [('area', 'yes'), ('natural', 'sea')])
+        writer.add_way(21, [13, 11])
+        writer.add_relation(30, [('way', 20, 'outer'), ('way', 21, 'inner')], [('type', 'multipolygon')])
+        writer.close()
+
+    def test_round_trip(self):
+        self.write()
+        blocks = read_blocks(self.path)
+        self.assertEqual(['OSMHeader', 'OSMData', 'OSMData', 'OSMData'], [block_type for (block_type, data) in blocks])
+        entities = []
+        for (block_type, data) in blocks[1:]:
+            entities += decode_entities(data)
+        self.assertEqual([('node', 10, []), ('node', 11, [('natural', 'sea')]), ('node', 13, []),
+                          ('way', 20, [('area', 'yes'), ('natural', 'sea')]), ('way', 21, []),
+                          ('relation', 30, [('type', 'multipolygon')])],
+                         [(entity[0], entity[1], entity[3]) for entity in entities])
+        for (entity, (lon, lat)) in zip(entities, [(8.5, 47.25), (-8.5, -47.25), (179.9999999, 0.0000001)]):
+            self.assertAlmostEqual(lon, entity[2][0], 7)
+            self.assertAlmostEqual(lat, entity[2][1], 7)
+        self.assertEqual([10, 11, 13, 10], entities[3][2])
+        self.assertEqual([13, 11], entities[4][2])
+        self.assertEqual([('way', 20, 'outer'), ('way', 21, 'inner')], entities[5][2])
+
+    def test_header(self):
+        self.write()
+        header = osmpbf.read_header(self.path)
+        self.assertEqual('Sort.Type_then_ID', header[5])
+        self.assertEqual('mapcreator', header[16])
+        features = [value for (field, value) in osmpbf.decode_fields(read_blocks(self.path)[0][1]) if field == 4]
+        self.assertEqual(['OsmSchema-V0.6', 'DenseNodes'], features)
+
+    def test_sorted_by_type_with_full_blocks(self):
+        osmpbf.BLOCK_ENTITIES = 2
+        writer = osmpbf.PbfWriter(self.path)
+        for node_id in range(1, 6):
+            writer.add_node(node_id, node_id, node_id)
+        for way_id in range(1, 4):
+            writer.add_way(way_id, [way_id, way_id + 1])
+        writer.close()
+        entities = []
+        for (block_type, data) in read_blocks(self.path)[1:]:
+            entities += decode_entities(data)
+        self.assertEqual([('node', i) for i in range(1, 6)] + [('way', i) for i in range(1, 4)],
+                         [(entity[0], entity[1]) for entity in entities])
+
+    def test_named_pipe_without_spool_file(self):
+        def no_spool(*args, **kwargs):
+            raise AssertionError("a spool file was created")
+        temporary_file = osmpbf.tempfile.TemporaryFile
+        osmpbf.tempfile.TemporaryFile = no_spool
+        os.mkfifo(self.path)
+        received = []
+        def read():
+            with open(self.path, 'rb') as f:
+                received.append(f.read())
+        reader = threading.Thread(target=read)
+        reader.start()
+        try:
+            self.write()
+        finally:
+            osmpbf.tempfile.TemporaryFile = temporary_file
+            reader.join()
+        os.remove(self.path)
+        with open(self.path, 'wb') as f:
+            f.write(received[0])
+        entities = []
+        for (block_type, data) in read_blocks(self.path)[1:]:
+            entities += decode_entities(data)
+        self.assertEqual(['node', 'node', 'node', 'way', 'way', 'relation'], [entity[0] for entity in entities])
+
+    def test_ids_must_increase(self):
+        writer = osmpbf.PbfWriter(self.path)
+        writer.add_node(2, 0, 0)
+        self.assertRaises(ValueError, writer.add_node, 2, 0, 0)
+        writer.close()
+
+    def test_truncated_file_is_incomplete(self):
+        self.write()
+        self.assertTrue(osmpbf.is_complete(self.path))
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data[:-3])
+        self.assertFalse(osmpbf.is_complete(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the automatic insertion of intermediate pbf extracts, run from the
+repository root with python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from xml.etree import ElementTree as ET
+
+# the tests only schedule osmosis calls, GDAL is only imported
+try:
+    try:
+        from osgeo import ogr
+    except ImportError:
+        import ogr
+    import mapcreator
+except ImportError:
+    sys.modules['ogr'] = types.ModuleType('ogr')
+    try:
+        import mapcreator
+    finally:
+        del sys.modules['ogr']
+import costmodel
+import landextraction
+import scheduler
+
+# bounding boxes of the polygons as minlon, minlat, maxlon, maxlat
+POLYGONS = {
+    'europe': (-10, 35, 30, 70),
+    'europe/germany': (5.8, 47.2, 15.1, 55.1),
+    'europe/germany/bavaria': (8.9, 47.2, 13.9, 50.6),
+    'europe/germany/saxony': (11.8, 50.1, 15.1, 51.7),
+    'europe/austria': (9.5, 46.3, 17.2, 49.1),
+}
+
+CONFIGURATION = '''<mapcreator-config>
+    <part name="europe" create-map="false">
+        <part name="germany">
+            <part name="bavaria"/>
+            <part name="saxony"/>
+        </part>
+        <part name="austria"/>
+    </part>
+</mapcreator-config>'''
+
+
+def write_polygon(path, bbox):
+    (minlon, minlat, maxlon, maxlat) = bbox
+    with open(path, 'w') as f:
+        f.write('polygon\n1\n')
+        for (lon, lat) in [(minlon, minlat), (maxlon, minlat), (maxlon, maxlat), (minlon, maxlat), (minlon, minlat)]:
+            f.write('   %s   %s\n' % (lon, lat))
+        f.write('END\nEND\n')
+
+
+class ExtractSavingTest(unittest.TestCase):
+
+    def test_saves_for_many_readers_of_a_large_source(self):
+        self.assertTrue(costmodel.extract_saving(40000, 4000, 4, 100, 400) > 0)
+
+    def test_costs_for_a_single_reader(self):
+        self.assertTrue(costmodel.extract_saving(40000, 4000, 1, 100, 100) < 0)
+
+    def test_costs_for_a_small_source(self):
+        # the start of osmosis outweighs reading a small source a few more times
+        self.assertTrue(costmodel.extract_saving(10, 1, 3, 100, 300) < 0)
+
+
+class InsertPbfExtractsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        for (region, bbox) in POLYGONS.items():
+            if not os.path.exists(os.path.dirname('polygons/' + region)):
+                os.makedirs(os.path.dirname('polygons/' + region))
+            write_polygon('polygons/%s.poly' % region, bbox)
+        self.download_land_polygons = landextraction.LandExtractor.download_land_polygons
+        landextraction.LandExtractor.download_land_polygons = lambda self, *args: None
+        self.creator = mapcreator.MapCreator('osmosis', 'data', 'maps', 'polygons', 'planet.osm.pbf',
+                                             'target', 'logs', 14, 'en', dry_run=True)
+        self.creator.osmosis_version = lambda: 'osmosis'
+        self.creator.land_version = lambda: 'land'
+        self.root = ET.fromstring(CONFIGURATION)
+
+    def tearDown(self):
+        landextraction.LandExtractor.download_land_polygons = self.download_land_polygons
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def part(self, region):
+        element = self.root
+        for name in region.split('/'):
+            element = [child for child in element if child.get('name') == name][0]
+        return element
+
+    def test_source_readers(self):
+        # the maps of germany, bavaria, saxony and austria read the planet
+        (readers, vertices) = self.creator.source_readers(self.part('europe'), '')
+        self.assertEqual(4, readers)
+        self.assertEqual(20, vertices)
+        self.creator.inserted_pbfs.add(self.part('europe/germany'))
+        # one extract of germany replaces the maps of germany and its sub parts
+        (readers, vertices) = self.creator.source_readers(self.part('europe'), '')
+        self.assertEqual(2, readers)
+        self.assertEqual(10, vertices)
+
+    def test_extract_inserted_for_a_large_source(self):
+        regions = self.creator.insert_pbf_extracts(self.root, 'planet.osm.pbf', source_size=40000)
+        # europe is read by four maps, germany by three, austria only by its own map
+        self.assertEqual(['europe', 'europe/germany'], regions)
+        for region in ('europe', 'europe/germany'):
+            self.assertTrue(self.creator.read_part_attributes(self.part(region))[1])
+        for region in ('europe/austria', 'europe/germany/bavaria'):
+            self.assertFalse(self.creator.read_part_attributes(self.part(region))[1])
+        # the configuration is left as it is
+        self.assertEqual(ET.tostring(ET.fromstring(CONFIGURATION)), ET.tostring(self.root))
+
+    def test_no_extract_for_a_small_source(self):
+        self.assertEqual([], self.creator.insert_pbf_extracts(self.root, 'planet.osm.pbf', source_size=10))
+        self.assertFalse(self.creator.read_part_attributes(self.part('europe'))[1])
+
+    def test_sub_parts_read_the_extract(self):
+        self.creator.insert_pbf_extracts(self.root, 'planet.osm.pbf', source_size=40000)
+        part_scheduler = scheduler.PartScheduler(1)
+        self.creator.schedulePart(part_scheduler, self.root, None, None, 'planet.osm.pbf', '', '', '', 0)
+        tasks = dict((task.name, task) for task in part_scheduler.tasks)
+        self.assertEqual(['data/planet.osm.pbf'], tasks[':split'].inputs)
+        self.assertEqual(['data/europe.osm.pbf'], tasks[':split'].outputs)
+        self.assertEqual(['data/europe.osm.pbf'], tasks['europe/:split'].inputs)
+        self.assertEqual(['data/europe/germany.osm.pbf'], tasks['europe/:split'].outputs)
+        self.assertEqual('data/europe.osm.pbf', tasks['europe/austria.map'].inputs[0])
+        for region in ('europe/germany', 'europe/germany/bavaria', 'europe/germany/saxony'):
+            self.assertEqual('data/europe/germany.osm.pbf', tasks[region + '.map'].inputs[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the task scheduler, run from the repository root with
+python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import journal
+import scheduler
+
+# runs a scheduler in a process of its own: the first task starts a child process that
+# sleeps and ignores SIGINT, like an osmosis call that takes a while to stop, the second
+# one depends on it and writes a marker file
+INTERRUPTED_RUN = '''
+import subprocess, sys
+sys.path.insert(0, %(root)r)
+import scheduler
+def sleep():
+    subprocess.check_call(['sh', '-c', 'trap "" INT; sleep 30'])
+def mark():
+    open(%(marker)r, 'w').close()
+part_scheduler = scheduler.PartScheduler(1)
+first = part_scheduler.add('sleep', sleep)
+part_scheduler.add('mark', mark, always_run=True, dependencies=[first])
+print 'started'
+sys.stdout.flush()
+part_scheduler.run()
+'''
+
+# a journaled run of a single job, the second task is interrupted while its child process runs
+JOURNALED_RUN = '''
+import logging, subprocess, sys
+sys.path.insert(0, %(root)r)
+import journal, scheduler
+logging.basicConfig()
+def touch(path):
+    open(path, 'w').close()
+def sleep():
+    process = subprocess.Popen(['sleep', '30'])
+    print 'started'
+    sys.stdout.flush()
+    if process.wait():
+        raise Exception('interrupted')
+    touch(%(second)r)
+task_journal = journal.TaskJournal(%(journal)r)
+part_scheduler = scheduler.PartScheduler(1, journal=task_journal)
+first = part_scheduler.add('first', lambda: touch(%(first)r), outputs=[%(first)r])
+second = part_scheduler.add('second', sleep, [first], outputs=[%(second)r])
+part_scheduler.add('third', lambda: touch(%(third)r), [second], outputs=[%(third)r])
+try:
+    part_scheduler.run()
+finally:
+    task_journal.close()
+'''
+
+
+class PartSchedulerTest(unittest.TestCase):
+
+    def test_dependencies(self):
+        order = []
+        def fail():
+            raise ValueError("failed")
+        part_scheduler = scheduler.PartScheduler(2)
+        first = part_scheduler.add('first', lambda: order.append('first'))
+        failing = part_scheduler.add('failing', fail, [first])
+        skipped = part_scheduler.add('skipped', lambda: order.append('skipped'), [failing])
+        cleanup = part_scheduler.add('cleanup', lambda: order.append('cleanup'), [skipped], always_run=True)
+        self.assertTrue(part_scheduler.run())
+        self.assertEqual(['first', 'cleanup'], order)
+        self.assertEqual(scheduler.FAILED, failing.state)
+        self.assertEqual(scheduler.SKIPPED, skipped.state)
+        self.assertEqual(scheduler.DONE, cleanup.state)
+
+    def test_memory_budget(self):
+        lock = threading.Lock()
+        memory_in_use = [0]
+        peak_memory = [0]
+        def run(memory):
+            def action():
+                with lock:
+                    memory_in_use[0] += memory
+                    peak_memory[0] = max(peak_memory[0], memory_in_use[0])
+                time.sleep(0.2)
+                with lock:
+                    memory_in_use[0] -= memory
+            return action
+        part_scheduler = scheduler.PartScheduler(4, memory_budget=100)
+        for (index, memory) in enumerate([60, 50, 40, 30, 70]):
+            # the memory of a task is estimated once it becomes ready
+            part_scheduler.add('task%d' % index, run(memory), memory=lambda memory=memory: memory)
+        self.assertFalse(part_scheduler.run())
+        # the first and the third task fill the budget, the second one waits for them
+        self.assertEqual(100, peak_memory[0])
+
+    def test_reserved_memory(self):
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+        def run():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.2)
+            with lock:
+                running[0] -= 1
+        part_scheduler = scheduler.PartScheduler(2, memory_budget=100)
+        # e.g. the land polygon index loaded by the first task, the other two no longer fit next to each other
+        first = part_scheduler.add('first', lambda: part_scheduler.reserve(60))
+        part_scheduler.add('second', run, [first], memory=30)
+        part_scheduler.add('third', run, [first], memory=30)
+        self.assertFalse(part_scheduler.run())
+        self.assertEqual(1, peak[0])
+        self.assertEqual(60, part_scheduler.memory_in_use)
+
+    def test_fits(self):
+        self.assertTrue(scheduler.fits(100, 1, 60, scheduler.Task('task', None, memory=40)))
+        self.assertFalse(scheduler.fits(100, 1, 60, scheduler.Task('task', None, memory=50)))
+        # a task larger than the budget runs alone rather than never
+        self.assertTrue(scheduler.fits(100, 0, 0, scheduler.Task('task', None, memory=200)))
+        self.assertTrue(scheduler.fits(0, 3, 500, scheduler.Task('task', None, memory=200)))
+
+    def simulated(self, jobs, memory_budget=0):
+        part_scheduler = scheduler.PartScheduler(jobs, memory_budget)
+        durations = {}
+        def add(name, seconds, memory, dependencies=()):
+            task = part_scheduler.add(name, None, dependencies, memory=memory)
+            durations[task] = seconds
+            return task
+        extract = add('extract', 10, 100)
+        germany = add('germany', 5, 200, [extract])
+        austria = add('austria', 8, 300, [extract])
+        add('poi', 2, 50, [germany, austria])
+        (schedule, peak_memory, peak_disk) = part_scheduler.simulate(lambda task: durations[task])
+        return ([(task.name, start, end) for (task, start, end) in schedule], peak_memory)
+
+    def test_simulate(self):
+        self.assertEqual(([('extract', 0, 10), ('germany', 10, 15), ('austria', 10, 18), ('poi', 18, 20)], 500),
+                         self.simulated(2))
+        self.assertEqual(([('extract', 0, 10), ('germany', 10, 15), ('austria', 15, 23), ('poi', 23, 25)], 300),
+                         self.simulated(1))
+
+    def test_simulate_memory_budget(self):
+        # the two maps no longer run next to each other
+        self.assertEqual(([('extract', 0, 10), ('germany', 10, 15), ('austria', 15, 23), ('poi', 23, 25)], 300),
+                         self.simulated(2, memory_budget=400))
+
+    def test_ctrl_c_stops_run(self):
+        marker = tempfile.mktemp()
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        process = subprocess.Popen([sys.executable, '-c', INTERRUPTED_RUN % {'root': root, 'marker': marker}],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setsid)
+        self.assertEqual('started', process.stdout.readline().strip())
+        time.sleep(1)
+        # like Ctrl-C in a terminal, the signal goes to the whole process group
+        os.killpg(process.pid, signal.SIGINT)
+        deadline = time.time() + 5
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        stopped = process.poll() is not None
+        # the sleeping child is still running
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        self.assertTrue(stopped, "the scheduler did not stop on SIGINT")
+        self.assertIn('KeyboardInterrupt', process.stderr.read())
+        self.assertFalse(os.path.exists(marker), "a task was started after the interrupt")
+
+    def test_resume_after_ctrl_c(self):
+        directory = tempfile.mkdtemp()
+        try:
+            paths = dict((name, os.path.join(directory, name)) for name in ('first', 'second', 'third', 'journal'))
+            paths['root'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            process = subprocess.Popen([sys.executable, '-c', JOURNALED_RUN % paths],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setsid)
+            self.assertEqual('started', process.stdout.readline().strip())
+            os.killpg(process.pid, signal.SIGINT)
+            stderr = process.communicate()[1]
+            self.assertIn('KeyboardInterrupt', stderr)
+            self.assertNotIn('could not record state', stderr)
+
+            # the resumed run starts with the interrupted task
+            executed = []
+            def run(name):
+                executed.append(name)
+                open(paths[name], 'w').close()
+            task_journal = journal.TaskJournal(paths['journal'], resume=True)
+            part_scheduler = scheduler.PartScheduler(1, journal=task_journal)
+            first = part_scheduler.add('first', lambda: run('first'), outputs=[paths['first']])
+            second = part_scheduler.add('second', lambda: run('second'), [first], outputs=[paths['second']])
+            part_scheduler.add('third', lambda: run('third'), [second], outputs=[paths['third']])
+            try:
+                self.assertFalse(part_scheduler.run())
+            finally:
+                task_journal.close()
+            self.assertEqual(['second', 'third'], executed)
+        finally:
+            shutil.rmtree(directory)
+
+
+
+class ArtifactTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.existing = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, size=0):
+        def action():
+            self.existing.append((name.split('.')[0], sorted(os.listdir(self.directory))))
+            with open(self.path(name), 'wb') as f:
+                f.write('\0' * size * 1024 * 1024)
+        return action
+
+    def read(self, name, fail=False):
+        def action():
+            self.existing.append((name, sorted(os.listdir(self.directory))))
+            if fail:
+                raise IOError("failed")
+        return action
+
+    def test_consumers_are_counted(self):
+        part_scheduler = scheduler.PartScheduler(1)
+        split = part_scheduler.add('split', self.write('europe.pbf'), outputs=[self.path('europe.pbf')],
+                                   intermediate=True)
+        germany = part_scheduler.add('germany', self.read('germany'), [split], inputs=[self.path('europe.pbf')])
+        austria = part_scheduler.add('austria', self.read('austria'), [split],
+                                     inputs=[self.path('europe.pbf'), self.path('planet.pbf')])
+        artifact = part_scheduler.artifacts[self.path('europe.pbf')]
+        self.assertEqual([artifact], split.artifacts)
+        self.assertEqual([germany, austria], artifact.consumers)
+        # the source pbf is not intermediate
+        self.assertEqual([artifact], austria.input_artifacts)
+
+    def test_removed_after_the_last_consumer(self):
+        part_scheduler = scheduler.PartScheduler(1)
+        europe = part_scheduler.add('europe', self.write('europe.pbf'), outputs=[self.path('europe.pbf')],
+                                    intermediate=True)
+        germany = part_scheduler.add('germany', self.write('germany.pbf'), [europe], outputs=[self.path('germany.pbf')],
+                                     intermediate=True, inputs=[self.path('europe.pbf')])
+        part_scheduler.add('bavaria', self.read('bavaria'), [germany], inputs=[self.path('germany.pbf')])
+        part_scheduler.add('austria', self.read('austria'), [europe], inputs=[self.path('europe.pbf')])
+        self.assertFalse(part_scheduler.run())
+        # europe is removed once germany and austria read it, germany once bavaria read it
+        self.assertEqual([('europe', []), ('germany', ['europe.pbf']), ('austria', ['europe.pbf', 'germany.pbf']),
+                          ('bavaria', ['germany.pbf'])], self.existing)
+        self.assertEqual([], os.listdir(self.directory))
+        self.assertTrue(all(artifact.removed for artifact in part_scheduler.artifacts.values()))
+
+    def test_kept_if_a_consumer_fails(self):
+        part_scheduler = scheduler.PartScheduler(1)
+        split = part_scheduler.add('split', self.write('europe.pbf'), outputs=[self.path('europe.pbf')],
+                                   intermediate=True)
+        part_scheduler.add('germany', self.read('germany', fail=True), [split], inputs=[self.path('europe.pbf')])
+        part_scheduler.add('austria', self.read('austria'), [split], inputs=[self.path('europe.pbf')])
+        self.assertTrue(part_scheduler.run())
+        # the extract is needed to run germany again
+        self.assertEqual(['europe.pbf'], os.listdir(self.directory))
+        self.assertFalse(part_scheduler.artifacts[self.path('europe.pbf')].removed)
+
+    def test_fits_disk(self):
+        self.assertTrue(scheduler.fits(0, 1, 0, scheduler.Task('task', None, disk=40), 100, 60))
+        self.assertFalse(scheduler.fits(0, 1, 0, scheduler.Task('task', None, disk=50), 100, 60))
+        self.assertTrue(scheduler.fits(0, 0, 0, scheduler.Task('task', None, disk=200), 100, 60))
+
+    def test_disk_budget(self):
+        part_scheduler = scheduler.PartScheduler(2, disk_budget=2)
+        first = part_scheduler.add('first', self.write('first.pbf', 2), outputs=[self.path('first.pbf')],
+                                   intermediate=True, disk=2)
+        part_scheduler.add('first map', self.read('first map'), [first], inputs=[self.path('first.pbf')])
+        part_scheduler.add('second', self.write('second.pbf', 2), outputs=[self.path('second.pbf')],
+                           intermediate=True, disk=2)
+        self.assertFalse(part_scheduler.run())
+        # the second extract waits until the first one was read and removed
+        self.assertEqual([('first', []), ('first map', ['first.pbf']), ('second', [])], self.existing)
+        self.assertEqual(0, part_scheduler.disk_in_use)
+
+    def test_simulated_disk(self):
+        part_scheduler = scheduler.PartScheduler(2)
+        split = part_scheduler.add('split', None, outputs=['europe.pbf', 'asia.pbf'], intermediate=True, disk=40)
+        part_scheduler.add('europe', None, [split], inputs=['europe.pbf'], disk=5)
+        part_scheduler.add('asia', None, [split], inputs=['asia.pbf'], disk=5)
+        durations = {'split': 10, 'europe': 5, 'asia': 8}
+        (schedule, peak_memory, peak_disk) = part_scheduler.simulate(lambda task: durations[task.name])
+        # the extract of europe is removed before the map of asia is done
+        self.assertEqual(50, peak_disk)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the shapefile to osm conversion, run from the repository root with
+python -m unittest discover -s tests
+'''
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+# the tests pass data sources to the converter themselves, GDAL is only imported
+try:
+    try:
+        from osgeo import ogr
+    except ImportError:
+        import ogr
+    import shape2osm
+except ImportError:
+    sys.modules['ogr'] = types.ModuleType('ogr')
+    try:
+        import shape2osm
+    finally:
+        del sys.modules['ogr']
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+class Ring:
+    def __init__(self, points):
+        self.points = points
+
+    def GetPointCount(self):
+        return len(self.points)
+
+    def GetX(self, i):
+        return self.points[i][0]
+
+    def GetY(self, i):
+        return self.points[i][1]
+
+    def GetPoints(self):
+        return list(self.points) or None
+
+
+class Polygon:
+    def __init__(self, rings):
+        self.rings = rings
+
+    def GetGeometryCount(self):
+        return len(self.rings)
+
+    def GetGeometryRef(self, i):
+        return self.rings[i]
+
+
+class FieldDefn:
+    def __init__(self, name):
+        self.name = name
+
+    def GetName(self):
+        return self.name
+
+
+class Feature:
+    def __init__(self, fid, polygon, fields):
+        self.fid = fid
+        self.polygon = polygon
+        self.fields = fields
+
+    def GetFID(self):
+        return self.fid
+
+    def GetGeometryRef(self):
+        return self.polygon
+
+    def GetFieldCount(self):
+        return len(self.fields)
+
+    def GetFieldAsString(self, i):
+        return self.fields[i][1]
+
+    def GetFieldDefnRef(self, i):
+        return FieldDefn(self.fields[i][0])
+
+
+class Layer:
+    def __init__(self, features):
+        self.features = features
+        self.position = 0
+
+    def GetExtent(self):
+        return (-10, 10, -10, 10)
+
+    def ResetReading(self):
+        self.position = 0
+
+    def SetSpatialFilterRect(self, *rect):
+        pass
+
+    def GetNextFeature(self):
+        if self.position < len(self.features):
+            self.position += 1
+            return self.features[self.position - 1]
+        return None
+
+
+class DataSource:
+    def __init__(self, name, features):
+        self.name = name
+        self.layer = Layer(features)
+
+    def GetName(self):
+        return self.name
+
+    def GetLayer(self, i):
+        return self.layer
+
+
+def closed_ring(points):
+    return Ring(points + points[:1])
+
+
+def data_source(name, offset):
+    '''
+    a few polygons: simple ones, one with holes, one with a ring longer than a way and
+    a degenerate one, the coordinates are shifted by the offset
+    '''
+    def ring(points):
+        return closed_ring([(x + offset, y + offset) for (x, y) in points])
+    fields = [('tile_x', '3'), ('FType', 'LakePond'), ('gnis_name', "a&b'<c> lake")]
+    features = [
+        Feature(0, Polygon([ring([(0, 0), (1, 0), (1, 1), (0, 1)])]), fields),
+        Feature(1, Polygon([ring([(2, 2), (6, 2), (6, 6), (2, 6)]),
+                            ring([(3, 3), (4, 3), (4, 4)]),
+                            ring([(4.5, 4.5), (5, 4.5), (5, 5), (4.75, 5.5), (4.5, 5)])]), fields[:1]),
+        Feature(2, Polygon([ring([(-1 - 0.5 * i, -1 - (i % 3)) for i in range(11)])]), []),
+        Feature(3, Polygon([Ring([])]), fields),
+    ]
+    return DataSource(name, features)
+
+
+class ShapeConverterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.max_waylength = shape2osm.Max_Waylength
+        self.ids = shape2osm.ids
+        # short ways, so rings are split, and the start id of the previous implementation
+        shape2osm.Max_Waylength = 4
+        shape2osm.ids = shape2osm.IdSequence(22951459320)
+
+    def tearDown(self):
+        shape2osm.Max_Waylength = self.max_waylength
+        shape2osm.ids = self.ids
+        shutil.rmtree(self.directory)
+
+    def test_output_of_previous_implementation(self):
+        # the reference files were written by the converter before it kept its state in
+        # ShapeConverter, which ran for both shapefiles in one process
+        for (name, offset) in (('first', 0), ('second', 20)):
+            output_location = os.path.join(self.directory, name)
+            shape2osm.run(data_source(name, offset), output_location=output_location)
+            with open(output_location + '.osm') as output:
+                with open(os.path.join(DATA_DIR, 'shape2osm-%s.osm' % name)) as reference:
+                    self.assertEqual(reference.read(), output.read())
+
+    def test_converters_share_ids(self):
+        first = shape2osm.ShapeConverter(os.path.join(self.directory, 'first'))
+        second = shape2osm.ShapeConverter(os.path.join(self.directory, 'second'))
+        first.convert(data_source('first', 0))
+        second.convert(data_source('second', 20))
+        first_ids = self.object_ids('first')
+        second_ids = self.object_ids('second')
+        self.assertTrue(first_ids)
+        self.assertEqual(len(first_ids) + len(second_ids), len(first_ids | second_ids))
+
+    def object_ids(self, name):
+        ids = set()
+        with open(os.path.join(self.directory, name + '.osm')) as output:
+            for line in output:
+                if line.startswith('<node') or line.startswith('<way') or line.startswith('<relation'):
+                    ids.add(re.search(r"\bid='(\d+)'", line).group(1))
+        return ids
+
+
+if __name__ == '__main__':
+    unittest.main()